@@ -1,5 +1,9 @@
 import httplib
 import json
+import time
+import Queue
+import socket
+import threading
 
 import logging
 
@@ -9,10 +13,138 @@ from urlparse import urlparse
 LOG = logging.getLogger(__name__)
 
 
+class HttpError(Exception):
+    """
+    The server answered with an unexpected status.
+    """
+    def __init__(self, status, body):
+        super(HttpError, self).__init__(
+            "HTTP status %s: %s" % (status, body))
+        self.status = status
+        self.body = body
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP/1.1 connections.
+
+    Up to ``size`` idle connections are kept per host. More connections
+    can be open at once, but the extra ones are closed after use.
+    ``connect_timeout`` and ``read_timeout`` are in seconds
+    (None means no timeout).
+    """
+    def __init__(self, size=8, connect_timeout=None, read_timeout=None):
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _idle_queue(self, key):
+        with self._lock:
+            try:
+                return self._idle[key]
+            except KeyError:
+                queue = self._idle[key] = Queue.LifoQueue(self.size)
+                return queue
+
+    def get(self, scheme, netloc):
+        """
+        Return a tuple of a connection to ``netloc`` and a flag
+        telling whether the connection has been used before.
+        """
+        try:
+            return self._idle_queue((scheme, netloc)).get_nowait(), True
+        except Queue.Empty:
+            pass
+        if scheme == "https":
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        return conn_class(netloc, timeout=self.connect_timeout), False
+
+    def put(self, scheme, netloc, conn):
+        try:
+            self._idle_queue((scheme, netloc)).put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    def close(self):
+        """
+        Close idle connections.
+        """
+        with self._lock:
+            queues = self._idle.values()
+            self._idle = {}
+        for queue in queues:
+            while True:
+                try:
+                    queue.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+    def request(self, url, method, body=None, headers={}):
+        """
+        Perform a request and return a tuple of response and its body.
+        A request is repeated on a new connection only if it could not
+        be sent over a reused connection (that the server has probably
+        closed) or the server closed the reused connection without
+        a status line. A request that the server may have processed
+        is never repeated.
+        """
+        parsed = urlparse(url)
+        request_uri = ("?".join([parsed.path, parsed.query])
+                       if parsed.query
+                       else parsed.path)
+        while True:
+            conn, reused = self.get(parsed.scheme, parsed.netloc)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    conn.sock.settimeout(self.read_timeout)
+                conn.request(method, request_uri, body, headers)
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if reused:
+                    LOG.debug("reconnecting to %s" % parsed.netloc)
+                    continue
+                raise
+            try:
+                resp = conn.getresponse()
+                resp_body = resp.read()
+            except httplib.BadStatusLine, ex:
+                conn.close()
+                if reused and no_status_line(ex):
+                    LOG.debug("reconnecting to %s" % parsed.netloc)
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.put(parsed.scheme, parsed.netloc, conn)
+            return resp, resp_body
+
+
+def no_status_line(ex):
+    """
+    Check if ``ex`` (a :class:`httplib.BadStatusLine`) means that
+    the connection was closed before a response was started.
+    """
+    return (not ex.line or ex.line == repr("") or
+            ex.line.startswith("No status line received"))
+
+
 class RestClient(object):
     debug = False
     auth_headers = {}
     management_url = ""
+    pool = ConnectionPool()
     
     def __init__(self, *args, **kwargs):
         for key, value in kwargs.iteritems():
@@ -42,14 +174,7 @@ class RestClient(object):
 
         resp, body = None, None
         try:
-            parsed = urlparse(args[0])
-            client = httplib.HTTPConnection(parsed.netloc)
-            request_uri = ("?".join([parsed.path, parsed.query])
-                           if parsed.query
-                           else parsed.path)
-            client.request(args[1], request_uri, **kwargs)
-            resp = client.getresponse()
-            body = resp.read()
+            resp, body = self.pool.request(args[0], args[1], **kwargs)
         finally:
             self.http_log(args, kwargs, resp, body)
         return (resp, body)
@@ -70,3 +195,50 @@ class RestClient(object):
 class BillingHeartClient(RestClient):
     def event(self, request):
         return self.post("/event", request)
+
+    def events(self, requests):
+        """
+        Post a list of events in one request. Returns a list
+        of results or raises :class:`HttpError` if the whole
+        request has failed.
+        """
+        resp, body = self.request(self.management_url + "/events", "POST",
+                                  body=requests, headers=self.auth_headers)
+        if resp.status != 200:
+            raise HttpError(resp.status, body)
+        return json.loads(body)
+
+    def post_events(self, requests, max_retries, on_drop):
+        """
+        Post a list of events with :meth:`events` retrying failures
+        and return a list of their results.
+
+        An unreachable Heart is waited for without a limit. If the Heart
+        fails the whole request more than ``max_retries`` times,
+        the events may be malformed, so they are split in halves that
+        are posted separately till the failing events are found.
+        They are passed to ``on_drop`` with the last error as lists
+        and their results are ``None``.
+        """
+        delay = 1
+        failures = 0
+        while True:
+            try:
+                return self.events(requests)
+            except Exception, ex:
+                if isinstance(ex, HttpError):
+                    failures += 1
+                    if failures > max_retries:
+                        error = ex
+                        break
+                LOG.error("cannot post %s events to the Heart: %s;"
+                          " retrying in %s seconds" %
+                          (len(requests), ex, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
+        if len(requests) == 1:
+            on_drop(requests, error)
+            return [None]
+        middle = len(requests) // 2
+        return (self.post_events(requests[:middle], max_retries, on_drop) +
+                self.post_events(requests[middle:], max_retries, on_drop))
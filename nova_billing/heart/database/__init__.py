@@ -1,5 +1,10 @@
+import sqlite3
+
 from flask import Flask
 from flaskext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
 
 from nova_billing.heart import app
 from nova_billing.utils import global_conf
@@ -7,3 +12,19 @@ from nova_billing.utils import global_conf
 
 app.config['SQLALCHEMY_DATABASE_URI'] = global_conf.heart_db_url
 db = SQLAlchemy(app)
+
+
+# pysqlite commits before a SAVEPOINT, so let SQLAlchemy begin
+# transactions itself to keep savepoints inside them
+
+
+@event.listens_for(Pool, "connect")
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, "begin")
+def _sqlite_begin(connection):
+    if connection.dialect.name == "sqlite":
+        connection.execute("BEGIN")
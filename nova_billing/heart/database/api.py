@@ -20,22 +20,922 @@
 Nova Billing API.
 """
 
-from itertools import repeat
+import weakref
+import itertools
+
+from bisect import bisect_right
 from datetime import datetime
 
+from sqlalchemy import Float, Integer
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query
 from sqlalchemy.sql import func, and_, or_
-from sqlalchemy.sql.expression import text
+from sqlalchemy.sql.expression import case, literal, select, text, \
+     FunctionElement
 
-from .models import Account, Resource, Segment, Tariff
+from .models import Account, Resource, Segment, Tariff, TariffChange, \
+     RollupMonth, BillRollup, CounterMonth, MonthCounter
 from . import db
+from . import kernel
 
 from nova_billing import utils
 
 
+class _seconds_between(FunctionElement):
+    """
+    Whole seconds elapsed from the first argument to the second one,
+    rounded down like :func:`nova_billing.utils.total_seconds`.
+    """
+    type = Integer()
+    name = "seconds_between"
+
+
+@compiles(_seconds_between)
+def _default_seconds_between(element, compiler, **kw):
+    begin_at, end_at = list(element.clauses)
+    return "FLOOR(EXTRACT(EPOCH FROM (%s - %s)))" % (
+        compiler.process(end_at), compiler.process(begin_at))
+
+
+@compiles(_seconds_between, "mysql")
+def _mysql_seconds_between(element, compiler, **kw):
+    begin_at, end_at = list(element.clauses)
+    return "TIMESTAMPDIFF(SECOND, %s, %s)" % (
+        compiler.process(begin_at), compiler.process(end_at))
+
+
+@compiles(_seconds_between, "sqlite")
+def _sqlite_seconds_between(element, compiler, **kw):
+    # SQLite keeps datetimes as "YYYY-MM-DD HH:MM:SS.ffffff" strings;
+    # strftime("%s") drops the fraction, so borrow a second when
+    # the microseconds of the end are less than those of the begin.
+    # Each argument is needed twice, so it is rendered once in a subselect
+    # and referred to by name: a bind parameter rendered twice would
+    # take one value for two placeholders.
+    begin_at, end_at = list(element.clauses)
+    return ("(SELECT CAST(strftime('%%s', seconds_end) AS INTEGER)"
+            " - CAST(strftime('%%s', seconds_begin) AS INTEGER)"
+            " - (CASE WHEN CAST(substr(seconds_end, 21, 6) AS INTEGER)"
+            " < CAST(substr(seconds_begin, 21, 6) AS INTEGER)"
+            " THEN 1 ELSE 0 END)"
+            " FROM (SELECT %s AS seconds_begin, %s AS seconds_end))" %
+            (compiler.process(begin_at), compiler.process(end_at)))
+
+
+def _clipped_seconds(begin_at, clip_begin, clip_end):
+    """
+    Build an expression of whole seconds like
+    :func:`nova_billing.utils.clipped_seconds`.
+    """
+    return (_seconds_between(begin_at, clip_end) -
+            _seconds_between(begin_at, clip_begin))
+
+
+_identity_caches = weakref.WeakKeyDictionary()
+
+
+def identity_cache():
+    """
+    Return a dictionary of accounts and resources looked up
+    by the current session and of cache updates waiting
+    for :func:`commit`. The session lives till the end
+    of the request, so does the dictionary.
+    """
+    session = db.session()
+    try:
+        return _identity_caches[session]
+    except KeyError:
+        cache = _identity_caches[session] = {}
+        return cache
+
+
+class VersionedCache(object):
+    """
+    Bounded LRU cache whose entries are valid while the cache
+    version stays the same. Writers call :meth:`bump` to drop
+    all entries at once.
+    """
+    def __init__(self, maxsize):
+        self.lru = utils.LRUCache(maxsize)
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the value of ``key`` or raise ``KeyError``.
+        """
+        entry = self.lru.get(key)
+        if entry is not None and entry[0] == self.version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        raise KeyError(key)
+
+    def put(self, key, value, version):
+        """
+        Store ``value`` read when the cache had ``version``.
+        A value read before a concurrent :meth:`bump` is not stored.
+        """
+        if version == self.version:
+            self.lru.put(key, (version, value))
+
+    def bump(self):
+        self.version += 1
+        self.lru.clear()
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.lru),
+                "maxsize": self.lru.maxsize,
+                "version": self.version}
+
+
+caches = {
+    "tariff": VersionedCache(1),
+    "account_map": VersionedCache(1),
+    "account": VersionedCache(utils.global_conf.heart_cache_size),
+    "resource": VersionedCache(utils.global_conf.heart_cache_size),
+}
+
+
+def cache_stats():
+    return dict(((name, cache.stats())
+                 for name, cache in caches.iteritems()))
+
+
+def cache_clear():
+    for cache in caches.itervalues():
+        cache.bump()
+
+
+def cache_put_on_commit(name, key, value):
+    """
+    Store ``value`` in cache ``name`` when the current transaction
+    is committed with :func:`commit`. Objects flushed by the transaction
+    are visible to its queries, so they may be cached only after commit.
+    """
+    cache = caches[name]
+    identity_cache().setdefault("put", []).append(
+        (cache, key, value, cache.version))
+
+
+def cache_bump_on_commit(name):
+    """
+    Bump cache ``name`` when the current transaction is committed
+    with :func:`commit`.
+    """
+    identity_cache().setdefault("bump", set()).add(name)
+
+
+def commit():
+    """
+    Commit the current transaction and update caches.
+    """
+    cache = identity_cache()
+    put = cache.pop("put", ())
+    bump = cache.pop("bump", ())
+    db.session.commit()
+    for name in bump:
+        caches[name].bump()
+    for cache, key, value, version in put:
+        cache.put(key, value, version)
+
+
+def rollback():
+    """
+    Roll back the current transaction and forget objects it has created.
+    """
+    db.session.rollback()
+    identity_cache().clear()
+
+
+def begin_nested():
+    """
+    Begin a savepoint within the current transaction. It is ended
+    with :func:`commit_nested` or :func:`rollback_nested`.
+    """
+    db.session.begin_nested()
+    cache = identity_cache()
+    cache.setdefault("savepoints", []).append(len(cache.get("put", ())))
+
+
+def commit_nested():
+    """
+    Release the innermost savepoint.
+    """
+    identity_cache()["savepoints"].pop()
+    db.session.commit()
+
+
+def rollback_nested():
+    """
+    Roll back the innermost savepoint and forget objects it has created.
+    Cache bumps are kept, so that they are still done on :func:`commit`.
+    """
+    db.session.rollback()
+    cache = identity_cache()
+    del cache.setdefault("put", [])[cache["savepoints"].pop():]
+    for key in cache.keys():
+        if key not in ("put", "bump", "savepoints"):
+            del cache[key]
+
+
+def _clip_segments(period_start, period_stop, now, closed,
+                   account_id=None, account_range=None):
+    """
+    Select segments charged on [``period_start``, ``period_stop``]
+    with their beginnings and ends clipped to the interval.
+    ``account_id`` and ``account_range`` limit the accounts
+    of their resources.
+    """
+    end_at = func.coalesce(Segment.end_at, now)
+    if closed is None:
+        end_at_filter = or_(Segment.end_at > period_start,
+                            Segment.end_at == None)
+    elif closed:
+        end_at_filter = Segment.end_at > period_start
+    else:
+        end_at_filter = Segment.end_at == None
+    if now <= period_start:
+        # open segments last till ``now``, i.e., end before the interval
+        end_at_filter = and_(end_at_filter, Segment.end_at != None)
+    result = (select([
+                Segment.resource_id,
+                Segment.cost,
+                Segment.begin_at,
+                Segment.end_at,
+                case([(Segment.begin_at < period_start,
+                       literal(period_start))],
+                     else_=Segment.begin_at).label("clip_begin"),
+                # an open segment begun after ``now`` lasts no time
+                case([(end_at > period_stop, literal(period_stop)),
+                      (end_at < Segment.begin_at, Segment.begin_at)],
+                     else_=end_at).label("clip_end")]).
+                where(Segment.begin_at < period_stop).
+                where(end_at_filter))
+    conditions = _account_conditions(Resource.account_id,
+                                     account_id, account_range)
+    if conditions:
+        result = result.where(Segment.resource_id.in_(
+            select([Resource.id]).where(and_(*conditions))))
+    return result.alias("clipped")
+
+
+def _migration_adjustment(clipped):
+    """
+    Select extra linear cost of resources charged after tariff
+    changes migrated within their clipped segments.
+    See :meth:`TariffSchedule.charge`.
+    """
+    change = TariffChange.__table__.alias("change")
+    first = TariffChange.__table__.alias("first_change")
+    base = (select([first.c.prev_scale]).
+            where(and_(first.c.rtype == change.c.rtype,
+                       first.c.begin_at > clipped.c.begin_at)).
+            order_by(first.c.begin_at, first.c.id).
+            limit(1).
+            as_scalar())
+    piece_begin = case([(change.c.begin_at > clipped.c.clip_begin,
+                         change.c.begin_at)],
+                       else_=clipped.c.clip_begin)
+    cost = case([(base > 0,
+                  clipped.c.cost * (change.c.scale - change.c.prev_scale) /
+                  base *
+                  _clipped_seconds(clipped.c.begin_at, piece_begin,
+                                   clipped.c.clip_end) /
+                  literal(utils.SECONDS_IN_YEAR, Float))],
+                else_=0.0)
+    return (select([clipped.c.resource_id,
+                    func.sum(cost, type_=Float).label("cost")]).
+            select_from(clipped.
+                        join(Resource.__table__,
+                             Resource.id == clipped.c.resource_id).
+                        join(change,
+                             and_(change.c.rtype == Resource.rtype,
+                                  change.c.begin_at > clipped.c.begin_at,
+                                  change.c.begin_at < clipped.c.clip_end))).
+            where(and_(clipped.c.cost > 0,
+                       change.c.scale != change.c.prev_scale)).
+            group_by(clipped.c.resource_id).
+            alias("adjustment"))
+
+
+def _account_conditions(column, account_id, account_range):
+    conditions = []
+    if account_id:
+        conditions.append(column == account_id)
+    if account_range is not None:
+        conditions.append(column > account_range[0])
+        conditions.append(column <= account_range[1])
+    return conditions
+
+
+def _filter_accounts(result, column, account_id, account_range):
+    for condition in _account_conditions(column, account_id, account_range):
+        result = result.filter(condition)
+    return result
+
+
+def account_page(after_id=None, limit=None):
+    """
+    Return the range of ids of ``limit`` accounts following
+    ``after_id`` as a tuple of the exclusive lower and the inclusive
+    upper bound. ``None`` means that there are no such accounts.
+    """
+    table = Account.__table__
+    statement = select([table.c.id]).order_by(table.c.id)
+    if after_id is not None:
+        statement = statement.where(table.c.id > after_id)
+    ids = [row.id for row in db.session.execute(
+        statement.limit(limit) if limit is not None else statement)]
+    if not ids:
+        return None
+    return (after_id if after_id is not None else ids[0] - 1), ids[-1]
+
+
+def bill_query(period_start, period_stop, account_id=None, now=None,
+               closed=None, account_range=None):
+    """
+    Build a query that charges every resource on the interval
+    [``period_start``, ``period_stop``] in a single aggregated pass.
+
+    Segments are clipped to the interval (open segments last till
+    ``now`` or no time if they begin later) and their costs are summed
+    by the database following :meth:`TariffSchedule.charge`, so linear
+    costs also follow migrated tariff changes. The query returns one row
+    per resource ordered by account and resource id with the following
+    columns: ``id``, ``account_id``, ``parent_id``, ``name``, ``rtype``,
+    ``cost``, ``carried_fixed``, ``min_start``, ``max_start``,
+    and ``max_stop``. ``carried_fixed`` is the fixed cost of segments
+    started before ``period_start``.
+
+    ``closed=True`` charges only closed segments and ``closed=False``
+    charges only open ones. ``account_range`` limits the accounts
+    (see :func:`account_page`).
+    """
+    if now is None:
+        now = datetime.utcnow()
+    clipped = _clip_segments(period_start, period_stop, now, closed)
+    cost = func.sum(
+        case([(clipped.c.cost < 0, clipped.c.cost)],
+             else_=(clipped.c.cost *
+                    _clipped_seconds(clipped.c.begin_at,
+                                     clipped.c.clip_begin,
+                                     clipped.c.clip_end) /
+                    literal(utils.SECONDS_IN_YEAR, Float))),
+        type_=Float)
+    # segments are scanned twice only if there are migrated changes
+    adjustment = None
+    if tariff_schedule().migrated_before(period_stop):
+        adjustment = _migration_adjustment(
+            _clip_segments(period_start, period_stop, now, closed,
+                           account_id, account_range))
+        cost = cost + func.coalesce(func.max(adjustment.c.cost), 0.0)
+
+    result = (db.session.query(
+                Resource.id,
+                Resource.account_id,
+                Resource.parent_id,
+                Resource.name,
+                Resource.rtype,
+                cost.label("cost"),
+                func.sum(case([(and_(clipped.c.cost < 0,
+                                     clipped.c.begin_at < period_start),
+                                clipped.c.cost)],
+                              else_=0.0), type_=Float).label("carried_fixed"),
+                func.min(clipped.c.begin_at).label("min_start"),
+                func.max(clipped.c.begin_at).label("max_start"),
+                func.max(clipped.c.end_at).label("max_stop")).
+                join(clipped, clipped.c.resource_id == Resource.id))
+    if adjustment is not None:
+        result = result.outerjoin(
+            adjustment, adjustment.c.resource_id == Resource.id)
+    result = _filter_accounts(result, Resource.account_id,
+                              account_id, account_range)
+    return (result.
+            group_by(Resource.id,
+                     Resource.account_id,
+                     Resource.parent_id,
+                     Resource.name,
+                     Resource.rtype).
+            order_by(Resource.account_id, Resource.id))
+
+
+def rollup_months(period_start, period_stop, now=None):
+    """
+    Return the list of month beginnings if [``period_start``, ``period_stop``]
+    consists of whole closed months and ``None`` otherwise.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    if (period_start != utils.month_start(period_start) or
+        period_stop != utils.month_start(period_stop) or
+        period_stop > utils.month_start(now)):
+        return None
+    months = []
+    month = period_start
+    while month < period_stop:
+        months.append(month)
+        month = utils.add_months(month, 1)
+    return months or None
+
+
+def rollup_refresh(months):
+    """
+    Materialize bills of the given closed ``months`` that are not stored yet.
+    """
+    stored = set((obj.month for obj in
+                  RollupMonth.query.filter(RollupMonth.month.in_(months))))
+    for month in months:
+        if month in stored:
+            continue
+        rows = [{
+            "month": month,
+            "resource_id": row.id,
+            "cost": row.cost or 0.0,
+            "carried_fixed": row.carried_fixed or 0.0,
+            "min_start": row.min_start,
+            "max_start": row.max_start,
+            "max_stop": row.max_stop,
+        } for row in bill_query(month, utils.add_months(month, 1))]
+        if rows:
+            db.session.execute(BillRollup.__table__.insert(), rows)
+        db.session.add(RollupMonth(month=month))
+    db.session.commit()
+
+
+def rollup_invalidate(since=None):
+    """
+    Drop materialized bills of months that can be changed by a write
+    made at ``since``. ``since=None`` drops all of them.
+    """
+    for model in RollupMonth, BillRollup:
+        statement = model.__table__.delete()
+        if since is not None:
+            statement = statement.where(
+                model.month >= utils.month_start(since))
+        db.session.execute(statement)
+
+
+def rollup_query(months, account_id=None, account_range=None):
+    """
+    Build a query that sums up materialized bills of ``months``.
+    It returns the same columns as :func:`bill_query`.
+    """
+    first_month = min(months)
+    cost = case([(BillRollup.month == first_month, BillRollup.cost)],
+                else_=BillRollup.cost - BillRollup.carried_fixed)
+    result = (db.session.query(
+                Resource.id,
+                Resource.account_id,
+                Resource.parent_id,
+                Resource.name,
+                Resource.rtype,
+                func.sum(cost, type_=Float).label("cost"),
+                func.sum(case([(BillRollup.month == first_month,
+                                BillRollup.carried_fixed)],
+                              else_=0.0), type_=Float).label("carried_fixed"),
+                func.min(BillRollup.min_start).label("min_start"),
+                func.max(BillRollup.max_start).label("max_start"),
+                func.max(BillRollup.max_stop).label("max_stop")).
+                join(BillRollup, BillRollup.resource_id == Resource.id).
+                filter(BillRollup.month.in_(months)))
+    result = _filter_accounts(result, Resource.account_id,
+                              account_id, account_range)
+    return (result.
+            group_by(Resource.id,
+                     Resource.account_id,
+                     Resource.parent_id,
+                     Resource.name,
+                     Resource.rtype).
+            order_by(Resource.account_id, Resource.id))
+
+
+class BillRow(object):
+    """
+    Resource bill with the same attributes as rows of :func:`bill_query`
+    taken from ``row`` or ``values``.
+    """
+    keys = ("id", "account_id", "parent_id", "name", "rtype",
+            "cost", "carried_fixed", "min_start", "max_start",
+            "max_stop")
+
+    def __init__(self, row=None, **values):
+        for key in self.keys:
+            setattr(self, key,
+                    getattr(row, key) if row is not None else values[key])
+
+    def add(self, row):
+        """
+        Add a bill of the same resource computed on other segments.
+        """
+        self.cost = (self.cost or 0.0) + (row.cost or 0.0)
+        self.carried_fixed = ((self.carried_fixed or 0.0) +
+                              (row.carried_fixed or 0.0))
+        self.min_start = min(self.min_start, row.min_start)
+        self.max_start = max(self.max_start, row.max_start)
+        if self.max_stop is None or (row.max_stop is not None and
+                                     row.max_stop > self.max_stop):
+            self.max_stop = row.max_stop
+
+
+def month_to_date_month(period_start, period_stop, now=None):
+    """
+    Return ``period_start`` if [``period_start``, ``period_stop``]
+    is the current month and ``None`` otherwise.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    month = utils.month_start(now)
+    if period_start == month and period_stop == utils.add_months(month, 1):
+        return month
+    return None
+
+
+def counter_refresh(month):
+    """
+    Seed month-to-date counters of ``month`` from closed segments
+    unless they are already kept.
+
+    The month is committed first and then claimed with an update
+    that keeps it locked till the counters are committed. Meanwhile
+    :func:`counter_add` waits for the lock, so a segment closed
+    concurrently is either seen by the seeding or added to its counter.
+    """
+    counter_month = CounterMonth.query.get(month)
+    if counter_month is not None and counter_month.seeded:
+        return
+    if counter_month is None:
+        db.session.add(CounterMonth(month=month, seeded=False))
+    db.session.commit()
+    table = CounterMonth.__table__
+    if not db.session.execute(
+            table.update().
+            where(and_(table.c.month == month, table.c.seeded == False)).
+            values(seeded=True)).rowcount:
+        # seeded by another request
+        db.session.commit()
+        return
+    rows = [{
+        "month": month,
+        "resource_id": row.id,
+        "account_id": row.account_id,
+        "cost": row.cost or 0.0,
+        "min_start": row.min_start,
+        "max_start": row.max_start,
+        "max_stop": row.max_stop,
+    } for row in bill_query(month, utils.add_months(month, 1), closed=True)]
+    if rows:
+        db.session.execute(MonthCounter.__table__.insert(), rows)
+    db.session.commit()
+
+
+def counter_add(account_id, resource_id, rtype, segment_id, end_at,
+                now=None):
+    """
+    Charge segment ``segment_id`` that is being closed at ``end_at``
+    to the current month counters if they are kept.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    month = utils.month_start(now)
+    next_month = utils.add_months(month, 1)
+    if end_at <= month:
+        return
+    months = CounterMonth.__table__
+    # a shared lock waits for the month being seeded (see counter_refresh)
+    if not db.session.execute(select([months.c.seeded],
+                                     months.c.month == month,
+                                     for_update="read")).scalar():
+        return
+    segment = Segment.query.get(segment_id)
+    if segment.begin_at >= next_month:
+        return
+    # a late event can close a segment before its beginning
+    clip_begin = max(segment.begin_at, month)
+    cost = tariff_schedule().charge(rtype, segment.cost,
+                                    segment.begin_at, clip_begin,
+                                    max(min(end_at, next_month), clip_begin))
+    # add in the database, so that concurrent workers do not lose
+    # each other's costs
+    table = MonthCounter.__table__
+    begin_at = literal(segment.begin_at)
+    result = db.session.execute(
+        table.update().
+        where(and_(table.c.month == month,
+                   table.c.resource_id == resource_id)).
+        values(cost=table.c.cost + cost,
+               min_start=case([(table.c.min_start > begin_at, begin_at)],
+                              else_=table.c.min_start),
+               max_start=case([(table.c.max_start < begin_at, begin_at)],
+                              else_=table.c.max_start),
+               max_stop=case([(or_(table.c.max_stop == None,
+                                   table.c.max_stop < literal(end_at)),
+                               literal(end_at))],
+                             else_=table.c.max_stop)))
+    if not result.rowcount:
+        db.session.execute(table.insert(), {
+            "month": month,
+            "resource_id": resource_id,
+            "account_id": account_id,
+            "cost": cost,
+            "min_start": segment.begin_at,
+            "max_start": segment.begin_at,
+            "max_stop": end_at})
+
+
+def counter_invalidate(since=None):
+    """
+    Drop month-to-date counters of months that can be changed by a write
+    made at ``since`` except by closing segments. ``since=None`` drops
+    all of them.
+    """
+    for model in CounterMonth, MonthCounter:
+        statement = model.__table__.delete()
+        if since is not None:
+            statement = statement.where(
+                model.month >= utils.month_start(since))
+        db.session.execute(statement)
+
+
+def month_to_date_rows(month, account_id=None, now=None,
+                       account_range=None):
+    """
+    Bill the current ``month`` as month-to-date counters
+    plus open segments charged till ``now``.
+
+    :returns: an iterator over rows like ones of :func:`bill_query`
+        ordered by account and resource id. Counters and open segments
+        are read on dedicated connections (see :func:`stream_rows`)
+        and merged row by row.
+    """
+    counter_refresh(month)
+    counters = (db.session.query(
+                Resource.id,
+                Resource.account_id,
+                Resource.parent_id,
+                Resource.name,
+                Resource.rtype,
+                MonthCounter.cost,
+                literal(0.0, Float).label("carried_fixed"),
+                MonthCounter.min_start,
+                MonthCounter.max_start,
+                MonthCounter.max_stop).
+                join(MonthCounter, MonthCounter.resource_id == Resource.id).
+                filter(MonthCounter.month == month))
+    counters = _filter_accounts(counters, MonthCounter.account_id,
+                                account_id, account_range).order_by(
+                                    Resource.account_id, Resource.id)
+    segments = bill_query(month, utils.add_months(month, 1),
+                          account_id, now, closed=False,
+                          account_range=account_range)
+    return _sum_rows(_merge_rows(
+        _stream_statement(db.engine, counters.statement),
+        _stream_statement(db.engine, segments.statement)))
+
+
+def _row_key(row):
+    return (row.account_id, row.id)
+
+
+def _merge_rows(first, second):
+    """
+    Merge two iterators over rows ordered by account and resource id.
+    """
+    first_row = next(first, None)
+    second_row = next(second, None)
+    while first_row is not None or second_row is not None:
+        if second_row is None or (first_row is not None and
+                                  _row_key(first_row) <= _row_key(second_row)):
+            yield first_row
+            first_row = next(first, None)
+        else:
+            yield second_row
+            second_row = next(second, None)
+
+
+def _sum_rows(rows):
+    """
+    Sum adjacent ``rows`` of the same resource into :class:`BillRow`.
+    """
+    for key, group in itertools.groupby(rows, _row_key):
+        bill = BillRow(next(group))
+        for row in group:
+            bill.add(row)
+        yield bill
+
+
+def bill_row_to_dict(row):
+    """
+    Convert a row returned by :func:`bill_query` to a resource billing report.
+    """
+    destroyed_at = None
+    if row.max_stop is None or row.max_start < row.max_stop:
+        destroyed_at = row.max_stop
+    return {
+        "id": row.id,
+        "created_at": row.min_start,
+        "destroyed_at": destroyed_at,
+        "cost": row.cost or 0.0,
+        "parent_id": row.parent_id,
+        "name": row.name,
+        "rtype": row.rtype,
+    }
+
+
+def bill_rows(period_start, period_stop, account_id=None,
+              account_range=None):
+    """
+    Bill resources on the interval [``period_start``, ``period_stop``].
+    ``account_id=None`` means all accounts. ``account_range`` limits
+    the accounts (see :func:`account_page`).
+
+    Intervals of whole closed months are answered from materialized
+    monthly bills (see :func:`rollup_refresh`) and the current month
+    is answered from month-to-date counters (see :func:`counter_add`).
+
+    :returns: a query or an iterator over rows like ones of
+        :func:`bill_query` ordered by account and resource id.
+    """
+    months = rollup_months(period_start, period_stop)
+    if months:
+        try:
+            rollup_refresh(months)
+        except IntegrityError:
+            # another request is materializing the same months
+            rollback()
+        else:
+            return rollup_query(months, account_id, account_range)
+    if month_to_date_month(period_start, period_stop):
+        try:
+            return month_to_date_rows(period_start, account_id,
+                                      account_range=account_range)
+        except IntegrityError:
+            # another request is seeding the same counters
+            rollback()
+    return bill_query(period_start, period_stop, account_id,
+                      account_range=account_range)
+
+
+def stream_rows(rows):
+    """
+    Iterate over ``rows`` (a query or an iterable of rows). A query
+    is executed on a dedicated connection with a server-side cursor
+    where the driver supports it, so that rows are not loaded at once
+    and can be read after the session of the request is removed.
+    """
+    if not isinstance(rows, Query):
+        return iter(rows)
+    return _stream_statement(db.engine, rows.statement)
+
+
+def _stream_statement(engine, statement):
+    connection = engine.connect()
+    try:
+        result = connection.execution_options(
+            stream_results=True).execute(statement)
+        for row in result:
+            yield row
+    finally:
+        connection.close()
+
+
+def segment_scan_query(period_start, period_stop, account_id=None, now=None,
+                       account_range=None):
+    """
+    Build a query that selects segments charged on the interval
+    [``period_start``, ``period_stop``] with their resources.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    clipped = _clip_segments(period_start, period_stop, now, None)
+    result = (db.session.query(
+                Resource.id,
+                Resource.account_id,
+                Resource.parent_id,
+                Resource.name,
+                Resource.rtype,
+                clipped.c.cost,
+                clipped.c.begin_at,
+                clipped.c.end_at).
+                join(clipped, clipped.c.resource_id == Resource.id))
+    return _filter_accounts(result, Resource.account_id,
+                            account_id, account_range)
+
+
+def usage_on_interval(period_start, period_stop, granularity,
+                      account_id=None, now=None):
+    """
+    Charge accounts by resource types in buckets of ``granularity``
+    (see :func:`nova_billing.utils.time_buckets`) on the interval
+    [``period_start``, ``period_stop``] with a single scan of segments.
+
+    Linear costs are charged in every bucket a segment overlaps
+    following :meth:`TariffSchedule.charge`; a fixed cost is charged
+    in the bucket of the segment beginning (or in the first bucket
+    if the segment has begun before the interval). Seconds of buckets
+    are counted from segment beginnings (see
+    :func:`nova_billing.utils.clipped_seconds`), so they add up to
+    the seconds charged on the whole interval and the costs of buckets
+    add up to the bill of the interval up to floating point rounding.
+
+    :returns: a tuple of bucket edges and a dictionary of series
+        by ``(account_id, rtype)``. A series is a dictionary with
+        ``cost`` and ``seconds`` lists by buckets; ``seconds`` is
+        the time that linearly charged resources were used.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    edges = utils.time_buckets(period_start, period_stop, granularity)
+    buckets = len(edges) - 1
+    tariffs = tariff_schedule()
+    series = {}
+    for row in stream_rows(segment_scan_query(
+            period_start, period_stop, account_id, now)):
+        key = (row.account_id, row.rtype)
+        try:
+            costs, seconds = series[key]
+        except KeyError:
+            costs, seconds = series[key] = ([0.0] * buckets, [0] * buckets)
+        clip_begin = max(row.begin_at, period_start)
+        if row.cost < 0:
+            costs[bisect_right(edges, clip_begin) - 1] += row.cost
+            continue
+        clip_end = min(row.end_at or now, period_stop)
+        if clip_end <= clip_begin:
+            continue
+        i = bisect_right(edges, clip_begin) - 1
+        while i < buckets and edges[i] < clip_end:
+            begin = max(edges[i], clip_begin)
+            end = min(edges[i + 1], clip_end)
+            costs[i] += tariffs.charge(row.rtype, row.cost, row.begin_at,
+                                       begin, end)
+            seconds[i] += utils.clipped_seconds(row.begin_at, begin, end)
+            i += 1
+    return edges, dict(((key, {"cost": value[0], "seconds": value[1]})
+                        for key, value in series.iteritems()))
+
+
+def bill_on_periods(periods, account_id=None, now=None,
+                    account_range=None):
+    """
+    Bill resources on several ``periods`` (a list of tuples of their
+    beginnings and ends) with a single scan of segments. Segments are
+    charged in batches of ``heart_segment_batch_size`` by
+    :class:`nova_billing.heart.database.kernel.CostKernel`, so every
+    bill equals the one of :func:`bill_on_interval`.
+
+    :returns: a list of dictionaries like ones returned by
+        :func:`bill_on_interval` in the order of ``periods``.
+    """
+    if now is None:
+        now = datetime.utcnow()
+    cost_kernel = kernel.CostKernel(periods, tariff_schedule(), now)
+    rows = [{} for period in periods]
+    segments = stream_rows(segment_scan_query(
+        cost_kernel.start, cost_kernel.stop, account_id, now, account_range))
+    while True:
+        batch = list(itertools.islice(
+            segments, utils.global_conf.heart_segment_batch_size))
+        if not batch:
+            break
+        resources = dict(((row.id, row) for row in batch))
+        for (period, resource_id, cost, carried_fixed,
+             min_start, max_start, max_stop) in cost_kernel.charge(batch):
+            resource = resources[resource_id]
+            bill = BillRow(
+                id=resource_id, account_id=resource.account_id,
+                parent_id=resource.parent_id, name=resource.name,
+                rtype=resource.rtype, cost=cost,
+                carried_fixed=carried_fixed,
+                min_start=utils.epoch_to_datetime(min_start),
+                max_start=utils.epoch_to_datetime(max_start),
+                max_stop=(utils.epoch_to_datetime(max_stop)
+                          if max_stop is not None else None))
+            period_rows = rows[period]
+            try:
+                period_rows[resource_id].add(bill)
+            except KeyError:
+                period_rows[resource_id] = bill
+
+    retval = []
+    for period_rows in rows:
+        bills = {}
+        for bill in sorted(period_rows.itervalues(),
+                           key=lambda bill: (bill.account_id, bill.id)):
+            bills.setdefault(bill.account_id, []).append(
+                bill_row_to_dict(bill))
+        retval.append(bills)
+    return retval
+
+
 def bill_on_interval(period_start, period_stop, account_id=None):
     """
     Retrieve statistics for the given interval [``period_start``, ``period_stop``]. 
-    ``account_id=None`` means all accounts.
+    ``account_id=None`` means all accounts. See :func:`bill_rows`.
 
     Example of the returned value:
 
@@ -75,77 +975,81 @@ def bill_on_interval(period_start, period_stop, account_id=None):
 
     :returns: a dictionary where keys are account ids and values are billing lists.
     """
-    result = (db.session.query(Segment, Resource).
-                join(Resource).
-                filter(Segment.begin_at < period_stop).
-                filter(or_(Segment.end_at > period_start,
-                           Segment.end_at == None)))
-    if account_id:
-        result = result.filter(Resource.account_id == account_id)
-    
     retval = {}
-    rsrc_by_id = {}
-    now = datetime.utcnow()
-    for segment, rsrc in result:
-        if not retval.has_key(rsrc.account_id):
-            retval[rsrc.account_id] = []
-        try:
-            rsrc_descr = rsrc_by_id[rsrc.id]
-        except KeyError:
-            rsrc_descr = {
-                "id": rsrc.id,
-                "created_at": None,
-                "destroyed_at": None,
-                "cost": 0.0,
-                "parent_id": rsrc.parent_id,
-                "name": rsrc.name,
-                "rtype": rsrc.rtype,
-            }
-            retval[rsrc.account_id].append(rsrc_descr)
-            rsrc_by_id[rsrc.id] = rsrc_descr
-        begin_at = max(segment.begin_at, period_start)
-        end_at = min(segment.end_at or now, period_stop)
-        rsrc_descr["cost"] += utils.cost_add(segment.cost, begin_at, end_at)
-
-    result = (db.session.query(Segment,
-        func.min(Segment.begin_at).label("min_start"),
-        func.max(Segment.begin_at).label("max_start"),
-        func.max(Segment.end_at).label("max_stop"),
-        Resource.id).
-        join(Resource).
-        group_by(Resource.id).
-        filter(Segment.begin_at < period_stop).
-        filter(or_(Segment.end_at > period_start,
-                   Segment.end_at == None)))
-    if account_id:
-        result = result.filter(Resource.account_id == account_id)
+    for row in bill_rows(period_start, period_stop, account_id):
+        retval.setdefault(row.account_id, []).append(bill_row_to_dict(row))
+    return retval
 
-    for row in result:
-        rsrc_descr = rsrc_by_id.get(row.id, None)
-        if not rsrc_descr:
-            continue
-        rsrc_descr["created_at"] = row.min_start
-        if row.max_stop is None or row.max_start < row.max_stop:
-            rsrc_descr["destroyed_at"] = row.max_stop
 
-    return retval
+def cached_get(model, cache_name, key, query):
+    """
+    Find an object of ``model`` by its id cached under ``key``
+    or with ``query``.
+    """
+    cache = caches[cache_name]
+    try:
+        obj_id = cache.get(key)
+    except KeyError:
+        pass
+    else:
+        obj = model.query.get(obj_id)
+        if obj is not None:
+            return obj
+    obj = query()
+    if obj is not None:
+        cache_put_on_commit(cache_name, key, obj.id)
+    return obj
+
+
+def account_query(name):
+    return Account.query.filter_by(name=name)
 
 
 def account_get_or_create(name):
-    obj = Account.query.filter_by(name=name).first()
+    """
+    Find or create an account. A new account is flushed,
+    but not committed.
+    """
+    cache = identity_cache()
+    key = ("account", name)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    obj = cached_get(Account, "account", name,
+                     lambda: account_query(name).first())
     if obj == None:
         obj = Account(name=name)
         db.session.add(obj)
-        db.session.commit()
+        db.session.flush()
+        cache_put_on_commit("account", name, obj.id)
+        cache_bump_on_commit("account_map")
+    cache[key] = obj
     return obj
 
 
-def resource_get_or_create(account_id, parent_id, rtype, name):
-    obj = Resource.query.filter_by(
+def resource_query(account_id, parent_id, rtype, name):
+    return Resource.query.filter_by(
         account_id=account_id,
         parent_id=parent_id,
         rtype=rtype,
-        name=name).first()
+        name=name)
+
+
+def resource_get_or_create(account_id, parent_id, rtype, name):
+    """
+    Find or create a resource. A new resource is flushed,
+    but not committed.
+    """
+    cache = identity_cache()
+    key = ("resource", account_id, parent_id, rtype, name)
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    obj = cached_get(Resource, "resource", key[1:],
+                     lambda: resource_query(
+                         account_id, parent_id, rtype, name).first())
     if obj == None:
         obj = Resource( 
             account_id=account_id,
@@ -153,72 +1057,333 @@ def resource_get_or_create(account_id, parent_id, rtype, name):
             rtype=rtype,
             name=name)
         db.session.add(obj)
-        db.session.commit()
+        db.session.flush()
+        cache_put_on_commit("resource", key[1:], obj.id)
+    cache[key] = obj
     return obj
 
 
-def resource_segment_end(resource_id, end_at):
-    db.session.execute(Segment.__table__.update().
+def resource_get_or_create_many(keys):
+    """
+    Find or create resources by a list of ``(account_id, parent_id,
+    rtype, name)`` keys with selects by 500 names or parents and
+    one multi-row insert. Keys should have either a name or a parent.
+    Returns a dict of resource ids by keys.
+    """
+    # names are compared as stored, e.g., an integer id as a string
+    keys = dict((((key[0], key[1], key[2],
+                   unicode(key[3]) if key[3] is not None else None), key)
+                 for key in keys))
+    if not keys:
+        return {}
+    names = list(set((key[3] for key in keys if key[3] is not None)))
+    parents = list(set((key[1] for key in keys if key[1] is not None)))
+    rtypes = set((key[2] for key in keys))
+    table = Resource.__table__
+    # keep the number of bound parameters low for SQLite
+    lookups = ([table.c.name.in_(names[i:i + 500])
+                for i in xrange(0, len(names), 500)] +
+               [table.c.parent_id.in_(parents[i:i + 500])
+                for i in xrange(0, len(parents), 500)])
+    statements = [select([table.c.id, table.c.account_id, table.c.parent_id,
+                          table.c.rtype, table.c.name]).
+                  where(and_(table.c.rtype.in_(rtypes), lookup))
+                  for lookup in lookups]
+
+    def find():
+        ret = {}
+        for statement in statements:
+            for row in db.session.execute(statement):
+                key = (row.account_id, row.parent_id, row.rtype, row.name)
+                if key in keys:
+                    ret[keys[key]] = row.id
+        return ret
+
+    ret = find()
+    missing = [{"account_id": key[0], "parent_id": key[1],
+                "rtype": key[2], "name": key[3]}
+               for key, orig_key in keys.iteritems() if orig_key not in ret]
+    if missing:
+        db.session.execute(table.insert(), missing)
+        ret = find()
+    return ret
+
+
+def segment_end_statement(segment_id, end_at):
+    return (Segment.__table__.update().
         values(end_at=end_at).where(
-            Segment.resource_id == resource_id))
+            Segment.id == segment_id))
+
+
+def resource_segment_end(rsrc, end_at):
+    """
+    Close the open segment of ``rsrc`` at ``end_at``.
+    Only the open segment is updated; closed ones never change.
+    Materialized bills of ``rsrc`` on whole months the segment crosses
+    get its end as ``max_stop``; their costs stay the same. Materialized
+    bills from the month of ``end_at`` should be dropped by the caller
+    (see :func:`rollup_invalidate`).
+    """
+    segment_id = rsrc.current_segment_id
+    if segment_id is None:
+        return
+    counter_add(rsrc.account_id, rsrc.id, rsrc.rtype, segment_id, end_at)
+    begin_at = Segment.query.get(segment_id).begin_at
+    end_month = utils.month_start(end_at)
+    if begin_at < end_month:
+        table = BillRollup.__table__
+        db.session.execute(
+            table.update().
+            where(and_(table.c.resource_id == rsrc.id,
+                       table.c.month >= utils.month_start(begin_at),
+                       table.c.month < end_month,
+                       or_(table.c.max_stop == None,
+                           table.c.max_stop < end_at))).
+            values(max_stop=end_at))
+    db.session.execute(segment_end_statement(segment_id, end_at))
+    rsrc.current_segment_id = None
+
+
+def resource_segment_begin(rsrc, cost, begin_at):
+    """
+    Open a new segment of ``rsrc``. The open segment
+    should be closed with :func:`resource_segment_end` before.
+    """
+    obj = Segment(
+        resource_id=rsrc.id,
+        cost=cost,
+        begin_at=begin_at)
+    db.session.add(obj)
+    db.session.flush()
+    rsrc.current_segment_id = obj.id
+
+
+def resource_current_segment_sync(rtypes=None):
+    """
+    Point ``current_segment_id`` of resources (of ``rtypes``
+    if given) to their latest open segments.
+    Used after segments are written bypassing
+    :func:`resource_segment_begin`.
+    """
+    open_segment = (select([func.max(Segment.id)]).
+                    where(and_(Segment.resource_id == Resource.id,
+                               Segment.end_at == None)).
+                    as_scalar())
+    statement = (Resource.__table__.update().
+                 values(current_segment_id=open_segment))
+    if rtypes is not None:
+        statement = statement.where(Resource.rtype.in_(rtypes))
+    db.session.execute(statement)
 
 
 def account_map():
-    return dict(((obj.id, obj.name)
-                 for obj in Account.query.all()))
+    """
+    Return a dictionary of account names by ids. The map is cached
+    till any process creates an account.
+    """
+    last_id = db.session.query(func.max(Account.id)).scalar()
+    cache = caches["account_map"]
+    try:
+        return dict(cache.get(last_id))
+    except KeyError:
+        pass
+    version = cache.version
+    result = dict(((obj.id, obj.name) for obj in Account.query.all()))
+    cache.put(last_id, result, version)
+    return dict(result)
+
+
+def account_list(after_id=None, limit=None):
+    """
+    Return a list of ids and names of ``limit`` accounts following
+    ``after_id`` ordered by id.
+    """
+    result = Account.query.order_by(Account.id)
+    if after_id is not None:
+        result = result.filter(Account.id > after_id)
+    if limit is not None:
+        result = result.limit(limit)
+    return [(obj.id, obj.name) for obj in result]
+
+
+def account_names(account_ids):
+    """
+    Return a dictionary of names of ``account_ids`` read on a dedicated
+    connection (for example, while a response is streamed).
+    """
+    table = Account.__table__
+    return dict(((row.id, row.name) for row in db.engine.execute(
+        select([table.c.id, table.c.name]).
+        where(table.c.id.in_(account_ids)))))
+
+
+class TariffSchedule(object):
+    """
+    Current tariff multipliers together with the history
+    of tariff changes (see :class:`TariffChange`).
+    """
+    def __init__(self, multipliers, changes):
+        self.multipliers = multipliers
+        # rtype => lists of begin_at and (prev_scale, scale)
+        # of changes ordered by begin_at
+        self.begins = {}
+        self.scales = {}
+        for rtype, begin_at, prev_scale, scale in changes:
+            self.begins.setdefault(rtype, []).append(begin_at)
+            self.scales.setdefault(rtype, []).append((prev_scale, scale))
+
+    def last_change(self, rtype):
+        """
+        Return a tuple of ``begin_at``, ``prev_scale``, and ``scale``
+        of the latest change of ``rtype`` or None.
+        """
+        try:
+            return (self.begins[rtype][-1], ) + self.scales[rtype][-1]
+        except KeyError:
+            return None
+
+    def migrated_before(self, moment):
+        """
+        Check if any migrated change begins before ``moment``.
+        """
+        for rtype, begins in self.begins.iteritems():
+            for begin_at, (prev_scale, scale) in zip(
+                    begins, self.scales[rtype]):
+                if begin_at >= moment:
+                    break
+                if scale != prev_scale:
+                    return True
+        return False
+
+    def multiplier(self, rtype, at=None):
+        """
+        Return the multiplier of ``rtype`` in force at ``at``.
+        Migrated changes made after ``at`` are taken back,
+        so a late event is charged as it was in time.
+        """
+        multiplier = self.multipliers.get(rtype, 1)
+        if at is None or rtype not in self.begins:
+            return multiplier
+        scales = self.scales[rtype]
+        i = bisect_right(self.begins[rtype], at)
+        if i < len(scales) and scales[-1][1]:
+            multiplier = multiplier * scales[i][0] / scales[-1][1]
+        return multiplier
+
+    def charge(self, rtype, cost, begin_at, clip_begin, clip_end):
+        """
+        Charge a segment of ``rtype`` begun at ``begin_at`` on
+        [``clip_begin``, ``clip_end``] following
+        :func:`nova_billing.utils.cost_add` and migrated changes
+        made after ``begin_at``. Seconds are counted like in
+        :func:`nova_billing.utils.clipped_seconds`, so charges
+        of adjacent intervals add up to the charge of the whole.
+        """
+        if cost < 0:
+            return cost
+        total = (cost * utils.clipped_seconds(begin_at, clip_begin, clip_end) /
+                 utils.SECONDS_IN_YEAR)
+        if cost <= 0 or rtype not in self.begins:
+            return total
+        begins = self.begins[rtype]
+        scales = self.scales[rtype]
+        i = bisect_right(begins, begin_at)
+        if i >= len(scales) or not scales[i][0]:
+            return total
+        base = scales[i][0]
+        for begin, (prev_scale, scale) in zip(begins[i:], scales[i:]):
+            if begin >= clip_end:
+                break
+            total += (cost *
+                      utils.clipped_seconds(begin_at, max(begin, clip_begin),
+                                            clip_end) /
+                      utils.SECONDS_IN_YEAR *
+                      (scale - prev_scale) / base)
+        return total
+
+
+def tariff_schedule():
+    """
+    Return the current :class:`TariffSchedule`. It is cached
+    till any process records a new tariff change.
+    """
+    cache = identity_cache()
+    try:
+        return cache["tariff"]
+    except KeyError:
+        pass
+    last_id = db.session.query(func.max(TariffChange.id)).scalar()
+    tariff_cache = caches["tariff"]
+    try:
+        schedule = tariff_cache.get(last_id)
+    except KeyError:
+        version = tariff_cache.version
+        schedule = TariffSchedule(
+            dict(((obj.rtype, obj.multiplier)
+                  for obj in Tariff.query.all())),
+            [(obj.rtype, obj.begin_at, obj.prev_scale, obj.scale)
+             for obj in TariffChange.query.order_by(
+                 TariffChange.begin_at, TariffChange.id)])
+        tariff_cache.put(last_id, schedule, version)
+    cache["tariff"] = schedule
+    return schedule
 
 
 def tariff_map():
-    return dict(((obj.rtype, obj.multiplier)
-                 for obj in Tariff.query.all()))
+    return dict(tariff_schedule().multipliers)
 
 
-def resource_find(rtype, name):
-    resource_account = (db.session.query(Resource, Account).
+def tariffs_change(new_tariffs, event_datetime, migrate=False):
+    """
+    Set ``new_tariffs`` (a dictionary of multipliers by rtypes)
+    at ``event_datetime`` and record the changes.
+
+    With ``migrate``, segments begun before ``event_datetime`` are
+    charged after the new tariffs since then. Migrated changes
+    of an rtype must be made in the order of their datetimes,
+    otherwise ``ValueError`` is raised.
+    """
+    schedule = tariff_schedule()
+    new_tariffs = dict(((key, value)
+                        for key, value in new_tariffs.iteritems()
+                        if isinstance(value, (int, float))))
+    changes = []
+    for rtype, multiplier in new_tariffs.iteritems():
+        last = schedule.last_change(rtype)
+        if last is None:
+            begin_at, prev_scale = event_datetime, 1.0
+        else:
+            begin_at, prev_scale = max(last[0], event_datetime), last[2]
+        scale = prev_scale
+        if migrate:
+            if begin_at != event_datetime:
+                raise ValueError(
+                    "tariff of %s was changed after %s" %
+                    (rtype, utils.datetime_to_str(event_datetime)))
+            old_multiplier = schedule.multipliers.get(rtype, 1.0)
+            if old_multiplier <= 0:
+                old_multiplier = 1.0
+            scale = prev_scale * multiplier / old_multiplier
+        changes.append(TariffChange(
+            rtype=rtype,
+            begin_at=begin_at,
+            multiplier=multiplier,
+            prev_scale=prev_scale,
+            scale=scale))
+    for obj in changes:
+        db.session.merge(Tariff(rtype=obj.rtype, multiplier=obj.multiplier))
+        db.session.add(obj)
+    identity_cache().pop("tariff", None)
+    cache_bump_on_commit("tariff")
+
+
+def resource_find_query(rtype, name):
+    return (db.session.query(Resource, Account).
         filter(and_(Resource.rtype == rtype,
                and_(Resource.name == name,
-               Resource.account_id == Account.id))).first())
-    return resource_account[0] if resource_account else None
+               Resource.account_id == Account.id))))
 
 
-def tariffs_migrate(old_tariffs, new_tariffs, event_datetime):
-    new_tariffs = dict(
-        ((key, float(value))
-         for key, value in new_tariffs.iteritems()
-         if value != old_tariffs.get(key, 1.0)))
-    connection = db.session.connection()
-    for rtype in new_tariffs:
-        old_t = old_tariffs.get(rtype, 1.0)
-        if old_t < 0:
-            old_t = 1.0
-        
-        connection.execute(
-            "insert into %(segment)s"
-            " (resource_id, cost, begin_at, end_at)"
-            " select resource_id, cost * ?, ?, NULL"
-            " from %(segment)s, %(resource)s"
-            " where end_at is NULL "
-            " and %(segment)s.resource_id = %(resource)s.id"
-            " and %(resource)s.rtype = ?" %
-            {"segment": Segment.__tablename__,
-             "resource": Resource.__tablename__},
-            new_tariffs[rtype] / old_t,
-            event_datetime,
-            rtype)
-
-    changed_keys = new_tariffs.keys()
-    max_args = 32
-    for i in xrange(1 + len(changed_keys) / max_args):
-        partial_keys = changed_keys[i * max_args:(i + 1) * max_args] 
-        connection.execute(
-            "update %(segment)s"
-            " set end_at = ?"
-            " where end_at is NULL"
-            " and begin_at != ?"
-            " and resource_id in"
-            " (select id from %(resource)s where rtype in (%(type_list)s))" %
-            {"segment": Segment.__tablename__,
-             "resource": Resource.__tablename__,
-             "type_list": ", ".join(repeat("?", len(partial_keys)))},
-            event_datetime, event_datetime,
-            *partial_keys)
+def resource_find(rtype, name):
+    resource_account = resource_find_query(rtype, name).first()
+    return resource_account[0] if resource_account else None
@@ -0,0 +1,275 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cost kernel of multi-period bills.
+
+Segments are charged in batches loaded as columns of resource ids,
+costs, and beginnings and ends in microseconds since the epoch.
+Every segment is split across the periods it overlaps, clipped,
+charged following :meth:`TariffSchedule.charge`, and the costs are
+summed by periods and resources.
+
+NumPy is optional. With NumPy, a batch is charged with array
+operations; without it, the same arithmetic is done in a loop
+in the same order, so both ways give identical results.
+"""
+
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from nova_billing import utils
+
+
+MICROSECONDS = 1000000
+
+
+class CostKernel(object):
+    """
+    Charge segments on ``periods`` (a list of tuples of their
+    beginnings and ends) with ``tariffs`` (a :class:`TariffSchedule`).
+    Open segments last till ``now`` (or no time if they begin later)
+    like in :func:`nova_billing.heart.database.api.bill_query`.
+    ``use_numpy=None`` means using NumPy if it is installed.
+    """
+    def __init__(self, periods, tariffs, now, use_numpy=None):
+        self.use_numpy = (numpy is not None if use_numpy is None
+                          else use_numpy)
+        self.order = sorted(xrange(len(periods)), key=lambda i: periods[i])
+        self.starts = [utils.datetime_to_epoch(periods[i][0])
+                       for i in self.order]
+        self.stops = [utils.datetime_to_epoch(periods[i][1])
+                      for i in self.order]
+        # the latest end among the periods that begin not later;
+        # it is non-decreasing, so it can be bisected
+        self.max_stops = []
+        for stop in self.stops:
+            self.max_stops.append(max(self.max_stops[-1], stop)
+                                  if self.max_stops else stop)
+        self.now = utils.datetime_to_epoch(now)
+        # rtype => lists of begin_at, prev_scale, and scale of changes
+        self.changes = {}
+        for rtype, begins in tariffs.begins.iteritems():
+            self.changes[rtype] = (
+                [utils.datetime_to_epoch(begin_at) for begin_at in begins],
+                [float(prev_scale) for prev_scale, scale
+                 in tariffs.scales[rtype]],
+                [float(scale) for prev_scale, scale
+                 in tariffs.scales[rtype]])
+
+    @property
+    def start(self):
+        return utils.epoch_to_datetime(self.starts[0])
+
+    @property
+    def stop(self):
+        return utils.epoch_to_datetime(self.max_stops[-1])
+
+    def columns(self, rows):
+        """
+        Convert ``rows`` with ``id``, ``rtype``, ``cost``,
+        ``begin_at``, and ``end_at`` attributes to lists of resource
+        ids, rtypes, costs, beginnings, ends (``now`` for open
+        segments), and stops (``None`` for open segments).
+        """
+        ids, rtypes, costs, begins, ends, stops = [], [], [], [], [], []
+        for row in rows:
+            ids.append(row.id)
+            rtypes.append(row.rtype)
+            costs.append(float(row.cost))
+            begins.append(utils.datetime_to_epoch(row.begin_at))
+            if row.end_at is None:
+                ends.append(self.now)
+                stops.append(None)
+            else:
+                stop = utils.datetime_to_epoch(row.end_at)
+                ends.append(stop)
+                stops.append(stop)
+        return ids, rtypes, costs, begins, ends, stops
+
+    def charge(self, rows):
+        """
+        Charge a batch of segments ``rows`` (see :meth:`columns`).
+
+        :returns: a list of tuples of a period index, a resource id,
+            its cost, fixed cost carried from before the period,
+            the earliest and the latest segment beginning, and the latest
+            segment end (``None`` if all segments are open) ordered
+            by period indices in ``periods`` and resource ids.
+            Times are in microseconds since the epoch.
+        """
+        if self.use_numpy:
+            groups = self._charge_numpy(*self.columns(rows))
+        else:
+            groups = self._charge_python(*self.columns(rows))
+        return sorted(((self.order[group[0]], ) + tuple(group[1:])
+                       for group in groups), key=lambda group: group[:2])
+
+    def _linear(self, rtype, cost, begin, clip_begin, clip_end):
+        # whole seconds are counted from the segment beginning
+        # like in :func:`nova_billing.utils.clipped_seconds`
+        total = cost * ((clip_end - begin) // MICROSECONDS -
+                        (clip_begin - begin) // MICROSECONDS) / \
+            utils.SECONDS_IN_YEAR
+        if cost <= 0 or rtype not in self.changes:
+            return total
+        begins, prev_scales, scales = self.changes[rtype]
+        i = bisect_right(begins, begin)
+        if i >= len(scales) or not prev_scales[i]:
+            return total
+        base = prev_scales[i]
+        for k in xrange(i, len(begins)):
+            if begins[k] >= clip_end:
+                break
+            total += (cost *
+                      ((clip_end - begin) // MICROSECONDS -
+                       (max(begins[k], clip_begin) - begin) //
+                       MICROSECONDS) /
+                      utils.SECONDS_IN_YEAR *
+                      (scales[k] - prev_scales[k]) / base)
+        return total
+
+    def _charge_python(self, ids, rtypes, costs, begins, ends, stops):
+        starts, period_stops = self.starts, self.stops
+        groups = {}
+        for n in xrange(len(ids)):
+            cost, begin, end = costs[n], begins[n], ends[n]
+            for j in xrange(bisect_right(self.max_stops, begin),
+                            bisect_left(starts, end)):
+                if period_stops[j] <= begin or end <= starts[j]:
+                    continue
+                carried = 0.0
+                if cost < 0:
+                    value = cost
+                    if begin < starts[j]:
+                        carried = cost
+                else:
+                    clip_begin = max(begin, starts[j])
+                    value = self._linear(
+                        rtypes[n], cost, begin, clip_begin,
+                        max(min(end, period_stops[j]), clip_begin))
+                key = (j, ids[n])
+                try:
+                    group = groups[key]
+                except KeyError:
+                    group = groups[key] = [0.0, 0.0, begin, begin, None]
+                group[0] += value
+                group[1] += carried
+                group[2] = min(group[2], begin)
+                group[3] = max(group[3], begin)
+                if stops[n] is not None and (group[4] is None or
+                                             stops[n] > group[4]):
+                    group[4] = stops[n]
+        return [group_key + tuple(sums)
+                for group_key, sums in groups.iteritems()]
+
+    def _charge_numpy(self, ids, rtypes, costs, begins, ends, stops):
+        no_stop = numpy.iinfo(numpy.int64).min
+        starts = numpy.array(self.starts, dtype=numpy.int64)
+        period_stops = numpy.array(self.stops, dtype=numpy.int64)
+        ids = numpy.array(ids, dtype=numpy.int64)
+        costs = numpy.array(costs, dtype=numpy.float64)
+        begins = numpy.array(begins, dtype=numpy.int64)
+        ends = numpy.array(ends, dtype=numpy.int64)
+        stops = numpy.array([no_stop if stop is None else stop
+                             for stop in stops], dtype=numpy.int64)
+        changes = self.changes.items()
+        change_codes = dict(((rtype, code)
+                             for code, (rtype, change) in enumerate(changes)))
+        codes = numpy.array([change_codes.get(rtype, -1)
+                             for rtype in rtypes], dtype=numpy.int64)
+
+        # expand segments to pairs of a segment and a period
+        lo = numpy.searchsorted(
+            numpy.array(self.max_stops, dtype=numpy.int64), begins, "right")
+        hi = numpy.searchsorted(starts, ends, "left")
+        counts = numpy.maximum(hi - lo, 0)
+        rows = numpy.repeat(numpy.arange(len(counts)), counts)
+        offsets = numpy.cumsum(counts) - counts
+        j = lo[rows] + numpy.arange(len(rows)) - offsets[rows]
+        keep = (period_stops[j] > begins[rows]) & (ends[rows] > starts[j])
+        rows, j = rows[keep], j[keep]
+        if not len(rows):
+            return []
+
+        cost, begin = costs[rows], begins[rows]
+        fixed = cost < 0
+        clip_begin = numpy.maximum(begin, starts[j])
+        clip_end = numpy.maximum(numpy.minimum(ends[rows], period_stops[j]),
+                                 clip_begin)
+        end_seconds = (clip_end - begin) // MICROSECONDS
+        value = cost * (end_seconds - (clip_begin - begin) // MICROSECONDS) / \
+            utils.SECONDS_IN_YEAR
+        for code, (rtype, (change_begins, prev_scales, scales)) in \
+                enumerate(changes):
+            change_begins = numpy.array(change_begins, dtype=numpy.int64)
+            prev_scales = numpy.array(prev_scales + [0.0])
+            segments = numpy.nonzero((codes[rows] == code) & (cost > 0))[0]
+            i = numpy.searchsorted(change_begins, begin[segments], "right")
+            base = prev_scales[i]
+            segments, i, base = (segments[base != 0], i[base != 0],
+                                 base[base != 0])
+            for k in xrange(len(change_begins)):
+                selected = (i <= k) & (change_begins[k] < clip_end[segments])
+                pieces = segments[selected]
+                value[pieces] += (
+                    cost[pieces] *
+                    (end_seconds[pieces] -
+                     (numpy.maximum(change_begins[k], clip_begin[pieces]) -
+                      begin[pieces]) // MICROSECONDS) /
+                    utils.SECONDS_IN_YEAR *
+                    (scales[k] - prev_scales[k]) / base[selected])
+        value = numpy.where(fixed, cost, value)
+        carried = numpy.where(fixed & (begin < starts[j]), cost, 0.0)
+
+        # group-sum by periods and resources; bincount adds weights
+        # in the order of pairs like the loop does, so the sort
+        # that finds the groups need not be stable
+        resource_ids = ids[rows]
+        keys = j * (resource_ids.max() + 1) + resource_ids
+        by_key = numpy.argsort(keys)
+        sorted_keys = keys[by_key]
+        new_group = numpy.empty(len(keys), dtype=bool)
+        new_group[0] = True
+        numpy.not_equal(sorted_keys[1:], sorted_keys[:-1], new_group[1:])
+        bounds = numpy.nonzero(new_group)[0]
+        inverse = numpy.empty(len(keys), dtype=numpy.int64)
+        inverse[by_key] = numpy.cumsum(new_group) - 1
+        size = len(bounds)
+        cost_sums = numpy.bincount(inverse, weights=value, minlength=size)
+        carried_sums = numpy.bincount(inverse, weights=carried,
+                                      minlength=size)
+        firsts = by_key[bounds]
+        grouped_begins = begin[by_key]
+        min_starts = numpy.minimum.reduceat(grouped_begins, bounds)
+        max_starts = numpy.maximum.reduceat(grouped_begins, bounds)
+        max_stops = numpy.maximum.reduceat(stops[rows][by_key], bounds)
+        return [(period, resource_id, cost_sum, carried_sum,
+                 min_start, max_start,
+                 None if max_stop == no_stop else max_stop)
+                for period, resource_id, cost_sum, carried_sum,
+                    min_start, max_start, max_stop in zip(
+                        j[firsts].tolist(),
+                        resource_ids[firsts].tolist(),
+                        cost_sums.tolist(), carried_sums.tolist(),
+                        min_starts.tolist(), max_starts.tolist(),
+                        max_stops.tolist())]
@@ -42,6 +42,10 @@ class Account(db.Model, BillingBase):
     name = db.Column(db.String(255), nullable=False)
 
 
+# account_get_or_create
+db.Index("ix_account_name", Account.name)
+
+
 class Resource(db.Model, BillingBase):
     __tablename__ = "resource"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -50,11 +54,18 @@ class Resource(db.Model, BillingBase):
     account_id = db.Column(db.Integer, db.ForeignKey("account.id"), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey("resource.id"))
     attrs = db.Column(db.UnicodeText)
+    # the open segment, if any; not declared as a foreign key
+    # to avoid a dependency cycle between resource and segment
+    current_segment_id = db.Column(db.Integer)
     
     def get_attrs(self):
-        if self.attrs:
+        return self.parse_attrs(self.attrs)
+
+    @staticmethod
+    def parse_attrs(attrs):
+        if attrs:
             try:
-                return json.loads(self.attrs)
+                return json.loads(attrs)
             except:
                 return {}
         return {}
@@ -63,6 +74,13 @@ class Resource(db.Model, BillingBase):
         self.attrs = json.dumps(attrs)
 
 
+# resource_get_or_create
+db.Index("ix_resource_lookup", Resource.account_id, Resource.parent_id,
+         Resource.rtype, Resource.name)
+# resource_find
+db.Index("ix_resource_rtype_name", Resource.rtype, Resource.name)
+
+
 class Segment(db.Model, BillingBase):
     __tablename__ = "segment"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -76,7 +94,93 @@ class Segment(db.Model, BillingBase):
     end_at = db.Column(db.DateTime, nullable=True)
 
 
+# resource_segment_end
+db.Index("ix_segment_resource_end", Segment.resource_id, Segment.end_at)
+# bill_query: covers the period filter and the clipped columns
+db.Index("ix_segment_period", Segment.end_at, Segment.begin_at,
+         Segment.resource_id, Segment.cost)
+
+
 class Tariff(db.Model, BillingBase):
     __tablename__ = "tariff"
     rtype = db.Column(db.String(TypeLength), nullable=False, primary_key=True)
     multiplier = db.Column(db.Float, nullable=False)
+
+
+class TariffChange(db.Model, BillingBase):
+    """
+    A tariff set for ``rtype`` at ``begin_at``.
+
+    ``scale`` is the product of ratios of all migrated tariff changes
+    of ``rtype`` till this one, ``prev_scale`` is the product before it.
+    A segment begun before the change is charged ``scale / base``
+    times its cost after ``begin_at``, where ``base`` is ``prev_scale``
+    of the first change after the segment beginning. Changes made
+    without migration keep ``scale`` equal to ``prev_scale``.
+    """
+    __tablename__ = "tariff_change"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    rtype = db.Column(db.String(TypeLength), nullable=False)
+    begin_at = db.Column(db.DateTime, nullable=False)
+    multiplier = db.Column(db.Float, nullable=False)
+    prev_scale = db.Column(db.Float, nullable=False)
+    scale = db.Column(db.Float, nullable=False)
+
+
+# bill_query: changes after a segment beginning
+db.Index("ix_tariff_change_rtype", TariffChange.rtype, TariffChange.begin_at)
+
+
+class RollupMonth(db.Model, BillingBase):
+    """
+    A closed calendar month whose bill is materialized in ``bill_rollup``.
+    """
+    __tablename__ = "rollup_month"
+    month = db.Column(db.DateTime, primary_key=True)
+
+
+class BillRollup(db.Model, BillingBase):
+    """
+    Bill of a resource on a closed calendar month.
+    """
+    __tablename__ = "bill_rollup"
+    month = db.Column(db.DateTime, primary_key=True)
+    resource_id = db.Column(db.Integer, db.ForeignKey("resource.id"),
+                            primary_key=True)
+    cost = db.Column(db.Float, nullable=False)
+    # fixed cost of segments started before the month; it is already
+    # charged by the previous month when months are summed up
+    carried_fixed = db.Column(db.Float, nullable=False)
+    min_start = db.Column(db.DateTime, nullable=False)
+    max_start = db.Column(db.DateTime, nullable=False)
+    max_stop = db.Column(db.DateTime, nullable=True)
+
+
+class CounterMonth(db.Model, BillingBase):
+    """
+    A month whose month-to-date counters are updated on events.
+    Counters are used after they are ``seeded``.
+    """
+    __tablename__ = "counter_month"
+    month = db.Column(db.DateTime, primary_key=True)
+    seeded = db.Column(db.Boolean, nullable=False, default=False)
+
+
+class MonthCounter(db.Model, BillingBase):
+    """
+    Cost of closed segments of a resource within a month.
+    """
+    __tablename__ = "month_counter"
+    month = db.Column(db.DateTime, primary_key=True)
+    resource_id = db.Column(db.Integer, db.ForeignKey("resource.id"),
+                            primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey("account.id"),
+                           nullable=False)
+    cost = db.Column(db.Float, nullable=False)
+    min_start = db.Column(db.DateTime, nullable=False)
+    max_start = db.Column(db.DateTime, nullable=False)
+    max_stop = db.Column(db.DateTime, nullable=True)
+
+
+# month-to-date bill of an account
+db.Index("ix_month_counter_account", MonthCounter.month, MonthCounter.account_id)
@@ -0,0 +1,254 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Columnar dump of the Heart database.
+
+A dump starts with ``MAGIC`` and contains blocks of up to
+``block_size`` rows of a table. A block is a table name, a number
+of rows, and columns; every column is a name, a kind, and
+zlib-compressed data. All numbers are little-endian.
+
+Column data begin with a byte per row that is 1 for NULL values.
+Then follow:
+
+* ``i`` - 64-bit integers, delta-encoded;
+* ``t`` - timestamps as 64-bit microseconds since the epoch,
+  delta-encoded;
+* ``f`` - 64-bit floats;
+* ``s`` - 32-bit lengths and UTF-8 strings;
+* ``e`` - a dictionary of strings (32-bit count, 32-bit lengths,
+  UTF-8 strings) and 32-bit codes; used for ``rtype`` columns.
+
+Rollups and counters are not dumped: they are rebuilt on demand.
+"""
+
+import sys
+import zlib
+import struct
+from array import array
+
+from sqlalchemy import DateTime, Float, Integer
+from sqlalchemy.sql.expression import select
+
+from nova_billing.utils import datetime_to_epoch, epoch_to_datetime
+from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database.models import Account, Resource, Segment, \
+     Tariff, TariffChange
+
+
+MAGIC = "NBD\x01"
+
+models = (Account, Resource, Segment, Tariff, TariffChange)
+
+# array of Python 2 has no "q" type code, but "l" is 64-bit on LP64
+INT64 = "l" if array("l").itemsize == 8 else "q"
+
+
+class DumpError(Exception):
+    pass
+
+
+def column_kind(column):
+    if column.name == "rtype":
+        return "e"
+    if isinstance(column.type, Integer):
+        return "i"
+    if isinstance(column.type, DateTime):
+        return "t"
+    if isinstance(column.type, Float):
+        return "f"
+    return "s"
+
+
+def to_bytes(arr):
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tostring()
+
+
+def from_bytes(typecode, data):
+    arr = array(typecode)
+    arr.fromstring(data)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+def encode_strings(values):
+    values = [value if isinstance(value, str)
+              else unicode(value).encode("utf-8")
+              for value in values]
+    return to_bytes(array("i", (len(value) for value in values))) + \
+        "".join(values)
+
+
+def decode_strings(count, data, offset):
+    lengths = from_bytes("i", data[offset:offset + 4 * count])
+    offset += 4 * count
+    values = []
+    for length in lengths:
+        values.append(data[offset:offset + length].decode("utf-8"))
+        offset += length
+    return values, offset
+
+
+def encode_column(kind, values):
+    nulls = array("B", (value is None for value in values))
+    parts = [to_bytes(nulls)]
+    if kind == "e":
+        codes = {}
+        for value in values:
+            if value is not None and value not in codes:
+                codes[value] = len(codes)
+        names = sorted(codes, key=codes.get)
+        parts.append(to_bytes(array("i", [len(names)])))
+        parts.append(encode_strings(names))
+        parts.append(to_bytes(array(
+            "i", (codes.get(value, 0) for value in values))))
+    elif kind == "s":
+        parts.append(encode_strings([value or "" for value in values]))
+    elif kind == "f":
+        parts.append(to_bytes(array(
+            "d", (value or 0.0 for value in values))))
+    else:
+        if kind == "t":
+            values = [datetime_to_epoch(value) if value is not None else 0
+                      for value in values]
+        deltas = array(INT64)
+        prev = 0
+        for value in values:
+            value = value or 0
+            deltas.append(value - prev)
+            prev = value
+        parts.append(to_bytes(deltas))
+    return zlib.compress("".join(parts))
+
+
+def decode_column(kind, count, data):
+    data = zlib.decompress(data)
+    nulls = from_bytes("B", data[:count])
+    offset = count
+    if kind == "e":
+        names_count = from_bytes("i", data[offset:offset + 4])[0]
+        names, offset = decode_strings(names_count, data, offset + 4)
+        values = [names[code] if names else None
+                  for code in from_bytes("i", data[offset:])]
+    elif kind == "s":
+        values, offset = decode_strings(count, data, offset)
+    elif kind == "f":
+        values = from_bytes("d", data[offset:]).tolist()
+    else:
+        values = []
+        value = 0
+        for delta in from_bytes(INT64, data[offset:]):
+            value += delta
+            values.append(value)
+        if kind == "t":
+            values = map(epoch_to_datetime, values)
+    return [None if null else item for null, item in zip(nulls, values)]
+
+
+def write_string(fileobj, value):
+    fileobj.write(struct.pack("<H", len(value)))
+    fileobj.write(value)
+
+
+def read(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise DumpError("unexpected end of dump")
+    return data
+
+
+def read_string(fileobj):
+    return read(fileobj, struct.unpack("<H", read(fileobj, 2))[0])
+
+
+def export(fileobj, block_size=65536):
+    """
+    Write all dumped tables to ``fileobj``.
+    Returns a dict of numbers of rows by table names.
+    """
+    fileobj.write(MAGIC)
+    counts = {}
+    for model in models:
+        table = model.__table__
+        columns = list(table.columns)
+        kinds = [column_kind(column) for column in columns]
+        counts[table.name] = 0
+        # ordered by the primary key, so parent resources go first
+        # and the delta-encoded ids compress well
+        result = db.session.execute(
+            select(columns).order_by(*table.primary_key.columns))
+        while True:
+            rows = result.fetchmany(block_size)
+            if not rows:
+                break
+            write_string(fileobj, table.name)
+            fileobj.write(struct.pack("<IH", len(rows), len(columns)))
+            for i, column in enumerate(columns):
+                data = encode_column(kinds[i], [row[i] for row in rows])
+                write_string(fileobj, column.name)
+                fileobj.write(struct.pack("<cI", kinds[i], len(data)))
+                fileobj.write(data)
+            counts[table.name] += len(rows)
+    write_string(fileobj, "")
+    return counts
+
+
+def load(fileobj):
+    """
+    Insert rows from ``fileobj`` into empty tables. Every block
+    is inserted with one multi-row insert. Columns that are missing
+    in the current schema are skipped.
+    Returns a dict of numbers of rows by table names.
+    """
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        raise DumpError("not a Nova Billing dump")
+    tables = dict(((model.__table__.name, model.__table__)
+                   for model in models))
+    for table in tables.itervalues():
+        if db.session.execute(select([table]).limit(1)).first():
+            raise DumpError("table %s is not empty" % table.name)
+    counts = {}
+    while True:
+        name = read_string(fileobj)
+        if not name:
+            break
+        try:
+            table = tables[name]
+        except KeyError:
+            raise DumpError("unknown table %s" % name)
+        count, column_count = struct.unpack("<IH", read(fileobj, 6))
+        rows = [{} for i in xrange(count)]
+        for i in xrange(column_count):
+            column = read_string(fileobj)
+            kind, size = struct.unpack("<cI", read(fileobj, 5))
+            data = read(fileobj, size)
+            if column not in table.columns:
+                continue
+            for row, value in zip(rows, decode_column(kind, count, data)):
+                row[column] = value
+        db.session.execute(table.insert(), rows)
+        counts[name] = counts.get(name, 0) + count
+    db_api.rollup_invalidate()
+    db_api.counter_invalidate()
+    db_api.commit()
+    return counts
@@ -19,10 +19,14 @@
 
 """Starter script for Nova Billing heart."""
 
+import eventlet
+eventlet.monkey_patch()
+
 import argparse
 
 from nova_billing.heart.database import db
 from nova_billing.heart import app
+from nova_billing.heart.server import Server
 from nova_billing.utils import global_conf
 
 
@@ -32,18 +36,28 @@ def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument("--reload", "-r", default=False,
                             action="store_true",
-                            help="reload when the source changes")
+                            help="run the development server and "
+                            "reload when the source changes")
+    arg_parser.add_argument("--debug", "-d", default=False,
+                            action="store_true",
+                            help="run the development server in debug mode")
     arg_parser.add_argument("host:port", nargs="?",
-                            default="%s:%s" % (
-                                global_conf.host,
-                                global_conf.port),
+                            default=None,
                             help="host:port")
     args = arg_parser.parse_args()
 
     db.create_all()
-    listen = getattr(args, "host:port").split(':')
-    app.debug = True
-    app.run(host=listen[0], port=int(listen[1]), use_reloader=args.reload)
+    listen = getattr(args, "host:port")
+    if listen:
+        listen = listen.split(':')
+        listen = (listen[0], int(listen[1]))
+    if args.reload or args.debug:
+        if not listen:
+            listen = (global_conf.host, int(global_conf.port))
+        app.debug = True
+        app.run(host=listen[0], port=listen[1], use_reloader=args.reload)
+    else:
+        Server(app, listen).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Administration script for Nova Billing heart database."""
+
+import sys
+import argparse
+import datetime
+
+from sqlalchemy.engine import reflection
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from nova_billing.heart import dump
+from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database.models import Resource
+from nova_billing.utils import global_conf
+
+
+class explain(Executable, ClauseElement):
+    """
+    Query plan of a statement.
+    """
+    _returning = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(explain)
+def _default_explain(element, compiler, **kw):
+    return "EXPLAIN %s" % compiler.process(element.statement)
+
+
+@compiles(explain, "sqlite")
+def _sqlite_explain(element, compiler, **kw):
+    return "EXPLAIN QUERY PLAN %s" % compiler.process(element.statement)
+
+
+def core_queries():
+    """
+    Return a list of (title, statement) for queries of the hot paths.
+    """
+    period_start = datetime.datetime(2012, 1, 1)
+    period_stop = datetime.datetime(2012, 2, 1)
+    return [
+        ("account_get_or_create",
+         db_api.account_query("1").statement),
+        ("resource_get_or_create",
+         db_api.resource_query(1, 1, "memory_mb", None).statement),
+        ("resource_find",
+         db_api.resource_find_query("nova/instance", "1").statement),
+        ("resource_segment_end",
+         db_api.segment_end_statement(1, period_start)),
+        ("bill (all accounts)",
+         db_api.bill_query(period_start, period_stop).statement),
+        ("bill (one account)",
+         db_api.bill_query(period_start, period_stop, 1).statement),
+    ]
+
+
+def cmd_explain(args):
+    for title, statement in core_queries():
+        print "== %s" % title
+        try:
+            for row in db.engine.execute(explain(statement)):
+                print "  %s" % " | ".join((str(value) for value in row))
+        except Exception, ex:
+            print "  cannot explain: %s" % ex
+        print
+
+
+def cmd_create_indexes(args):
+    """
+    Create indexes missing in an existing database.
+    ``db.create_all`` creates indexes only together with their tables.
+    """
+    db.create_all()
+    inspector = reflection.Inspector.from_engine(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set((index["name"]
+                        for index in inspector.get_indexes(table.name)))
+        for index in table.indexes:
+            if index.name not in existing:
+                print "creating %s" % index.name
+                index.create(db.engine)
+
+
+def cmd_upgrade(args):
+    """
+    Bring an existing database to the current schema:
+    create missing tables, columns, and indexes.
+    """
+    db.create_all()
+    inspector = reflection.Inspector.from_engine(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set((column["name"]
+                        for column in inspector.get_columns(table.name)))
+        for column in table.columns:
+            if column.name not in existing:
+                print "adding %s.%s" % (table.name, column.name)
+                db.engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    table.name, column.name,
+                    column.type.compile(dialect=db.engine.dialect)))
+                if column is Resource.__table__.c.current_segment_id:
+                    db_api.resource_current_segment_sync()
+                    db.session.commit()
+    cmd_create_indexes(args)
+
+
+def cmd_export(args):
+    with open(args.file, "wb") as dump_file:
+        counts = dump.export(dump_file)
+    for name, count in sorted(counts.iteritems()):
+        print "%s: %s rows" % (name, count)
+
+
+def cmd_import(args):
+    db.create_all()
+    with open(args.file, "rb") as dump_file:
+        try:
+            counts = dump.load(dump_file)
+        except dump.DumpError, ex:
+            print >>sys.stderr, "cannot import %s: %s" % (args.file, ex)
+            sys.exit(1)
+    for name, count in sorted(counts.iteritems()):
+        print "%s: %s rows" % (name, count)
+
+
+def main():
+    global_conf.logging()
+
+    arg_parser = argparse.ArgumentParser()
+    subparsers = arg_parser.add_subparsers()
+    subparsers.add_parser(
+        "explain",
+        help="print query plans for the core queries").set_defaults(
+            func=cmd_explain)
+    subparsers.add_parser(
+        "upgrade",
+        help="create missing tables, columns, and indexes").set_defaults(
+            func=cmd_upgrade)
+    subparsers.add_parser(
+        "create-indexes",
+        help="create missing indexes").set_defaults(
+            func=cmd_create_indexes)
+    subparser = subparsers.add_parser(
+        "export",
+        help="write accounts, resources, segments, and tariffs"
+        " to a compressed columnar file")
+    subparser.add_argument("file")
+    subparser.set_defaults(func=cmd_export)
+    subparser = subparsers.add_parser(
+        "import",
+        help="load a file written by export into an empty database")
+    subparser.add_argument("file")
+    subparser.set_defaults(func=cmd_import)
+    args = arg_parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -21,7 +21,10 @@ REST API for Nova Billing Heart
 """
 
 import json
+import logging
 import datetime
+import operator
+import itertools
 
 from flask import Flask, request, session, redirect, url_for, \
      jsonify, Response
@@ -30,12 +33,21 @@ from . import app
 
 from .database import api as db_api
 from .database import db
-from .database.models import Account, Resource, Segment, Tariff
+from .database.models import Account, Resource
 
 from nova_billing import utils
 from nova_billing.version import version_string
 
 
+LOG = logging.getLogger(__name__)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# the maximum number of buckets in a usage report
+# and of periods in a multi-period bill
+MAX_BUCKETS = 10000
+
+
 def request_json():
     ret = request.json
     if ret == None:
@@ -50,6 +62,39 @@ def to_json(resp):
             mimetype=utils.ContentType.JSON)
 
 
+def to_json_stream(items, head=None, key=None):
+    """
+    Stream a JSON array of ``items`` as the value of ``key``
+    in the ``head`` object or as the whole response
+    if ``head`` is not given. Items are serialized one by one
+    and sent in chunks of about ``STREAM_CHUNK_SIZE`` bytes.
+    """
+    def generate():
+        if head is None:
+            chunk = ["["]
+        else:
+            prefix = json.dumps(head, default=utils.datetime_to_str)[:-1]
+            if head:
+                prefix += ", "
+            chunk = [prefix, json.dumps(key), ": ["]
+        size = 0
+        separator = ""
+        for item in items:
+            data = json.dumps(item, default=utils.datetime_to_str)
+            chunk.append(separator)
+            chunk.append(data)
+            separator = ", "
+            size += len(data)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        chunk.append("]" if head is None else "]}")
+        yield "".join(chunk)
+
+    return Response(generate(), mimetype=utils.ContentType.JSON)
+
+
 def check_attrs(rj, attr_list):
     for attr in attr_list:
         if attr not in rj:
@@ -57,6 +102,77 @@ def check_attrs(rj, attr_list):
                 description="%s must be specified" % attr)
 
 
+def get_page():
+    """
+    Parse keyset pagination arguments: ``limit`` is the maximum number
+    of items and ``after_id`` is the id of the last item of the previous
+    page. Items are ordered by id.
+    """
+    ret = []
+    for arg in "limit", "after_id":
+        value = request.args.get(arg, None)
+        if value is not None:
+            try:
+                value = int(value)
+            except ValueError:
+                raise BadRequest(description="%s must be an integer" % arg)
+        ret.append(value)
+    if ret[0] is not None and ret[0] <= 0:
+        raise BadRequest(description="limit must be positive")
+    return ret
+
+
+def get_fields(allowed):
+    """
+    Parse ``fields`` argument: a comma-separated list of attributes
+    to return. ``None`` means all attributes.
+    """
+    try:
+        fields = request.args["fields"]
+    except KeyError:
+        return None
+    fields = [field for field in fields.split(",") if field]
+    for field in fields:
+        if field not in allowed:
+            raise BadRequest(description="unknown field `%s'" % field)
+    return fields
+
+
+def project(obj, fields):
+    if fields is None:
+        return obj
+    return dict(((field, obj[field]) for field in fields))
+
+
+def check_event_resource(rsrc):
+    """
+    Check types of costs, attributes, and children of the event
+    resource ``rsrc`` and its children.
+    """
+    if not isinstance(rsrc, dict):
+        raise BadRequest(description="event must be an object")
+    for attr in "linear", "fixed":
+        if attr not in rsrc:
+            continue
+        value = rsrc[attr]
+        if value is None and attr == "fixed":
+            continue
+        if (isinstance(value, bool) or
+                not isinstance(value, (int, long, float))):
+            raise BadRequest(description="%s must be a number" % attr)
+    for attr, attr_type, type_name in (
+            ("rtype", basestring, "a string"),
+            ("name", (basestring, int, long, type(None)),
+             "a string or a number"),
+            ("attrs", dict, "an object"),
+            ("children", list, "an array")):
+        if attr in rsrc and not isinstance(rsrc[attr], attr_type):
+            raise BadRequest(
+                description="%s must be %s" % (attr, type_name))
+    for child in rsrc.get("children", ()):
+        check_event_resource(child)
+
+
 def check_and_get_datatime(rj):
     ret = utils.str_to_datetime(rj.get("datetime", None))
     if not ret:
@@ -77,7 +193,7 @@ def get_version():
                      request.environ["SERVER_PORT"],
                      url),
                 "rel": "self",
-            } for url in "bill", "resource", "account", "tariff" ],
+            } for url in "bill", "usage", "resource", "account", "tariff" ],
         ],
     }
 
@@ -104,16 +220,24 @@ def get_period():
             date_args = (now.year, now.month, 1)
             date_incr = 1
     else:
-        time_period_splitted = request.args["time_period"].split("-", 2)
-        date_args = [1, 1, 1]
-        for i in xrange(min(2, len(time_period_splitted))):
-            try:
-                date_args[i] = int(time_period_splitted[i])
-            except ValueError:
-                raise BadRequest(
-                    description="invalid time_period `%s'" % request.args["time_period"])
-        date_incr = len(time_period_splitted) - 1
+        return parse_time_period(request.args["time_period"])
+    return period_bounds(date_args, date_incr)
+
 
+def parse_time_period(time_period):
+    time_period_splitted = time_period.split("-", 2)
+    date_args = [1, 1, 1]
+    for i in xrange(min(2, len(time_period_splitted))):
+        try:
+            date_args[i] = int(time_period_splitted[i])
+        except ValueError:
+            raise BadRequest(
+                description="invalid time_period `%s'" % time_period)
+    date_incr = len(time_period_splitted) - 1
+    return period_bounds(date_args, date_incr)
+
+
+def period_bounds(date_args, date_incr):
     period_start = datetime.datetime(*date_args)
     if date_incr == 2:
         period_end = period_start + datetime.timedelta(days=1)
@@ -130,29 +254,147 @@ def get_period():
     return period_start, period_end
 
 
-@app.route("/bill")
-def get_bill():
+def get_account_id():
+    """
+    Return id of the account named by ``account`` argument
+    or ``None`` if it is not given.
+    """
     account_name = request.args.get("account", None)
-    if account_name:
-        account = Account.query.filter_by(name=account_name).first()
-        if account == None:
-            raise NotFound()
-        account_id = account.id
+    if not account_name:
+        return None
+    account = Account.query.filter_by(name=account_name).first()
+    if account == None:
+        raise NotFound()
+    return account.id
+
+
+def get_periods():
+    """
+    Return a list of periods of a multi-period bill: several
+    ``time_period`` values or a period split into ``step`` periods.
+    ``None`` means a single period.
+    """
+    time_periods = request.args.getlist("time_period")
+    if len(time_periods) > 1:
+        periods = [parse_time_period(time_period)
+                   for time_period in time_periods]
+    elif "step" in request.args:
+        period_start, period_end = get_period()
+        try:
+            edges = utils.time_buckets(
+                period_start, period_end, request.args["step"])
+        except ValueError, ex:
+            raise BadRequest(description=str(ex))
+        periods = zip(edges[:-1], edges[1:])
     else:
-        account_id = None
+        return None
+    if len(periods) > MAX_BUCKETS:
+        raise BadRequest(description="too many periods; use a longer step")
+    return periods
+
+
+@app.route("/bill")
+def get_bill():
+    account_id = get_account_id()
+
+    periods = get_periods()
+    limit, after_id = get_page()
+    fields = get_fields(bill_resource_fields)
+    if periods is not None:
+        return get_bills(periods, account_id, limit, after_id, fields)
+
+    period_start, period_end = get_period()
+    ans_dict = {
+        "period_start": period_start,
+        "period_end": period_end,
+    }
+    account_range = None
+    if limit is not None or after_id is not None:
+        account_range = db_api.account_page(after_id, limit)
+        if account_range is None:
+            return to_json_stream((), ans_dict, "bill")
+    rows = db_api.stream_rows(db_api.bill_rows(
+        period_start, period_end, account_id, account_range))
+    return to_json_stream(
+        bill_accounts(rows, db_api.account_map(), fields), ans_dict, "bill")
+
+
+def get_bills(periods, account_id, limit, after_id, fields):
+    """
+    Bill several periods with a single scan of segments.
+    """
+    account_range = None
+    bills = None
+    if limit is not None or after_id is not None:
+        account_range = db_api.account_page(after_id, limit)
+        if account_range is None:
+            bills = [{} for period in periods]
+    if bills is None:
+        bills = db_api.bill_on_periods(
+            periods, account_id, account_range=account_range)
+    accounts = db_api.account_map()
+    return to_json({"bills": [{
+        "period_start": period_start,
+        "period_end": period_end,
+        "bill": [{
+            "id": key,
+            "name": accounts.get(key, None),
+            "resources": [project(rsrc, fields) for rsrc in value],
+        } for key, value in sorted(bill.iteritems())],
+    } for (period_start, period_end), bill in zip(periods, bills)]})
+
+
+bill_resource_fields = ("id", "name", "rtype", "parent_id", "cost",
+                        "created_at", "destroyed_at")
+
+
+def bill_accounts(rows, accounts, fields=None):
+    """
+    Group bill rows ordered by account into account bills.
+    Resource reports are projected to ``fields``.
+    """
+    for account_id, account_rows in itertools.groupby(
+            rows, operator.attrgetter("account_id")):
+        if account_id not in accounts:
+            # the account was created by another process
+            accounts.update(db_api.account_names([account_id]))
+        yield {
+            "id": account_id,
+            "name": accounts.get(account_id, None),
+            "resources": [project(db_api.bill_row_to_dict(row), fields)
+                          for row in account_rows],
+        }
+
+
+@app.route("/usage")
+def get_usage():
+    account_id = get_account_id()
 
     period_start, period_end = get_period()
-    total_statistics = db_api.bill_on_interval(
-        period_start, period_end, account_id)
+    granularity = request.args.get("granularity", "day")
+    try:
+        edges = utils.time_buckets(period_start, period_end, granularity)
+    except ValueError, ex:
+        raise BadRequest(description=str(ex))
+    if len(edges) - 1 > MAX_BUCKETS:
+        raise BadRequest(
+            description="too many buckets; use a coarser granularity")
+    edges, series = db_api.usage_on_interval(
+        period_start, period_end, granularity, account_id)
 
     accounts = db_api.account_map()
     ans_dict = {
         "period_start": period_start,
         "period_end": period_end,
-        "bill": [{
-            "id": key, "name": accounts.get(key, None), 
-            "resources": value
-        } for key, value in total_statistics.iteritems()],
+        "granularity": granularity,
+        "buckets": edges[:-1],
+        "usage": [{
+            "account_id": key[0],
+            "account": accounts.get(key[0], None),
+            "rtype": key[1],
+            "cost": value["cost"],
+            "seconds": value["seconds"],
+        } for key, value in sorted(series.iteritems())],
     }
     return to_json(ans_dict)
 
@@ -189,13 +431,12 @@ def process_event(rsrc, parent_id, account_id, event_datetime, tariffs):
         cost = None
         close_segment = False
     if close_segment:
-        db_api.resource_segment_end(rsrc_id, event_datetime)
+        db_api.resource_segment_end(rsrc_obj, event_datetime)
     if cost is not None:
-        obj = Segment(
-            resource_id=rsrc_id,
-            cost=-cost * tariffs.get(rsrc["rtype"], 1),
-            begin_at=event_datetime)
-        db.session.add(obj)
+        db_api.resource_segment_begin(
+            rsrc_obj,
+            -cost * tariffs.multiplier(rsrc["rtype"], event_datetime),
+            event_datetime)
 
     for child in rsrc.get("children", ()):
         process_event(child, rsrc_id,
@@ -223,11 +464,12 @@ def process_resource(rsrc, parent_id, account_id):
         process_resource(child, rsrc_id, account_id)
 
 
-@app.route("/event", methods=["POST"])
-def post_event():
-    rj = request_json()
-    check_attrs(rj, ("rtype", ))
-    rj_datetime = check_and_get_datatime(rj)
+def get_event_account(rj):
+    """
+    Find account of the event ``rj``.
+
+    :returns: a tuple of account name and account id.
+    """
     try:
         account_name = rj["account"]
     except KeyError:
@@ -239,15 +481,80 @@ def post_event():
     else:
         account = db_api.account_get_or_create(account_name)
         account_id = account.id
+    return account_name, account_id
 
-    tariffs = db_api.tariff_map()
+
+def event_result(rj, rj_datetime, account_name):
+    return {"account": account_name,
+            "rtype": rj["rtype"],
+            "datetime": rj_datetime,
+            "name": rj.get("name", None)}
+
+
+@app.route("/event", methods=["POST"])
+def post_event():
+    rj = request_json()
+    check_event_resource(rj)
+    check_attrs(rj, ("rtype", ))
+    rj_datetime = check_and_get_datatime(rj)
+    account_name, account_id = get_event_account(rj)
+
+    tariffs = db_api.tariff_schedule()
     process_event(rj, None,  account_id, rj_datetime, tariffs)
+    db_api.rollup_invalidate(rj_datetime)
 
-    db.session.commit()
-    return to_json({"account": account_name,
-                    "rtype": rj["rtype"],
-                    "datetime": rj_datetime,
-                    "name": rj.get("name", None)})
+    db_api.commit()
+    return to_json(event_result(rj, rj_datetime, account_name))
+
+
+@app.route("/events", methods=["POST"])
+def post_events():
+    """
+    Process an array of events in one transaction.
+    Events are applied in the order of their datetimes, each one
+    in its own savepoint, so a failing event does not roll back others.
+    Returns an array of results in the order of the request;
+    a result has ``status`` equal to 200, 400, or 500 and an ``error``
+    description for rejected events.
+    """
+    rj = request_json()
+    if not isinstance(rj, list):
+        raise BadRequest(description="array of events must be specified")
+
+    results = [None] * len(rj)
+    events = []
+    for i, event in enumerate(rj):
+        try:
+            check_event_resource(event)
+            check_attrs(event, ("rtype", ))
+            events.append((check_and_get_datatime(event), i, event))
+        except BadRequest, ex:
+            results[i] = {"status": ex.code, "error": ex.description}
+    events.sort()
+
+    tariffs = db_api.tariff_schedule()
+    for rj_datetime, i, event in events:
+        db_api.begin_nested()
+        try:
+            account_name, account_id = get_event_account(event)
+            process_event(event, None, account_id, rj_datetime, tariffs)
+        except BadRequest, ex:
+            db_api.rollback_nested()
+            results[i] = {"status": ex.code, "error": ex.description}
+            continue
+        except Exception, ex:
+            db_api.rollback_nested()
+            LOG.exception("cannot store event %s", json.dumps(event))
+            results[i] = {"status": 500, "error": "cannot store event"}
+            continue
+        db_api.commit_nested()
+        results[i] = event_result(event, rj_datetime, account_name)
+        results[i]["status"] = 200
+    if events:
+        db_api.rollup_invalidate(events[0][0])
+
+    db_api.commit()
+    return to_json(results)
 
 
 @app.route("/tariff", methods=["GET"])
@@ -263,48 +570,61 @@ def change_tariff():
     rj_datetime = check_and_get_datatime(rj)
     migrate = rj.get("migrate", False)
 
-    if migrate:
-        old_tariffs = db_api.tariff_map()
     new_tariffs = rj["values"]
-    for key, value in new_tariffs.iteritems():
-        if isinstance(value, int) or isinstance(value, float):
-            db.session.merge(Tariff(rtype=key, multiplier=value))
-
+    try:
+        db_api.tariffs_change(new_tariffs, rj_datetime, migrate)
+    except ValueError, ex:
+        raise BadRequest(description=str(ex))
     if migrate:
-        db_api.tariffs_migrate(
-            old_tariffs,
-            new_tariffs,
-            rj_datetime)
+        db_api.rollup_invalidate(rj_datetime)
+        db_api.counter_invalidate(rj_datetime)
 
-    db.session.commit()
+    db_api.commit()
 
     return to_json(new_tariffs)
 
 
+@app.route("/cache", methods=["GET"])
+def get_cache():
+    return to_json(db_api.cache_stats())
+
+
 @app.route("/account", methods=["GET"])
 def get_account():
+    limit, after_id = get_page()
+    fields = get_fields(("id", "name"))
     return to_json([
-        {"id": key, "name": value}
-        for key, value in db_api.account_map().iteritems()])
+        project({"id": key, "name": value}, fields)
+        for key, value in db_api.account_list(after_id, limit)])
+
+
+resource_fields = ("id", "name", "rtype", "account_id", "parent_id", "attrs")
 
 
 @app.route("/resource", methods=["GET"])
 def get_resource():
+    limit, after_id = get_page()
+    fields = get_fields(resource_fields) or resource_fields
     res = Resource.query
     filter = dict(((fld, request.args[fld]) 
         for fld in ("account_id", "name", "id", "rtype", "parent_id")
         if fld in request.args))
     if filter:
         res = res.filter_by(**filter)
-    return to_json([
-        {"id": obj.id,
-         "name": obj.name,
-         "rtype": obj.rtype,
-         "account_id": obj.account_id,
-         "parent_id": obj.parent_id,
-         "attrs": obj.get_attrs(),
-        } for obj in res.all()
-    ])
+    if after_id is not None:
+        res = res.filter(Resource.id > after_id)
+    res = res.order_by(Resource.id)
+    if limit is not None:
+        res = res.limit(limit)
+    # attrs are neither read nor decoded unless requested
+    res = res.with_entities(*[getattr(Resource, field) for field in fields])
+    return to_json_stream((
+        dict(((field,
+               Resource.parse_attrs(obj.attrs) if field == "attrs"
+               else getattr(obj, field))
+              for field in fields))
+        for obj in db_api.stream_rows(res)
+    ))
 
 
 @app.route("/resource", methods=["POST"])
@@ -325,7 +645,7 @@ def post_resource():
 
     process_resource(rj, None,  account_id)
 
-    db.session.commit()
+    db_api.commit()
     return to_json({"account": account_name,
                     "rtype": rj["rtype"],
                     "name": rj.get("name", None)})
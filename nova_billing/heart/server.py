@@ -0,0 +1,252 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Production WSGI server for Nova Billing Heart.
+
+The master process binds the listening socket and keeps
+``heart_workers`` worker processes. Every worker serves requests
+with a pool of ``heart_pool_size`` green threads. SIGHUP reloads
+the settings and replaces workers gracefully: new workers are started
+and old ones finish their requests before exiting. SIGTERM and SIGINT
+stop the server the same way.
+"""
+
+import os
+import sys
+import errno
+import signal
+import logging
+
+import eventlet
+import eventlet.hubs
+import eventlet.wsgi
+from eventlet import patcher
+
+from nova_billing.heart.database import db
+from nova_billing.utils import global_conf
+
+
+LOG = logging.getLogger(__name__)
+
+_time = patcher.original("time")
+
+
+class TimeoutMiddleware(object):
+    """
+    Answer 503 Service Unavailable to requests that are not
+    handled in ``timeout`` seconds. A request can be interrupted only
+    when its green thread yields (for example, on database I/O).
+    """
+    def __init__(self, app, timeout):
+        self.app = app
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        if not self.timeout:
+            return self.app(environ, start_response)
+        timeout = eventlet.Timeout(self.timeout)
+        try:
+            return self.app(environ, start_response)
+        except eventlet.Timeout, ex:
+            if ex is not timeout:
+                raise
+            LOG.error("%s %s timed out after %s seconds" %
+                      (environ.get("REQUEST_METHOD"),
+                       environ.get("PATH_INFO"),
+                       self.timeout))
+            start_response("503 Service Unavailable",
+                           [("Content-Type", "text/plain")],
+                           sys.exc_info())
+            return ["request timed out\n"]
+        finally:
+            timeout.cancel()
+
+
+class WritableLogger(object):
+    """
+    File-like object writing eventlet.wsgi log to ``logger``.
+    """
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def write(self, msg):
+        self.logger.log(self.level, msg.rstrip("\n"))
+
+
+class Server(object):
+    """
+    Prefork WSGI server of ``app``. Listens on ``listen`` (a tuple
+    of host and port) or on ``host`` and ``port`` from the settings.
+    """
+    def __init__(self, app, listen=None):
+        self.app = app
+        self.listen = listen
+        self.sock = None
+        self.sock_address = None
+        # pid => the time it was asked to stop or None
+        self.workers = {}
+        self.stopping = False
+        self.reloading = False
+
+    def bind(self):
+        address = self.listen or (global_conf.host, int(global_conf.port))
+        if self.sock is not None and address == self.sock_address:
+            return
+        sock = eventlet.listen(address, backlog=global_conf.heart_backlog)
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = sock
+        self.sock_address = address
+        LOG.info("listening on %s:%s" % address)
+
+    def serve(self):
+        """
+        Serve requests in the current process till SIGTERM or SIGINT.
+        """
+        # wake up a green thread on a signal instead of raising
+        # an exception in an arbitrary request
+        rfd, wfd = os.pipe()
+        for signum in signal.SIGTERM, signal.SIGINT:
+            signal.signal(signum, lambda signum, frame: os.write(wfd, "."))
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = eventlet.spawn(
+            eventlet.wsgi.server,
+            self.sock,
+            TimeoutMiddleware(self.app, global_conf.heart_request_timeout),
+            log=WritableLogger(LOG),
+            custom_pool=eventlet.GreenPool(global_conf.heart_pool_size),
+            keepalive=global_conf.heart_keepalive,
+            socket_timeout=global_conf.heart_client_timeout or None)
+
+        def wait_signal():
+            eventlet.hubs.trampoline(rfd, read=True)
+            os.read(rfd, 1)
+            # eventlet.wsgi.server stops accepting and
+            # waits for the running requests
+            server.kill(SystemExit)
+
+        eventlet.spawn_n(wait_signal)
+        try:
+            server.wait()
+        except SystemExit:
+            pass
+        LOG.info("worker %s stopped" % os.getpid())
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = None
+            return
+        status = 0
+        try:
+            # do not share the hub and database connections
+            # with the master
+            eventlet.hubs.use_hub()
+            db.engine.dispose()
+            self.serve()
+        except BaseException:
+            LOG.exception("worker %s failed" % os.getpid())
+            status = 1
+        os._exit(status)
+
+    def stop_workers(self, pids):
+        now = _time.time()
+        for pid in pids:
+            if self.workers.get(pid, now) is None:
+                self.workers[pid] = now
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+    def reap_workers(self):
+        """
+        Forget exited workers and kill ones that do not stop
+        in ``heart_graceful_timeout`` seconds.
+        Returns the number of running workers that are not stopping.
+        """
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno != errno.ECHILD:
+                    raise
+                self.workers.clear()
+                break
+            if not pid:
+                break
+            if self.workers.pop(pid, True) is None and not self.stopping:
+                LOG.error("worker %s exited unexpectedly with status %s" %
+                          (pid, status))
+        now = _time.time()
+        for pid, stop_time in self.workers.items():
+            if (stop_time is not None and
+                    now - stop_time > global_conf.heart_graceful_timeout):
+                LOG.warn("killing worker %s" % pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        return len([stop_time for stop_time in self.workers.itervalues()
+                    if stop_time is None])
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def run(self):
+        """
+        Run the server till SIGTERM or SIGINT. If ``heart_workers``
+        is 0, serve requests in the current process.
+        """
+        self.bind()
+        if global_conf.heart_workers <= 0:
+            self.serve()
+            return
+        for signum in signal.SIGTERM, signal.SIGINT, signal.SIGHUP:
+            signal.signal(signum, self.handle_signal)
+        while True:
+            if self.stopping:
+                self.stop_workers(self.workers.keys())
+                if not self.workers:
+                    break
+            elif self.reloading:
+                self.reloading = False
+                LOG.info("reloading")
+                global_conf.reload()
+                old_workers = self.workers.keys()
+                self.bind()
+                for i in xrange(global_conf.heart_workers):
+                    self.spawn_worker()
+                self.stop_workers(old_workers)
+            running = self.reap_workers()
+            if not self.stopping:
+                for i in xrange(global_conf.heart_workers - running):
+                    self.spawn_worker()
+            try:
+                _time.sleep(0.5)
+            except IOError:
+                pass
+        LOG.info("stopped")
@@ -17,10 +17,28 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+Import data of old Nova Billing (instances) or Glance (images)
+into the Heart database::
+
+    python2 -m nova_billing.migrate instances mysql://... --checkpoint FILE
+
+Instances are committed in chunks of ``--chunk-size`` items. Images,
+including deleted ones, are requested and committed in pages
+of ``--page-size`` items. If the run is interrupted, run the same
+command again to resume it from the checkpoint file.
+"""
+
+import os
 import sys
 import json
+import time
+import urllib
+import argparse
+import datetime
 
 from sqlalchemy import create_engine
+from sqlalchemy.sql.expression import select, text
 from flask import _request_ctx_stack
 
 from nova_billing import utils
@@ -36,60 +54,196 @@ class ResourceTypes(object):
     Image = "glance/image"
 
 
-usage = "usage: python2 -m nova_billing.migrate [images|instances] URL"
+class Checkpoint(object):
+    """
+    Position of an interrupted migration kept in ``path``.
+    The position is saved after every committed chunk, so a new run
+    with the same checkpoint file skips migrated data.
+    """
+    def __init__(self, path, source):
+        self.path = path
+        self.source = source
+        self.position = None
+        if not path or not os.path.exists(path):
+            return
+        with open(path, "r") as checkpoint_file:
+            saved = json.load(checkpoint_file)
+        if saved["source"] != source:
+            raise ValueError("checkpoint %s is saved for %s" %
+                             (path, saved["source"]))
+        self.position = saved["position"]
+
+    def save(self, position):
+        self.position = position
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump({"source": self.source, "position": position},
+                      checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(tmp_path, self.path)
+
+
+class Progress(object):
+    """
+    Print the number of migrated items to stderr.
+    """
+    def __init__(self, title, total=None):
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.started_at = time.time()
+
+    def add(self, count):
+        self.done += count
+        elapsed = max(time.time() - self.started_at, 0.001)
+        if self.total:
+            done = "%s/%s (%.1f%%)" % (
+                self.done, self.total, 100.0 * self.done / self.total)
+        else:
+            done = str(self.done)
+        print >>sys.stderr, "%s: %s, %.0f per second" % (
+            self.title, done, self.done / elapsed)
+
 
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return utils.str_to_datetime(value)
 
-def complain_usage():
-    print >>sys.stderr, usage
-    sys.exit(1)
+
+def insert_segments(segments):
+    """
+    Insert a list of segment dicts skipping ones that were inserted
+    by an interrupted run.
+    """
+    resource_ids = list(set((seg["resource_id"] for seg in segments)))
+    table = Segment.__table__
+    existing = set()
+    # keep the number of bound parameters low for SQLite
+    for i in xrange(0, len(resource_ids), 500):
+        existing.update(((row.resource_id, row.begin_at)
+                         for row in db.session.execute(
+                             select([table.c.resource_id, table.c.begin_at]).
+                             where(table.c.resource_id.in_(
+                                 resource_ids[i:i + 500])))))
+    segments = [seg for seg in segments
+                if (seg["resource_id"], seg["begin_at"]) not in existing]
+    if segments:
+        db.session.execute(table.insert(), segments)
+
+
+def finish():
+    db_api.resource_current_segment_sync()
+    db_api.rollup_invalidate()
+    db_api.counter_invalidate()
+    db.session.commit()
 
 
 def main():
-    if len(sys.argv) < 3:
-        complain_usage()
+    arg_parser = argparse.ArgumentParser(
+        prog="python2 -m nova_billing.migrate",
+        description="import data of old Nova Billing or Glance")
+    arg_parser.add_argument(
+        "source", choices=("images", "instances"),
+        help="what to import")
+    arg_parser.add_argument(
+        "url",
+        help="Glance API URL for images, old database URL for instances")
+    arg_parser.add_argument(
+        "--chunk-size", type=int, default=500,
+        help="number of instances committed at once (default: 500)")
+    arg_parser.add_argument(
+        "--page-size", type=int, default=500,
+        help="number of images requested from Glance"
+        " and committed at once (default: 500)")
+    arg_parser.add_argument(
+        "--checkpoint", metavar="FILE",
+        help="save the progress to FILE and resume from it")
+    args = arg_parser.parse_args()
 
     _request_ctx_stack.push(1)
     db.create_all()
-    if sys.argv[1] == "images":
-        migrate_images(sys.argv[2])
-    elif sys.argv[1] == "instances":
-        migrate_instances(sys.argv[2])
+    checkpoint = Checkpoint(args.checkpoint,
+                            "%s %s" % (args.source, args.url))
+    if args.source == "images":
+        migrate_images(args.url, args.page_size, checkpoint)
     else:
-        complain_usage()
+        migrate_instances(args.url, args.chunk_size, checkpoint)
+
+
+def image_pages(glance_client, page_size, marker=None):
+    """
+    Walk Glance image list with marker/limit pagination ordered by id.
+    Deleted images are listed as well. Yields lists of images.
+    """
+    while True:
+        params = {
+            "limit": page_size,
+            "sort_key": "id",
+            "sort_dir": "asc",
+            # list images of all tenants
+            "is_public": "none",
+            # changes-since makes Glance list deleted images
+            "changes-since": "1970-01-01T00:00:00",
+        }
+        if marker is not None:
+            params["marker"] = marker
+        images = json.loads(glance_client.get(
+            "/images/detail?%s" % urllib.urlencode(params)))["images"]
+        if not images:
+            return
+        yield images
+        marker = images[-1]["id"]
 
 
-def migrate_images(glance_url):
+def migrate_images(glance_url, page_size=500, checkpoint=None):
+    """
+    Import images listed by Glance page by page. Every page
+    is committed, so only one page is kept in memory.
+    """
+    checkpoint = checkpoint or Checkpoint(None, glance_url)
     glance_client = client.RestClient()
     glance_client.auth_headers = {"x-auth-token": global_conf.admin_token}
     glance_client.management_url = glance_url
     
     tariffs = db_api.tariff_map()
+    progress = Progress("images")
     accounts = {}
-    images = json.loads(glance_client.get("/images/detail"))["images"]
-    for project_id in (img1["owner"] for img1 in images if img1["owner"]):
-        accounts[project_id] = \
-            db_api.account_get_or_create(project_id).id
-    
-    for img1 in images:
-        if not img1["owner"]:
-            continue
-        account_id = accounts[img1["owner"]]
-        img2 = db_api.resource_get_or_create(
-            account_id, None,
-            ResourceTypes.Image,
-            img1["id"]
-        )
-        seg = Segment(
-            resource_id=img2.id,
-            cost=img1["size"] * tariffs.get(ResourceTypes.Image, 1) / (1024.0 ** 3),
-            begin_at=utils.str_to_datetime(img1["created_at"]),
-            end_at=utils.str_to_datetime(img1["deleted_at"]))
-        db.session.add(seg)
+    for page in image_pages(glance_client, page_size, checkpoint.position):
+        images = [img1 for img1 in page if img1["owner"]]
+        for img1 in images:
+            if img1["owner"] not in accounts:
+                accounts[img1["owner"]] = \
+                    db_api.account_get_or_create(img1["owner"]).id
+        resources = db_api.resource_get_or_create_many(
+            [(accounts[img1["owner"]], None, ResourceTypes.Image, img1["id"])
+             for img1 in images])
+        if images:
+            insert_segments([{
+                "resource_id": resources[(accounts[img1["owner"]], None,
+                                          ResourceTypes.Image, img1["id"])],
+                "cost": img1["size"] * tariffs.get(ResourceTypes.Image, 1) /
+                    (1024.0 ** 3),
+                "begin_at": to_datetime(img1["created_at"]),
+                "end_at": to_datetime(img1["deleted_at"]),
+            } for img1 in images])
+        db_api.commit()
+        checkpoint.save(page[-1]["id"])
+        progress.add(len(page))
 
-    db.session.commit()
+    finish()
     
 
-def migrate_instances(old_db_url):
+def migrate_instances(old_db_url, chunk_size=500, checkpoint=None):
+    """
+    Import instances of old Nova Billing in chunks ordered by
+    ``billing_instance_info.id``. Segments of a chunk are read with
+    one range query and inserted with one multi-row insert.
+    """
+    checkpoint = checkpoint or Checkpoint(None, old_db_url)
     engine1 = create_engine(old_db_url)
 
     tariffs = db_api.tariff_map()
@@ -101,68 +255,89 @@ def migrate_instances(old_db_url):
         "id", "instance_info_id",
         "segment_type", "begin_at",
         "end_at")
-    instance_infos = {}
     accounts = {}
-    for inst1 in engine1.execute(
-        "select distinct project_id from billing_instance_info"):
-        accounts[inst1.project_id] = \
-            db_api.account_get_or_create(inst1.project_id).id
-    
-    for inst1 in engine1.execute(
-        "select %s from billing_instance_info" %
-        ", ".join(instance_info_attrs)):
-        account_id = accounts[inst1.project_id]
-        inst2 = db_api.resource_get_or_create(
-            account_id, None,
-            ResourceTypes.Instance,
-            inst1.instance_id
-        )
-        inst_dict = {
-            "inst1": inst1,
-            "inst2": inst2,
-        }
-        for rtype in instance_resources:
-            inst_dict[rtype + "_id"] = db_api.resource_get_or_create(
-                account_id, inst2.id, 
-                rtype,
-                None
-            )
-        instance_infos[inst1.id] = inst_dict
-    
-    for iseg in engine1.execute(
-        "select %s from billing_instance_segment" %
-        ", ".join(instance_segment_attrs)):
-        inst_dict = instance_infos[iseg.instance_info_id]
-        inst1 = inst_dict["inst1"]
-        begin_at = utils.str_to_datetime(iseg.begin_at)
-        end_at = utils.str_to_datetime(iseg.end_at)
-        inst_dict["begin_at"] = (min(inst_dict["begin_at"], begin_at)
-                                 if "begin_at" in inst_dict else begin_at)
-        try:
-            prev = inst_dict["end_at"]
-        except KeyError:
-            inst_dict["end_at"] = end_at
-        else:
-            inst_dict["end_at"] = (
-                max(prev, end_at) if prev
-                else None)
-        for rtype in instance_resources:
-            seg = Segment(
-                resource_id=inst_dict[rtype + "_id"].id,
-                cost=getattr(inst1, rtype) * tariffs.get(rtype, 1),
-                begin_at=begin_at,
-                end_at=end_at)
-            db.session.add(seg)
-
-    for inst_dict in instance_infos.values():
-        seg = Segment(
-            resource_id=inst_dict["inst2"].id,
-            cost=tariffs.get("nova/instance", 0),
-            begin_at=inst_dict.get("begin_at", None),
-            end_at=inst_dict.get("end_at", None))
-        db.session.add(seg)
+    last_id = checkpoint.position or 0
+    progress = Progress("instances", engine1.execute(
+        text("select count(*) from billing_instance_info where id > :last_id"),
+        last_id=last_id).scalar())
+    while True:
+        chunk = engine1.execute(
+            text("select %s from billing_instance_info"
+                 " where id > :last_id order by id limit :limit" %
+                 ", ".join(instance_info_attrs)),
+            last_id=last_id, limit=chunk_size).fetchall()
+        if not chunk:
+            break
+        for inst1 in chunk:
+            if inst1.project_id not in accounts:
+                accounts[inst1.project_id] = \
+                    db_api.account_get_or_create(inst1.project_id).id
 
-    db.session.commit()
+        instance_keys = dict(((inst1.id, (accounts[inst1.project_id], None,
+                                          ResourceTypes.Instance,
+                                          inst1.instance_id))
+                              for inst1 in chunk))
+        instances = db_api.resource_get_or_create_many(
+            instance_keys.values())
+        child_keys = [(key[0], instances[key], rtype, None)
+                      for key in instance_keys.itervalues()
+                      for rtype in instance_resources]
+        children = db_api.resource_get_or_create_many(child_keys)
+
+        instance_infos = {}
+        for inst1 in chunk:
+            key = instance_keys[inst1.id]
+            inst_dict = {"inst1": inst1, "inst2": instances[key]}
+            for rtype in instance_resources:
+                inst_dict[rtype + "_id"] = children[
+                    (key[0], instances[key], rtype, None)]
+            instance_infos[inst1.id] = inst_dict
+
+        segments = []
+        for iseg in engine1.execute(
+            text("select %s from billing_instance_segment"
+                 " where instance_info_id > :last_id"
+                 " and instance_info_id <= :chunk_id" %
+                 ", ".join(instance_segment_attrs)),
+            last_id=last_id, chunk_id=chunk[-1].id):
+            inst_dict = instance_infos[iseg.instance_info_id]
+            inst1 = inst_dict["inst1"]
+            begin_at = to_datetime(iseg.begin_at)
+            end_at = to_datetime(iseg.end_at)
+            inst_dict["begin_at"] = (min(inst_dict["begin_at"], begin_at)
+                                     if "begin_at" in inst_dict else begin_at)
+            try:
+                prev = inst_dict["end_at"]
+            except KeyError:
+                inst_dict["end_at"] = end_at
+            else:
+                inst_dict["end_at"] = (
+                    max(prev, end_at) if prev and end_at
+                    else None)
+            for rtype in instance_resources:
+                segments.append({
+                    "resource_id": inst_dict[rtype + "_id"],
+                    "cost": getattr(inst1, rtype) * tariffs.get(rtype, 1),
+                    "begin_at": begin_at,
+                    "end_at": end_at})
+
+        for inst_dict in instance_infos.itervalues():
+            if "begin_at" not in inst_dict:
+                continue
+            segments.append({
+                "resource_id": inst_dict["inst2"],
+                "cost": tariffs.get("nova/instance", 0),
+                "begin_at": inst_dict["begin_at"],
+                "end_at": inst_dict["end_at"]})
+        if segments:
+            insert_segments(segments)
+
+        db_api.commit()
+        last_id = chunk[-1].id
+        checkpoint.save(last_id)
+        progress.add(len(chunk))
+
+    finish()
 
 
 if __name__ == "__main__":
@@ -20,11 +20,13 @@
 OpenStack AMQP listener
 """
 
+import json
 import time
 import socket
 import logging
 
 import eventlet
+import eventlet.queue
 
 import kombu.entity
 import kombu.messaging
@@ -34,12 +36,26 @@ from nova_billing import utils
 from nova_billing.utils import global_conf
 
 from . import instances
+from . import spool
 from . import volumes
 
 
 LOG = logging.getLogger(__name__)
 
 
+def get_resource_key(body):
+    """
+    Return the instance or volume id the message is about.
+    """
+    args = body.get("args", None) or {}
+    for key in ("instance_uuid", "instance_id", "volume_id"):
+        try:
+            return args[key]
+        except KeyError:
+            pass
+    return None
+
+
 class Service(object):
     billing_heart = utils.get_heart_client()
     heart_request_interceptors = (
@@ -52,8 +68,17 @@ class Service(object):
     and starts listening immediately. In case of connection errors
     reconnection attempts will be made periodically.
     
-    The service listens for ``compute.#`` routing keys.
+    The service listens for ``compute.#`` routing keys. Messages
+    are translated by a pool of worker green threads; messages of
+    one instance or volume are handled by the same worker in order.
+    Translated messages are posted to the heart in batches and
+    acknowledged after the heart accepts them.
     """
+    # queues of worker green threads
+    workers = ()
+    # incremented on reconnection
+    generation = 0
+
     def __init__(self):
         self.params = dict(hostname=global_conf.rabbit_host,
                           port=global_conf.rabbit_port,
@@ -61,8 +86,18 @@ class Service(object):
                           password=global_conf.rabbit_password,
                           virtual_host=global_conf.rabbit_virtual_host)
         self.connection = None
+        self.batch = []
+        self.batch_deadline = None
+        if global_conf.amqp_spool_dir:
+            self.spool = spool.Spool(global_conf.amqp_spool_dir,
+                                     global_conf.amqp_spool_segment_size)
+        else:
+            self.spool = None
 
     def reconnect(self):
+        # unacknowledged messages are redelivered to the new channel
+        self.batch = []
+        self.generation += 1
         if self.connection:
             try:
                 self.connection.close()
@@ -94,16 +129,47 @@ class Service(object):
         LOG.debug("Created kombu connection: %s" % self.params)
 
     def process_message(self, body, message):
+        """
+        Pass the message to the worker of its resource or handle
+        it at once if there are no workers.
+        """
+        if not self.workers:
+            self.handle_message(body, message, self.generation)
+        else:
+            queue = self.workers[
+                hash(get_resource_key(body)) % len(self.workers)]
+            queue.put((body, message, self.generation))
+        if len(self.batch) >= global_conf.amqp_batch_size:
+            self.flush()
+
+    def work(self, queue):
+        """
+        This is the main function of a worker green thread.
+        """
+        while True:
+            self.handle_message(*queue.get())
+
+    def handle_message(self, body, message, generation):
+        """
+        Translate the message and add it to the current batch.
+        The message is acknowledged after the batch is delivered.
+        Messages received before reconnection are dropped.
+        """
         try:
-            self.process_event(body, message)
+            heart_request = self.create_heart_request(body, message)
         except:
             LOG.exception("Cannot handle message")
-        message.ack()
+            heart_request = None
+        if generation != self.generation:
+            return
+        if not self.batch:
+            self.batch_deadline = time.time() + global_conf.amqp_batch_timeout
+        self.batch.append((heart_request, message))
 
-    def process_event(self, body, message):
+    def create_heart_request(self, body, message):
         """
         This function analyzes ``body`` and calls
-        heart_request_interceptors.
+        heart_request_interceptors. Returns a heart request or None.
         """
         method = body.get("method", None)
         heart_request = None
@@ -113,18 +179,137 @@ class Service(object):
                 heart_request.setdefault("datetime", utils.datetime_to_str(
                     self.get_event_datetime(body)))
                 heart_request.setdefault("account", body["_context_project_id"])
-                try:
-                    self.billing_heart.event(heart_request)
-                except socket.error as ex:
-                    LOG.error("cannot post event to the Heart: %s" % str(ex))
-                except:
-                    LOG.exception("cannot post event to the Heart")
                 break
         try:
             routing_key = message.delivery_info["routing_key"]
-        except AttributeError, KeyError:
+        except (AttributeError, KeyError):
             routing_key = "<unknown>"
         LOG.debug("routing_key=%s method=%s" % (routing_key, method))
+        return heart_request
+
+    def post_events(self, heart_requests):
+        """
+        Post heart requests to the Heart in one call.
+        Requests rejected by the Heart are logged.
+        """
+        self.log_results(heart_requests,
+                         self.billing_heart.events(heart_requests))
+
+    def log_results(self, heart_requests, results):
+        for heart_request, result in zip(heart_requests, results):
+            if result is not None and result.get("status") != 200:
+                LOG.error("the Heart rejected event %s: %s" %
+                          (heart_request, result.get("error")))
+
+    def flush(self):
+        """
+        Post heart requests of the current batch to the Heart
+        and acknowledge the messages.
+
+        If the Heart fails, the requests are appended to the spool.
+        While the spool is not empty, new requests are appended to it
+        as well, so that the Heart receives them in order.
+        Without a spool, posting is retried till the Heart answers;
+        meanwhile RabbitMQ stops sending messages due to the prefetch
+        limit. If the Heart fails to process a batch more than
+        ``amqp_max_retries`` times, only the failing events are dropped
+        (see :meth:`BillingHeartClient.post_events` and
+        :meth:`drop_events`).
+        """
+        batch, self.batch = self.batch, []
+        heart_requests = [heart_request for heart_request, message in batch
+                          if heart_request is not None]
+        if heart_requests:
+            if self.spool is not None:
+                self.spool_events(heart_requests)
+            else:
+                self.retry_events(heart_requests)
+        for heart_request, message in batch:
+            message.ack()
+
+    def spool_events(self, heart_requests):
+        if self.spool.empty():
+            try:
+                self.post_events(heart_requests)
+                return
+            except Exception, ex:
+                LOG.error("cannot post %s events to the Heart: %s;"
+                          " spooling them" % (len(heart_requests), ex))
+        self.spool.append(heart_requests)
+
+    def retry_events(self, heart_requests):
+        self.log_results(heart_requests, self.billing_heart.post_events(
+            heart_requests, global_conf.amqp_max_retries, self.drop_events))
+
+    def drop_events(self, heart_requests, ex):
+        """
+        Log heart requests that the Heart keeps failing to process
+        so that they can be posted again by hand.
+        """
+        LOG.error("the Heart failed to process %s events %s times: %s;"
+                  " dropping them: %s" %
+                  (len(heart_requests), global_conf.amqp_max_retries + 1,
+                   ex, json.dumps(heart_requests)))
+
+    def replay_spool(self):
+        """
+        Post spooled heart requests in order till the spool is empty.
+        Events that the Heart fails to process more than
+        ``amqp_max_retries`` times are found like in :meth:`flush`
+        and moved aside (see :meth:`Spool.reject`), so that they do not
+        hold back the requests spooled after them.
+        """
+        while True:
+            heart_requests, position = self.spool.read(
+                global_conf.amqp_batch_size)
+            if not heart_requests:
+                return
+            rejected = []
+
+            def reject(requests, ex):
+                LOG.error("the Heart failed to process %s spooled events"
+                          " %s times: %s; moving them aside" %
+                          (len(requests), global_conf.amqp_max_retries + 1,
+                           ex))
+                rejected.extend(requests)
+
+            self.log_results(heart_requests, self.billing_heart.post_events(
+                heart_requests, global_conf.amqp_max_retries, reject))
+            if rejected:
+                self.spool.reject(rejected, position)
+            else:
+                self.spool.commit(position)
+
+    def replay(self):
+        """
+        This is the main function of the replay green thread.
+        """
+        delay = 1
+        while True:
+            try:
+                self.replay_spool()
+                delay = 1
+            except Exception, ex:
+                LOG.error("cannot post spooled events to the Heart: %s;"
+                          " retrying in %s seconds" % (ex, delay))
+                delay = min(delay * 2, 60)
+            time.sleep(delay)
+
+    def drain_events(self):
+        """
+        Wait for messages and flush the batch when it is due.
+        """
+        if self.batch and (len(self.batch) >= global_conf.amqp_batch_size or
+                           time.time() >= self.batch_deadline):
+            self.flush()
+        # wake up periodically to flush messages handled by workers
+        timeout = global_conf.amqp_batch_timeout
+        if self.batch:
+            timeout = self.batch_deadline - time.time()
+        try:
+            self.connection.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
 
     def get_event_datetime(self, body):
         return utils.now()
@@ -140,15 +325,24 @@ class Service(object):
                     channel=self.channel,
                     queues=self.queue,
                     callbacks=[self.process_message]) as consumer:
+                    consumer.qos(
+                        prefetch_count=global_conf.amqp_prefetch_count)
                     while True:
-                        self.connection.drain_events()
+                        self.drain_events()
             except socket.error:
                 pass
             except Exception, e:
                 LOG.exception('Failed to consume message from queue: %s' % str(e))
 
     def start(self):
+        eventlet.spawn_n(instances.flavor_cache.refresh)
+        self.workers = [eventlet.queue.LightQueue()
+                        for i in xrange(global_conf.amqp_workers)]
+        for queue in self.workers:
+            eventlet.spawn_n(self.work, queue)
         self.server = eventlet.spawn(self.consume)
+        if self.spool is not None:
+            eventlet.spawn_n(self.replay)
 
     def stop(self):
         self.server.stop()
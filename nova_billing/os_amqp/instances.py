@@ -16,6 +16,7 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import time
 import logging
 from nova_billing import utils
 from nova_billing.utils import global_conf
@@ -61,10 +62,19 @@ target_state = {
 }
 
 
+# messages that can change the flavor of an instance
+resize_methods = (
+    "prep_resize",
+    "resize_instance",
+    "finish_resize",
+    "confirm_resize",
+    "revert_resize",
+    "finish_revert_resize",
+)
+
+
 nova_client = utils.get_nova_client()
 
-# Cache flavors here
-flavors = {}
 no_flavor = {
     "name": "<none>",
     "local_gb": 0,
@@ -72,34 +82,118 @@ no_flavor = {
     "vcpus": 0,
 } 
 
-def get_flavor(flavor_id):
-    try:
-        return flavors[flavor_id]
-    except KeyError:
-        pass
-    try:
-        flav = nova_client.flavors.get(flavor_id)
-    except:
-        return no_flavor
-    flav = {
+
+def flavor_to_dict(flav):
+    return {
         "name": flav.name,
         "local_gb": flav.disk,
         "memory_mb": flav.ram,
         "vcpus": flav.vcpus,
     }
-    flavors[flavor_id] = flav
-    return flav
+
+
+class FlavorCache(object):
+    """
+    Flavors by their ids. All flavors are loaded with one request
+    and reloaded every ``flavor_cache_ttl`` seconds; a flavor
+    created between reloads is requested separately.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.flavors = {}
+        self.loaded_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self):
+        self.loaded_at = time.time()
+        try:
+            flavors = dict(((str(flav.id), flavor_to_dict(flav))
+                            for flav in nova_client.flavors.list()))
+        except:
+            LOG.exception("cannot load flavors")
+            return
+        self.flavors = flavors
+        LOG.info("loaded %s flavors; cache stats: %s" %
+                 (len(flavors), cache_stats()))
+
+    def get(self, flavor_id):
+        if self.loaded_at is None or time.time() - self.loaded_at >= self.ttl:
+            self.refresh()
+        flavor_id = str(flavor_id)
+        try:
+            flav = self.flavors[flavor_id]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return flav
+        try:
+            flav = flavor_to_dict(nova_client.flavors.get(flavor_id))
+        except:
+            return no_flavor
+        self.flavors[flavor_id] = flav
+        return flav
+
+    def stats(self):
+        return {"size": len(self.flavors),
+                "hits": self.hits,
+                "misses": self.misses}
+
+
+flavor_cache = FlavorCache(global_conf.flavor_cache_ttl)
+# flavors of instances seen in run_instance messages
+# with the time they were stored
+instance_flavors = utils.LRUCache(global_conf.instance_flavor_cache_size)
+instance_flavor_stats = {"hits": 0, "misses": 0}
+
+
+def cache_stats():
+    stats = {"flavor": flavor_cache.stats(),
+             "instance": dict(instance_flavor_stats)}
+    stats["instance"]["size"] = len(instance_flavors)
+    for value in stats.itervalues():
+        requests = value["hits"] + value["misses"]
+        value["hit_rate"] = float(value["hits"]) / requests if requests else None
+    return stats
+
+
+def get_flavor(flavor_id):
+    return flavor_cache.get(flavor_id)
+
+
+def put_instance_flavor(instance_id, flav):
+    instance_flavors.put(instance_id, (flav, time.time()))
 
 
 def get_instance_flavor(instance_id):
+    """
+    Return the flavor of the instance. A remembered flavor is asked
+    from Nova again after ``flavor_cache_ttl`` seconds.
+    """
+    entry = instance_flavors.get(instance_id)
+    if (entry is not None and
+            time.time() - entry[1] < global_conf.flavor_cache_ttl):
+        instance_flavor_stats["hits"] += 1
+        return entry[0]
+    instance_flavor_stats["misses"] += 1
     try:
-        return get_flavor(
+        flav = get_flavor(
             nova_client.servers.get(instance_id).flavor["id"])
     except:
         return no_flavor
+    if flav is not no_flavor:
+        put_instance_flavor(instance_id, flav)
+    return flav
 
 
 def create_heart_request(method, body):
+    if method in resize_methods:
+        # the new flavor is asked from Nova on the next event
+        args = body.get("args", None) or {}
+        for key in ("instance_uuid", "instance_id"):
+            instance_flavors.pop(args.get(key, None))
+        return None
     try:
         state = target_state[method]
     except KeyError:
@@ -124,6 +218,7 @@ def create_heart_request(method, body):
 
     child_keys = ("local_gb", "memory_mb", "vcpus")
     if method == "terminate_instance":
+        instance_flavors.pop(heart_request["name"])
         heart_request["fixed"] = None
         heart_request["children"] = [
             {"rtype": key, "fixed": None}
@@ -135,6 +230,7 @@ def create_heart_request(method, body):
         except KeyError:
             flav = get_instance_flavor(heart_request["name"])
         if method == "run_instance":
+            put_instance_flavor(heart_request["name"], flav)
             heart_request["fixed"] = 0
             heart_request["attrs"] = {"instance_type": flav["name"]}
         else:
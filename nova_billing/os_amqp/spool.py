@@ -0,0 +1,170 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Durable spool of heart requests.
+
+Requests are appended to segment files as JSON lines. A segment
+is named after its sequence number and is closed when it grows
+over ``segment_size`` bytes. The ``offset`` file keeps the position
+of the first unsent request: a segment number and a byte offset.
+Segments before that position are deleted. Requests that cannot
+be sent are moved aside to ``.rejected`` files named after their
+segments.
+"""
+
+import os
+import json
+import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    Append-only queue of heart requests kept in ``path`` directory.
+    """
+    def __init__(self, path, segment_size=16 * 1024 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segments = self.segments()
+        self.position = self.load_position(segments)
+        self.write_segment = segments[-1] if segments else self.position[0]
+        self.write_file = None
+        self.repair()
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, "%08d.log" % segment)
+
+    def segments(self):
+        return sorted((int(name[:-4]) for name in os.listdir(self.path)
+                       if name.endswith(".log") and name[:-4].isdigit()))
+
+    def load_position(self, segments):
+        try:
+            with open(os.path.join(self.path, "offset"), "r") as offset_file:
+                segment, offset = offset_file.read().split()
+                return int(segment), int(offset)
+        except (IOError, ValueError):
+            return (segments[0] if segments else 1), 0
+
+    def repair(self):
+        """
+        Cut off a request partially written to the last segment
+        before a crash.
+        """
+        path = self.segment_path(self.write_segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "r+b") as segment_file:
+            data = segment_file.read()
+            if data and not data.endswith("\n"):
+                LOG.warn("truncating incomplete record in %s" % path)
+                segment_file.truncate(data.rfind("\n") + 1)
+
+    def append(self, requests):
+        """
+        Append a list of requests and sync them to the disk.
+        """
+        if self.write_file is None:
+            self.write_file = open(
+                self.segment_path(self.write_segment), "ab")
+        self.write_file.write("".join(
+            (json.dumps(request) + "\n" for request in requests)))
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        if self.write_file.tell() >= self.segment_size:
+            self.write_file.close()
+            self.write_file = None
+            self.write_segment += 1
+
+    def empty(self):
+        segment, offset = self.position
+        if segment < self.write_segment:
+            return False
+        path = self.segment_path(segment)
+        return not os.path.exists(path) or os.path.getsize(path) <= offset
+
+    def read(self, limit):
+        """
+        Read up to ``limit`` requests starting from the first unsent one.
+        Returns a list of requests and the position after them that
+        should be passed to :meth:`commit` once they are sent.
+        """
+        segment, offset = self.position
+        requests = []
+        while len(requests) < limit and segment <= self.write_segment:
+            try:
+                segment_file = open(self.segment_path(segment), "rb")
+            except IOError:
+                if segment == self.write_segment:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            with segment_file:
+                segment_file.seek(offset)
+                for line in segment_file:
+                    if not line.endswith("\n"):
+                        break
+                    offset += len(line)
+                    requests.append(json.loads(line))
+                    if len(requests) >= limit:
+                        break
+                else:
+                    if segment < self.write_segment:
+                        segment, offset = segment + 1, 0
+                        continue
+            break
+        return requests, (segment, offset)
+
+    def commit(self, position):
+        """
+        Mark requests before ``position`` as sent.
+        """
+        tmp_path = os.path.join(self.path, "offset.tmp")
+        with open(tmp_path, "w") as offset_file:
+            offset_file.write("%s %s\n" % position)
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.rename(tmp_path, os.path.join(self.path, "offset"))
+        for segment in self.segments():
+            if segment >= position[0]:
+                break
+            os.unlink(self.segment_path(segment))
+        self.position = position
+
+    def reject(self, requests, position):
+        """
+        Move ``requests`` (some of the ones read before ``position``)
+        aside and mark all requests read before ``position`` as sent.
+        """
+        path = os.path.join(self.path, "%08d.rejected" % self.position[0])
+        with open(path, "ab") as rejected_file:
+            rejected_file.write("".join(
+                (json.dumps(request) + "\n" for request in requests)))
+            rejected_file.flush()
+            os.fsync(rejected_file.fileno())
+        self.commit(position)
+
+    def close(self):
+        if self.write_file is not None:
+            self.write_file.close()
+            self.write_file = None
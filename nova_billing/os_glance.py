@@ -16,14 +16,144 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import json
+import time
+import Queue
+import logging
+import threading
+
 import webob
+import webob.dec
 
 from nova_billing import utils
+from nova_billing.utils import global_conf
+
+
+LOG = logging.getLogger(__name__)
+
+# image metadata responses are much smaller
+MAX_METADATA_SIZE = 1024 * 1024
+
+
+class EventSender(object):
+    """
+    Posts heart requests to the Heart in a background thread.
+
+    Requests wait in a queue of up to ``queue_size`` items and are
+    posted in batches of up to ``batch_size`` items. A failed batch is
+    retried till the Heart accepts it; meanwhile new requests are
+    dropped when the queue is full. Events that the Heart fails
+    to process more than ``max_retries`` times are dropped and logged
+    (see :meth:`BillingHeartClient.post_events`). Queue depth and counters
+    of requests are returned by :meth:`stats` and logged every
+    ``glance_stats_interval`` seconds.
+    """
+    def __init__(self, billing_heart, queue_size, batch_size,
+                 max_retries=5):
+        self.billing_heart = billing_heart
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.queue = Queue.Queue(queue_size)
+        self.thread_pid = None
+        self.lock = threading.Lock()
+        # ``dropped`` is counted by both request and sender threads
+        self.dropped_lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def start(self):
+        """
+        Start the sender thread in the current process. Glance forks
+        its workers after loading the filter, so the thread is started
+        on the first request in every worker.
+        """
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread_pid = os.getpid()
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+
+    def send(self, heart_request):
+        if self.thread_pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(heart_request)
+        except Queue.Full:
+            dropped = self.count_dropped(1)
+            if dropped % 1000 == 1:
+                LOG.error("the Heart request queue is full; %s events"
+                          " dropped so far" % dropped)
+
+    def count_dropped(self, count):
+        with self.dropped_lock:
+            self.dropped += count
+            return self.dropped
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def post_events(self, heart_requests):
+        results = self.billing_heart.post_events(
+            heart_requests, self.max_retries, self.drop_events)
+        for heart_request, result in zip(heart_requests, results):
+            if result is None:
+                continue
+            if result.get("status") == 200:
+                self.sent += 1
+            else:
+                self.rejected += 1
+                LOG.error("the Heart rejected event %s: %s" %
+                          (heart_request, result.get("error")))
+
+    def drop_events(self, heart_requests, ex):
+        self.count_dropped(len(heart_requests))
+        LOG.error("the Heart failed to process %s events %s times: %s;"
+                  " dropping them: %s" %
+                  (len(heart_requests), self.max_retries + 1, ex,
+                   json.dumps(heart_requests)))
+
+    def run(self):
+        """
+        This is the main function of the sender thread.
+        """
+        reported_at = time.time()
+        while True:
+            try:
+                self.post_events(self.next_batch())
+            except:
+                LOG.exception("cannot post events to the Heart")
+            if time.time() - reported_at >= global_conf.glance_stats_interval:
+                reported_at = time.time()
+                LOG.info("billing event sender stats: %s" % self.stats())
+
+    def stats(self):
+        return {"queue_depth": self.queue.qsize(),
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "rejected": self.rejected}
 
 
 class GlanceBillingFilter(object):
+    """
+    Reports creation and deletion of images to the Heart.
+    Requests are posted by :class:`EventSender`, so Glance
+    does not wait for the Heart.
+    """
     billing_heart = utils.get_heart_client()
+    sender = EventSender(billing_heart,
+                         global_conf.glance_queue_size,
+                         global_conf.glance_batch_size,
+                         global_conf.glance_max_retries)
 
     def __init__(self, application):
         self.application = application
@@ -36,10 +166,10 @@ class GlanceBillingFilter(object):
             return resp
         method = req.environ.get("REQUEST_METHOD", "GET")
         if method == "PUT" or method == "POST":
+            resp_json = self.load_image_metadata(resp)
             try:
-                resp_json = json.loads(resp.body)
                 img_id, img_size = resp_json["image"]["id"], resp_json["image"]["size"]
-            except KeyError:
+            except (KeyError, TypeError):
                 return resp
             heart_request = {"name": img_id,
                              "linear": img_size / (1024.0 ** 3)}
@@ -52,9 +182,30 @@ class GlanceBillingFilter(object):
             heart_request["rtype"] = "glance/image"
             heart_request["account"] = req.headers["X-Tenant"]
             heart_request["datetime"] = utils.datetime_to_str(utils.now())
-            self.billing_heart.event(heart_request)
+            self.sender.send(heart_request)
         return resp
 
+    @staticmethod
+    def load_image_metadata(resp):
+        """
+        Parse a successful JSON response of a bounded size.
+        Other responses (e.g., image data) are not read, so they are
+        passed to the client without buffering.
+        """
+        if resp.status_int >= 300 or resp.content_type != "application/json":
+            return None
+        length = resp.content_length
+        if length is None:
+            # the body is not known in advance only for a streaming response
+            if not isinstance(resp.app_iter, (list, tuple)):
+                return None
+        elif length > MAX_METADATA_SIZE:
+            return None
+        try:
+            return json.loads(resp.body)
+        except ValueError:
+            return None
+
     @classmethod
     def factory(cls, global_config, **local_config):
         def filter(app):
@@ -27,13 +27,17 @@ import json
 import logging
 import sys
 import os
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 
-from nova_billing.client import BillingHeartClient
+from nova_billing.client import BillingHeartClient, ConnectionPool
 
 
 LOG = logging.getLogger(__name__)
 
+# 31556952 seconds - an average Gregorian year
+SECONDS_IN_YEAR = 31556952.0
+
 
 class ContentType(object):
     JSON = "application/json"
@@ -81,6 +85,45 @@ def datetime_to_str(dt):
     return ("%sZ" % dt.isoformat()) if isinstance(dt, datetime) else None
 
 
+def month_start(dt):
+    """
+    Return the beginning of the month of ``dt``.
+    """
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    """
+    Return the beginning of the month that is ``months`` after the month of ``dt``.
+    """
+    month = dt.year * 12 + dt.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def time_buckets(period_start, period_stop, granularity):
+    """
+    Split [``period_start``, ``period_stop``] into buckets of
+    ``granularity`` (``hour``, ``day``, or ``month``) aligned
+    to the calendar. Returns the list of bucket edges from
+    ``period_start`` to ``period_stop``; the first and the last
+    buckets can be partial.
+    """
+    if granularity == "month":
+        next_edge = lambda dt: add_months(dt, 1)
+    elif granularity == "day":
+        next_edge = lambda dt: (datetime(dt.year, dt.month, dt.day) +
+                                timedelta(days=1))
+    elif granularity == "hour":
+        next_edge = lambda dt: (datetime(dt.year, dt.month, dt.day, dt.hour) +
+                                timedelta(hours=1))
+    else:
+        raise ValueError("unknown granularity `%s'" % granularity)
+    edges = [period_start]
+    while edges[-1] < period_stop:
+        edges.append(min(next_edge(edges[-1]), period_stop))
+    return edges
+
+
 def usage_to_hours(usage):
     """
     Convert usage measured for seconds to hours.
@@ -96,9 +139,104 @@ def dict_add(a, b):
         a[key] = a.get(key, 0) + b[key]
 
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def datetime_to_epoch(value):
+    """
+    Convert ``value`` to microseconds since the epoch.
+    """
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def epoch_to_datetime(value):
+    return EPOCH + timedelta(microseconds=value)
+
+
 def cost_add(cost, begin_at, end_at):
-    # 31556952 seconds - an average Gregorian year
-    return cost if cost < 0 else cost * total_seconds(end_at - begin_at) / 31556952.0
+    return cost if cost < 0 else cost * total_seconds(end_at - begin_at) / SECONDS_IN_YEAR
+
+
+def clipped_seconds(begin_at, clip_begin, clip_end):
+    """
+    Whole seconds of [``clip_begin``, ``clip_end``] within a segment
+    begun at ``begin_at``. Seconds are counted from ``begin_at``,
+    so seconds of adjacent pieces of a segment add up to seconds
+    of the whole.
+    """
+    return (total_seconds(clip_end - begin_at) -
+            total_seconds(clip_begin - begin_at))
+
+
+class LRUCache(object):
+    """
+    A mapping of bounded size that drops the least recently used entries.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = {}
+        # circular doubly linked list of [prev, next, key, value];
+        # the root's next is the least recently used entry
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = self._root[0] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                link = self._data[key]
+            except KeyError:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def put(self, key, value):
+        with self._lock:
+            try:
+                link = self._data[key]
+            except KeyError:
+                link = [None, None, key, value]
+                self._data[key] = link
+                if len(self._data) > self.maxsize:
+                    oldest = self._root[1]
+                    self._unlink(oldest)
+                    del self._data[oldest[2]]
+            else:
+                link[3] = value
+                self._unlink(link)
+            self._append(link)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                link = self._data.pop(key)
+            except KeyError:
+                return default
+            self._unlink(link)
+            return link[3]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
 
 
 class GlobalConf(object):
@@ -110,15 +248,47 @@ class GlobalConf(object):
         "log_format": "%(asctime)-15s:nova-billing:%(levelname)s:%(name)s:%(message)s",
         "log_level": "DEBUG",
         "nova_conf": "nova.conf",
+        "heart_cache_size": 10000,
+        "heart_workers": 4,
+        "heart_pool_size": 100,
+        "heart_backlog": 128,
+        "heart_keepalive": True,
+        "heart_client_timeout": 60,
+        "heart_request_timeout": 300,
+        "heart_graceful_timeout": 30,
+        "heart_segment_batch_size": 65536,
+        "http_pool_size": 8,
+        "http_connect_timeout": 10,
+        "http_read_timeout": 60,
+        "amqp_batch_size": 100,
+        "amqp_batch_timeout": 1.0,
+        "amqp_prefetch_count": 200,
+        "amqp_workers": 8,
+        "amqp_max_retries": 5,
+        "flavor_cache_ttl": 3600,
+        "instance_flavor_cache_size": 10000,
+        "glance_queue_size": 10000,
+        "glance_batch_size": 100,
+        "glance_max_retries": 5,
+        "glance_stats_interval": 60,
+        "amqp_spool_dir": "/var/lib/nova-billing/spool",
+        "amqp_spool_segment_size": 16777216,
     }
 
     def load_from_file(self, filename):
+        self._filename = filename
         try:
             with open(filename, "r") as file:
                 self._conf.update(json.loads(file.read()))
         except:
             pass
 
+    def reload(self):
+        """
+        Read the last loaded settings file again.
+        """
+        self.load_from_file(self._filename)
+
     def load_nova_conf(self):
         try:
             from nova import flags
@@ -168,7 +338,10 @@ global_conf.load_from_file("/etc/nova-billing/settings.json")
 
 def get_heart_client():
     return BillingHeartClient(
-        management_url=global_conf.billing_heart_url) 
+        management_url=global_conf.billing_heart_url,
+        pool=ConnectionPool(global_conf.http_pool_size,
+                            global_conf.http_connect_timeout,
+                            global_conf.http_read_timeout))
 
 
 def get_nova_client():
@@ -45,6 +45,7 @@ setup(name='nova-billing',
       entry_points={
         'console_scripts': [
             'nova-billing-heart = nova_billing.heart.main:main',
+            'nova-billing-heart-manage = nova_billing.heart.manage:main',
             'nova-billing-os-amqp = nova_billing.os_amqp.main:main',
         ]
       },
@@ -0,0 +1,104 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for nova_billing.client
+"""
+
+import os
+import sys
+import json
+import httplib
+import threading
+import BaseHTTPServer
+import SocketServer
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import client
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append((self.client_address, body))
+        if json.loads(body).get("break"):
+            # processed, but the response is cut off
+            self.wfile.write("HTTP/1.1 200 OK\r\n"
+                             "Content-Length: 100\r\n\r\n{")
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestCase(tests.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = client.BillingHeartClient(
+            management_url="http://127.0.0.1:%s" % self.server.server_port,
+            pool=client.ConnectionPool(2, 5, 5))
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        super(TestCase, self).tearDown()
+
+    def test_keepalive(self):
+        for i in xrange(3):
+            self.assertEqual(json.loads(self.client.event({"i": i})), {"i": i})
+        # a single connection is reused
+        self.assertEqual(
+            len(set((address for address, body in self.server.requests))), 1)
+
+    def test_reconnect(self):
+        self.client.event({"i": 0})
+        conn = self.client.pool._idle.values()[0].get_nowait()
+        conn.sock.shutdown(2)
+        self.client.pool.put("http", conn.host + ":%s" % conn.port, conn)
+        self.assertEqual(json.loads(self.client.event({"i": 1})), {"i": 1})
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_no_replay(self):
+        self.client.event({"i": 0})
+        self.assertRaises(httplib.HTTPException,
+                          self.client.event, {"break": True})
+        # the request could have been processed, so it is not repeated
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(json.loads(self.client.event({"i": 1})), {"i": 1})
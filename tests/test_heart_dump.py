@@ -0,0 +1,118 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for nova_billing.heart.dump
+"""
+
+import os
+import sys
+import json
+import datetime
+import tempfile
+from StringIO import StringIO
+
+from sqlalchemy.sql.expression import select
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import utils
+from nova_billing.heart import app
+from nova_billing.heart import dump
+from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+
+
+class TestCase(tests.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.db_fd, self.db_filename = tempfile.mkstemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////" + self.db_filename
+        app.config['TESTING'] = True
+        self.app_client = app.test_client()
+        db.create_all()
+        db_api.cache_clear()
+
+    def tearDown(self):
+        db.session.remove()
+        os.close(self.db_fd)
+        os.unlink(self.db_filename)
+        super(TestCase, self).tearDown()
+
+    def populate_db(self):
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps(self.json_load_from_file("rest.tariff.in.json")),
+            content_type=utils.ContentType.JSON)
+        self.assertEqual(res.status_code, 200)
+        for event in self.json_load_from_file("os_amqp.instances.out.json"):
+            res = self.app_client.post(
+                "/event",
+                data=json.dumps(event),
+                content_type=utils.ContentType.JSON)
+            self.assertEqual(res.status_code, 200)
+
+    def table_rows(self):
+        return dict(((model.__table__.name,
+                      db.session.execute(select([model.__table__]).order_by(
+                          *model.__table__.primary_key.columns)).fetchall())
+                     for model in dump.models))
+
+    def test_encode_column(self):
+        values = [None, 5, -3, 2 ** 40]
+        self.assertEqual(dump.decode_column(
+            "i", 4, dump.encode_column("i", values)), values)
+        values = [datetime.datetime(2012, 1, 1, 0, 0, 0, 7), None,
+                  datetime.datetime(1969, 12, 31, 23, 59, 59)]
+        self.assertEqual(dump.decode_column(
+            "t", 3, dump.encode_column("t", values)), values)
+        values = [u"nova/instance", None, u"memory_mb", u"nova/instance"]
+        self.assertEqual(dump.decode_column(
+            "e", 4, dump.encode_column("e", values)), values)
+        values = [u"\u0444", None, u"", u"name"]
+        self.assertEqual(dump.decode_column(
+            "s", 4, dump.encode_column("s", values)), values)
+        values = [0.5, None, -1e100]
+        self.assertEqual(dump.decode_column(
+            "f", 3, dump.encode_column("f", values)), values)
+
+    def test_export_import(self):
+        self.populate_db()
+        bill = self.app_client.get("/bill?time_period=2011").data
+        with app.test_request_context():
+            rows = self.table_rows()
+            self.assertTrue(rows["segment"])
+            dump_file = StringIO()
+            counts = dump.export(dump_file, block_size=7)
+            self.assertEqual(counts, dict(((name, len(value))
+                                           for name, value in rows.items())))
+            dump_file.seek(0)
+            self.assertRaises(dump.DumpError, dump.load, dump_file)
+            db.session.remove()
+
+        db.drop_all()
+        db.create_all()
+        with app.test_request_context():
+            dump_file.seek(0)
+            self.assertEqual(dump.load(dump_file), counts)
+            self.assertEqual(self.table_rows(), rows)
+
+        self.assertEqual(self.app_client.get("/bill?time_period=2011").data,
+                         bill)
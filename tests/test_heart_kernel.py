@@ -0,0 +1,158 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for nova_billing.heart.database.kernel
+"""
+
+import os
+import sys
+import random
+import datetime
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import utils
+from nova_billing.heart.database import kernel
+from nova_billing.heart.database.api import TariffSchedule
+
+
+class Segment(object):
+    def __init__(self, id, rtype, cost, begin_at, end_at):
+        self.id = id
+        self.rtype = rtype
+        self.cost = cost
+        self.begin_at = begin_at
+        self.end_at = end_at
+
+
+class TestCase(tests.TestCase):
+    now = datetime.datetime(2011, 3, 10, 7, 30, 15, 250000)
+
+    def random_time(self, rand):
+        return datetime.datetime(2011, 1, 1) + datetime.timedelta(
+            seconds=rand.randint(0, 80 * 86400),
+            microseconds=rand.randint(0, 999999))
+
+    def make_segments(self, rand, count):
+        segments = []
+        for i in xrange(count):
+            begin_at = self.random_time(rand)
+            end_at = None
+            if rand.random() < 0.8:
+                end_at = begin_at + datetime.timedelta(
+                    seconds=rand.randint(0, 20 * 86400),
+                    microseconds=rand.randint(0, 999999))
+            cost = (-rand.randint(1, 100) if rand.random() < 0.2
+                    else rand.random() * 1000)
+            segments.append(Segment(
+                rand.randint(1, 30), rand.choice(("memory_mb", "local_gb")),
+                cost, begin_at, end_at))
+        return segments
+
+    def make_tariffs(self):
+        return TariffSchedule(
+            {"memory_mb": 3.0, "local_gb": 2.0},
+            [("memory_mb", datetime.datetime(2011, 1, 20, 3), 1.0, 2.0),
+             ("memory_mb", datetime.datetime(2011, 2, 3, 12, 0, 0, 5), 2.0,
+              2.0),
+             ("memory_mb", datetime.datetime(2011, 2, 14), 2.0, 3.0)])
+
+    def reference(self, segments, periods, tariffs):
+        groups = {}
+        for segment in segments:
+            end_at = segment.end_at or self.now
+            for index, (period_start, period_stop) in enumerate(periods):
+                if (period_stop <= segment.begin_at or
+                        end_at <= period_start):
+                    continue
+                if segment.cost < 0:
+                    cost = segment.cost
+                else:
+                    clip_begin = max(segment.begin_at, period_start)
+                    clip_end = min(end_at, period_stop)
+                    cost = (tariffs.charge(segment.rtype, segment.cost,
+                                           segment.begin_at,
+                                           clip_begin, clip_end)
+                            if clip_end > clip_begin else 0.0)
+                group = groups.setdefault((index, segment.id), [0.0])
+                group[0] += cost
+        return sorted(((key, group[0]) for key, group in groups.iteritems()))
+
+    def test_charge(self):
+        rand = random.Random(17)
+        segments = self.make_segments(rand, 2000)
+        tariffs = self.make_tariffs()
+        days = utils.time_buckets(datetime.datetime(2011, 1, 1),
+                                  datetime.datetime(2011, 3, 1), "day")
+        for periods in (
+                zip(days, days[1:]),
+                [(datetime.datetime(2011, 2, 1),
+                  datetime.datetime(2011, 3, 1)),
+                 (datetime.datetime(2011, 1, 1),
+                  datetime.datetime(2012, 1, 1)),
+                 (datetime.datetime(2011, 1, 15),
+                  datetime.datetime(2011, 1, 16))]):
+            expected = self.reference(segments, periods, tariffs)
+            results = []
+            for use_numpy in (False, True):
+                if use_numpy and kernel.numpy is None:
+                    continue
+                cost_kernel = kernel.CostKernel(
+                    periods, tariffs, self.now, use_numpy)
+                results.append(cost_kernel.charge(segments))
+                self.assertEqual(
+                    [(group[:2], group[2]) for group in results[-1]],
+                    expected)
+            # NumPy gives exactly the same groups
+            for result in results[1:]:
+                self.assertEqual(result, results[0])
+
+        # linear costs of adjacent periods add up to the cost of the whole
+        linear = [segment for segment in segments if segment.cost >= 0]
+        whole = kernel.CostKernel(
+            [(days[0], days[-1])], tariffs, self.now, False).charge(linear)
+        by_days = {}
+        for group in kernel.CostKernel(
+                zip(days, days[1:]), tariffs, self.now, False).charge(linear):
+            by_days[group[1]] = by_days.get(group[1], 0.0) + group[2]
+        self.assertEqual(sorted(by_days.keys()),
+                         [group[1] for group in whole])
+        for group in whole:
+            self.assertAlmostEqual(by_days[group[1]], group[2], places=7)
+
+        period_start = datetime.datetime(2011, 1, 10)
+        cost_kernel = kernel.CostKernel(
+            [(period_start, datetime.datetime(2011, 1, 11))],
+            tariffs, self.now, False)
+        begin_at = datetime.datetime(2011, 1, 9, 12)
+        end_at = datetime.datetime(2011, 1, 10, 6)
+        self.assertEqual(
+            cost_kernel.charge([Segment(1, "local_gb", -5, begin_at, None),
+                                Segment(1, "local_gb", 7.0, begin_at,
+                                        end_at)]),
+            [(0, 1, -5.0 + 7.0 * 6 * 3600 / utils.SECONDS_IN_YEAR, -5.0,
+              utils.datetime_to_epoch(begin_at),
+              utils.datetime_to_epoch(begin_at),
+              utils.datetime_to_epoch(end_at))])
+
+
+if __name__ == "__main__":
+    unittest.main()
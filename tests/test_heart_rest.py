@@ -23,6 +23,7 @@ Tests for nova_billing.rest
 import os
 import sys
 import json
+import random
 import datetime
 import unittest
 import stubout
@@ -31,6 +32,8 @@ import tempfile
 import routes
 import webob
 
+from sqlalchemy.sql.expression import literal
+
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import tests
 
@@ -38,7 +41,12 @@ import tests
 from nova_billing import utils
 
 from nova_billing.heart import app
+from nova_billing.heart import rest
+from nova_billing.heart import manage
 from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database.models import Account, Resource, Segment, \
+     RollupMonth, BillRollup
 
 
 class TestCase(tests.TestCase):
@@ -50,8 +58,10 @@ class TestCase(tests.TestCase):
         app.config['TESTING'] = True
         self.app_client = app.test_client()
         db.create_all()
+        db_api.cache_clear()
 
     def tearDown(self):
+        db.session.remove()
         os.close(self.db_fd)
         os.unlink(self.db_filename)
         super(TestCase, self).tearDown()
@@ -97,6 +107,13 @@ class TestCase(tests.TestCase):
         self.assertSuccess(res)
         self.json_check_with_file(json.loads(res.data), 
                          "rest.account.out.json")
+        # an account created by another process bypasses our caches
+        db.engine.execute(Account.__table__.insert(), name="other")
+        res = self.app_client.get("/account")
+        self.assertSuccess(res)
+        self.assertEqual(json.loads(res.data)[-1]["name"], "other")
+        res = self.app_client.get("/bill?time_period=2011")
+        self.assertSuccess(res)
     
     def test_resource(self):
         self.populate_db()
@@ -112,6 +129,203 @@ class TestCase(tests.TestCase):
         self.json_check_with_file(json.loads(res.data), 
             "rest.resource_filter.out.json")
 
+    def test_stream(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.populate_db()
+        self.stubs.Set(rest, "STREAM_CHUNK_SIZE", 100)
+        chunks = list(self.app_client.get("/resource").response)
+        self.assertTrue(len(chunks) > 2)
+        self.json_check_with_file(json.loads("".join(chunks)),
+            "rest.resource.out.json")
+        chunks = list(self.app_client.get("/bill").response)
+        self.assertTrue(len(chunks) > 1)
+        self.json_check_with_file(json.loads("".join(chunks)),
+            "rest.bill.out.json")
+        res = self.app_client.get("/resource?rtype=unknown")
+        self.assertEqual(json.loads(res.data), [])
+
+    def test_pagination(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.populate_db()
+        for i in xrange(4):
+            res = self.app_client.post(
+                "/event",
+                data=json.dumps({"account": "account%s" % i,
+                                 "rtype": "glance/image", "name": str(i),
+                                 "datetime": "2011-01-05T00:00:00Z",
+                                 "linear": 1}),
+                content_type=utils.ContentType.JSON)
+            self.assertSuccess(res)
+        for url in ("/resource", "/account", "/bill"):
+            full = json.loads(self.app_client.get(url).data)
+            if url == "/bill":
+                full = full["bill"]
+            pages = []
+            after_id = None
+            while True:
+                page_url = "%s?limit=2" % url
+                if after_id is not None:
+                    page_url += "&after_id=%s" % after_id
+                page = json.loads(self.app_client.get(page_url).data)
+                if url == "/bill":
+                    page = page["bill"]
+                if not page:
+                    break
+                self.assertTrue(len(page) <= 2)
+                pages.extend(page)
+                after_id = page[-1]["id"]
+            self.assertEqual(pages, full)
+
+        res = self.app_client.get("/resource?fields=id,rtype&limit=1")
+        self.assertEqual(json.loads(res.data),
+                         [{"id": 1, "rtype": "nova/instance"}])
+        res = self.app_client.get("/account?fields=name")
+        self.assertTrue(all((obj.keys() == ["name"]
+                             for obj in json.loads(res.data))))
+        res = self.app_client.get("/bill?fields=id,cost")
+        for account in json.loads(res.data)["bill"]:
+            for obj in account["resources"]:
+                self.assertEqual(sorted(obj.keys()), ["cost", "id"])
+        for url in ("/resource?fields=unknown", "/account?limit=0",
+                    "/bill?after_id=x"):
+            self.assertEqual(self.app_client.get(url).status_code, 400)
+
+    def test_usage(self):
+        self.populate_db()
+        # usage follows migrated tariffs as bills do
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps({"datetime": "2011-01-05T12:00:00Z",
+                             "migrate": True,
+                             "values": {"nova/volume": 63113904.0}}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        for period, granularity in (
+                ("time_period=2011", "month"),
+                ("time_period=2011-01", "day"),
+                ("period_start=2011-01-05T00:00:00Z&"
+                 "period_end=2011-01-06T00:00:00Z", "hour")):
+            url = "?%s" % period
+            bill = json.loads(self.app_client.get("/bill" + url).data)
+            res = self.app_client.get(
+                "/usage%s&granularity=%s" % (url, granularity))
+            self.assertSuccess(res)
+            usage = json.loads(res.data)
+            self.assertEqual(len(usage["buckets"]),
+                             {"month": 12, "day": 31, "hour": 24}[granularity])
+            totals = {}
+            for account in bill["bill"]:
+                for rsrc in account["resources"]:
+                    key = (account["id"], rsrc["rtype"])
+                    totals[key] = totals.get(key, 0) + rsrc["cost"]
+            self.assertTrue(usage["usage"])
+            for series in usage["usage"]:
+                self.assertEqual(len(series["cost"]), len(usage["buckets"]))
+                self.assertAlmostEqual(
+                    sum(series["cost"]),
+                    totals.pop((series["account_id"], series["rtype"])),
+                    places=6)
+            self.assertEqual(totals, {})
+        res = self.app_client.get("/usage?time_period=2011&granularity=week")
+        self.assertEqual(res.status_code, 400)
+        res = self.app_client.get("/usage?time_period=2011&granularity=hour&"
+                                  "account=unknown")
+        self.assertEqual(res.status_code, 404)
+
+    def test_usage_fractions(self):
+        account = db_api.account_get_or_create("systenant")
+        rsrc = db_api.resource_get_or_create(account.id, None,
+                                             "nova/volume", "1")
+        db_api.resource_segment_begin(
+            rsrc, utils.SECONDS_IN_YEAR,
+            datetime.datetime(2011, 1, 10, 0, 0, 0, 500000))
+        db_api.resource_segment_end(
+            rsrc, datetime.datetime(2011, 3, 5, 0, 0, 0, 700000))
+        db.session.commit()
+        period_start = datetime.datetime(2011, 1, 1)
+        period_stop = datetime.datetime(2012, 1, 1)
+        bill = db_api.bill_query(period_start, period_stop).one()
+        for granularity in "month", "day", "hour":
+            edges, series = db_api.usage_on_interval(
+                period_start, period_stop, granularity)
+            usage = series[(account.id, "nova/volume")]
+            self.assertEqual(sum(usage["seconds"]), 54 * 86400)
+            self.assertAlmostEqual(sum(usage["cost"]), bill.cost, places=6)
+
+    def test_bill_periods(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        self.populate_db()
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps({"datetime": "2011-01-05T12:00:00Z",
+                             "migrate": True,
+                             "values": {"nova/volume": 63113904.0}}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        for url, periods in (
+                ("/bill?time_period=2011-01&time_period=2010"
+                 "&time_period=2011", ["2011-01", "2010", "2011"]),
+                ("/bill?time_period=2011-01&step=day",
+                 ["period_start=2011-01-%02dT00:00:00Z&"
+                  "period_end=%s" % (day, "2011-01-%02dT00:00:00Z" % (day + 1)
+                                     if day < 31 else "2011-02-01T00:00:00Z")
+                  for day in xrange(1, 32)])):
+            res = self.app_client.get(url)
+            self.assertSuccess(res)
+            bills = json.loads(res.data)["bills"]
+            self.assertEqual(len(bills), len(periods))
+            for bill, period in zip(bills, periods):
+                if "=" not in period:
+                    period = "time_period=%s" % period
+                expected = self.get_bill_without_rollups("/bill?" + period)
+                self.assertEqual(bill["period_start"],
+                                 expected["period_start"])
+                self.assertBillEqual({"bill": bill["bill"]},
+                                     {"bill": expected["bill"]})
+        res = self.app_client.get("/bill?time_period=2011&step=hour&limit=1")
+        self.assertEqual(len(json.loads(res.data)["bills"]), 8760)
+        res = self.app_client.get("/bill?time_period=2011&step=week")
+        self.assertEqual(res.status_code, 400)
+
+    def test_bill_periods_after_now(self):
+        now = datetime.datetime(2011, 1, 5)
+        account = db_api.account_get_or_create("systenant")
+        for name, cost, begin_at, end_at in (
+                ("1", 10.0, datetime.datetime(2011, 1, 3), None),
+                ("2", -5.0, datetime.datetime(2011, 1, 3), None),
+                ("3", 10.0, datetime.datetime(2011, 1, 10), None),
+                ("4", -5.0, datetime.datetime(2011, 1, 10), None),
+                ("5", 10.0, datetime.datetime(2011, 1, 3),
+                 datetime.datetime(2011, 1, 12))):
+            rsrc = db_api.resource_get_or_create(account.id, None,
+                                                 "nova/volume", name)
+            db_api.resource_segment_begin(rsrc, cost, begin_at)
+            if end_at is not None:
+                db_api.resource_segment_end(rsrc, end_at)
+        db.session.commit()
+        periods = [(datetime.datetime(2011, 1, 1),
+                    datetime.datetime(2011, 2, 1)),
+                   (datetime.datetime(2011, 1, 4),
+                    datetime.datetime(2011, 1, 6)),
+                   (datetime.datetime(2011, 1, 6),
+                    datetime.datetime(2011, 1, 8)),
+                   (datetime.datetime(2011, 1, 8),
+                    datetime.datetime(2011, 1, 15))]
+        bills = db_api.bill_on_periods(periods, now=now)
+        for (period_start, period_stop), bill in zip(periods, bills):
+            expected = {}
+            for row in db_api.bill_query(period_start, period_stop,
+                                         now=now):
+                expected.setdefault(row.account_id, []).append(
+                    db_api.bill_row_to_dict(row))
+            for rsrcs in bill.values() + expected.values():
+                for rsrc in rsrcs:
+                    rsrc["cost"] = round(rsrc["cost"], 6)
+            self.assertEqual(bill, expected)
+        # open segments are not charged on periods after now
+        self.assertEqual([rsrc["name"] for rsrc in bills[2][account.id]],
+                         ["5"])
+
     def test_bill(self):
         self.stubs.Set(utils, "now", self.fake_now)        
         self.populate_db()
@@ -120,3 +334,402 @@ class TestCase(tests.TestCase):
         self.json_check_with_file(json.loads(res.data), 
             "rest.bill.out.json")
         self.stubs.UnsetAll()
+
+    def get_bill_without_rollups(self, url):
+        self.stubs.Set(db_api, "rollup_months", lambda *args: None)
+        self.stubs.Set(db_api, "month_to_date_month", lambda *args: None)
+        res = self.app_client.get(url)
+        self.stubs.UnsetAll()
+        self.assertSuccess(res)
+        return json.loads(res.data)
+
+    def assertBillEqual(self, bill1, bill2):
+        for acc1, acc2 in zip(bill1["bill"], bill2["bill"]):
+            for rsrc in acc1["resources"] + acc2["resources"]:
+                rsrc["cost"] = round(rsrc["cost"], 3)
+        self.assertEqual(bill1, bill2)
+
+    def test_seconds_between(self):
+        rand = random.Random(5)
+        account = db_api.account_get_or_create("systenant")
+        period_start = datetime.datetime(2011, 1, 1)
+        period_stop = datetime.datetime(2011, 7, 1)
+        expected = {}
+        for name in xrange(50):
+            begin_at = period_start + datetime.timedelta(
+                seconds=rand.randint(0, 60 * 86400),
+                microseconds=rand.randint(0, 999999))
+            end_at = begin_at + datetime.timedelta(
+                seconds=rand.randint(0, 60 * 86400),
+                microseconds=rand.randint(0, 999999))
+            # arguments are bind parameters
+            self.assertEqual(
+                db.session.query(db_api._seconds_between(
+                    literal(begin_at), literal(end_at))).scalar(),
+                utils.total_seconds(end_at - begin_at))
+            cost = rand.random() * 1000
+            rsrc = db_api.resource_get_or_create(
+                account.id, None, "nova/volume", str(name))
+            db_api.resource_segment_begin(rsrc, cost, begin_at)
+            db_api.resource_segment_end(rsrc, end_at)
+            expected[rsrc.id] = utils.cost_add(cost, begin_at, end_at)
+        db.session.commit()
+        rows = db_api.bill_query(period_start, period_stop).all()
+        self.assertEqual(len(rows), len(expected))
+        for row in rows:
+            self.assertAlmostEqual(row.cost, expected[row.id], places=9)
+
+    def test_lookup_queries(self):
+        account = db_api.account_get_or_create("systenant")
+        rsrc = db_api.resource_get_or_create(account.id, None,
+                                             "nova/volume", "1")
+        db.session.commit()
+        self.assertEqual(db_api.account_query("systenant").one().id,
+                         account.id)
+        self.assertEqual(db_api.resource_query(
+            account.id, None, "nova/volume", "1").one().id, rsrc.id)
+        self.assertEqual(db_api.resource_find("nova/volume", "1").id,
+                         rsrc.id)
+        self.assertEqual(db_api.resource_find("nova/volume", "2"), None)
+        plans = {}
+        for title, statement in manage.core_queries():
+            plans[title] = [str(list(row)[-1]) for row in
+                            db.engine.execute(manage.explain(statement))]
+        # lookups done on every event are index-driven
+        for title in ("account_get_or_create", "resource_get_or_create",
+                      "resource_find", "resource_segment_end"):
+            self.assertTrue(plans[title])
+            for step in plans[title]:
+                self.assertTrue(step.startswith("SEARCH"), step)
+
+    def test_bill_rollup(self):
+        self.populate_db()
+        res = self.app_client.get("/bill?time_period=2011")
+        self.assertSuccess(res)
+        self.assertBillEqual(json.loads(res.data),
+            self.get_bill_without_rollups("/bill?time_period=2011"))
+
+    def test_bill_rollup_fractions(self):
+        account = db_api.account_get_or_create("systenant")
+        rsrc = db_api.resource_get_or_create(account.id, None,
+                                             "nova/volume", "1")
+        # a second more than the months have when floored separately
+        db_api.resource_segment_begin(
+            rsrc, utils.SECONDS_IN_YEAR,
+            datetime.datetime(2011, 1, 10, 0, 0, 0, 500000))
+        db_api.resource_segment_end(
+            rsrc, datetime.datetime(2011, 3, 5, 0, 0, 0, 700000))
+        db.session.commit()
+        period_start = datetime.datetime(2011, 1, 1)
+        period_stop = datetime.datetime(2012, 1, 1)
+        rows = list(db_api.bill_rows(period_start, period_stop))
+        self.assertEqual(RollupMonth.query.count(), 12)
+        self.assertEqual(
+            [row.cost for row in rows],
+            [row.cost for row in db_api.bill_query(period_start,
+                                                   period_stop)])
+        self.assertEqual(rows[0].cost, 54 * 86400.0)
+
+    def test_bill_rollup_invalidate(self):
+        self.populate_db()
+        res = self.app_client.get("/bill?time_period=2011-01")
+        self.assertSuccess(res)
+        res = self.app_client.post(
+            "/event",
+            data=json.dumps({"account": "systenant",
+                             "rtype": "nova/volume",
+                             "name": 3,
+                             "fixed": None,
+                             "datetime": "2011-01-20T00:00:00Z"}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        res = self.app_client.get("/bill?time_period=2011-01")
+        self.assertSuccess(res)
+        bill = json.loads(res.data)
+        self.assertBillEqual(bill,
+            self.get_bill_without_rollups("/bill?time_period=2011-01"))
+        volume = [rsrc for rsrc in bill["bill"][0]["resources"]
+                  if rsrc["name"] == "3"][0]
+        self.assertEqual(volume["destroyed_at"], "2011-01-20T00:00:00Z")
+
+    def test_bill_rollup_invalidate_crossing(self):
+        self.populate_db()
+        res = self.app_client.get("/bill?time_period=2011-01")
+        self.assertSuccess(res)
+        rollup_count = BillRollup.query.count()
+        # the segment of the volume begins in January
+        res = self.app_client.post(
+            "/event",
+            data=json.dumps({"account": "systenant",
+                             "rtype": "nova/volume",
+                             "name": 3,
+                             "fixed": None,
+                             "datetime": "2011-03-05T00:00:00Z"}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        # bills of other resources are kept
+        self.assertEqual(RollupMonth.query.count(), 1)
+        self.assertEqual(BillRollup.query.count(), rollup_count)
+        res = self.app_client.get("/bill?time_period=2011-01")
+        self.assertSuccess(res)
+        bill = json.loads(res.data)
+        self.assertBillEqual(bill,
+            self.get_bill_without_rollups("/bill?time_period=2011-01"))
+        volume = [rsrc for rsrc in bill["bill"][0]["resources"]
+                  if rsrc["name"] == "3"][0]
+        self.assertEqual(volume["destroyed_at"], "2011-03-05T00:00:00Z")
+
+    def test_bill_month_to_date(self):
+        month = utils.month_start(datetime.datetime.utcnow())
+
+        def post_events(events):
+            for event in events:
+                event = dict(event)
+                event.setdefault("account", "systenant")
+                event["datetime"] = utils.datetime_to_str(
+                    month + datetime.timedelta(seconds=event["datetime"]))
+                res = self.app_client.post(
+                    "/event",
+                    data=json.dumps(event),
+                    content_type=utils.ContentType.JSON)
+                self.assertSuccess(res)
+
+        def check_bill():
+            res = self.app_client.get("/bill")
+            self.assertSuccess(res)
+            self.assertBillEqual(json.loads(res.data),
+                self.get_bill_without_rollups("/bill"))
+
+        post_events([
+            {"rtype": "nova/volume", "name": 1, "linear": 10, "datetime": -3600},
+            {"rtype": "nova/volume", "name": 1, "linear": 20, "datetime": 1},
+            {"rtype": "nova/volume", "name": 2, "fixed": 5, "datetime": 2},
+        ])
+        check_bill()
+        post_events([
+            {"rtype": "nova/volume", "name": 1, "linear": 30, "datetime": 3},
+            {"rtype": "nova/volume", "name": 2, "fixed": None, "datetime": 4},
+            {"rtype": "nova/volume", "name": 3, "linear": 1, "datetime": 5},
+            {"rtype": "nova/volume", "name": 4, "linear": 2, "datetime": 6,
+             "account": "tenant"},
+            {"rtype": "nova/volume", "name": 4, "linear": 3, "datetime": 7,
+             "account": "tenant"},
+            {"rtype": "nova/volume", "name": 5, "linear": 4, "datetime": 8},
+        ])
+        check_bill()
+        # counters and open segments are merged without loading them at once
+        rows = db_api.bill_rows(month, utils.add_months(month, 1))
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual([(row.account_id, row.id) for row in rows],
+                         [(row.account_id, row.id) for row in db_api.bill_query(
+                             month, utils.add_months(month, 1))])
+
+    def test_counter_add(self):
+        month = datetime.datetime(2011, 1, 1)
+        now = datetime.datetime(2011, 1, 20)
+        account = db_api.account_get_or_create("systenant")
+        rsrc = db_api.resource_get_or_create(account.id, None,
+                                             "nova/volume", "1")
+        # counters of a month that is not seeded yet are not updated
+        db.session.add(db_api.CounterMonth(month=month, seeded=False))
+        db_api.resource_segment_begin(rsrc, utils.SECONDS_IN_YEAR,
+                                      datetime.datetime(2011, 1, 2))
+        db_api.counter_add(account.id, rsrc.id, rsrc.rtype,
+                           rsrc.current_segment_id,
+                           datetime.datetime(2011, 1, 3), now)
+        self.assertEqual(db_api.MonthCounter.query.count(), 0)
+        db_api.resource_segment_end(rsrc, datetime.datetime(2011, 1, 3))
+        db.session.commit()
+        db_api.counter_refresh(month)
+        # the last segment is closed by a late event before its beginning
+        for day, cost, days in ((2, utils.SECONDS_IN_YEAR, 1),
+                                (5, utils.SECONDS_IN_YEAR * 2, 1),
+                                (10, utils.SECONDS_IN_YEAR, -1)):
+            db_api.resource_segment_begin(
+                rsrc, cost, month + datetime.timedelta(days=day))
+            end_at = month + datetime.timedelta(days=day + days)
+            db_api.counter_add(account.id, rsrc.id, rsrc.rtype,
+                               rsrc.current_segment_id, end_at, now)
+            db.session.execute(db_api.segment_end_statement(
+                rsrc.current_segment_id, end_at))
+            rsrc.current_segment_id = None
+        db.session.commit()
+        counter = db_api.MonthCounter.query.get((month, rsrc.id))
+        self.assertAlmostEqual(counter.cost, 86400.0 * 4)
+        self.assertEqual(counter.min_start, datetime.datetime(2011, 1, 2))
+        self.assertEqual(counter.max_start, datetime.datetime(2011, 1, 11))
+        self.assertEqual(counter.max_stop, datetime.datetime(2011, 1, 10))
+        row = db_api.bill_query(month, utils.add_months(month, 1),
+                                now=now, closed=True).one()
+        self.assertAlmostEqual(counter.cost, row.cost)
+
+    def test_events(self):
+        self.stubs.Set(utils, "now", self.fake_now)
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps(self.json_load_from_file("rest.tariff.in.json")),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        events = []
+        for filename in ("os_amqp.instances.out.json",
+                         "os_amqp.local_volumes.out.json"):
+            events.extend(self.json_load_from_file(filename))
+        events.reverse()
+        events.append({"rtype": "nova/volume"})
+        res = self.app_client.post(
+            "/events",
+            data=json.dumps(events),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        results = json.loads(res.data)
+        self.assertEqual(len(results), len(events))
+        self.assertEqual([result["status"] for result in results],
+                         [200] * (len(events) - 1) + [400])
+        res = self.app_client.get("/bill")
+        self.assertSuccess(res)
+
+        def bill_items(bill):
+            return sorted([
+                (rsrc["rtype"], rsrc["name"], rsrc["cost"],
+                 rsrc["created_at"], rsrc["destroyed_at"])
+                for acc in bill["bill"]
+                for rsrc in acc["resources"]])
+
+        self.assertEqual(bill_items(json.loads(res.data)),
+            bill_items(self.json_load_from_file("rest.bill.out.json")))
+
+    def test_events_isolated(self):
+        process_event = rest.process_event
+
+        def fake_process_event(rsrc, *args):
+            process_event(rsrc, *args)
+            if rsrc.get("name") == "broken":
+                raise RuntimeError("broken")
+
+        self.stubs.Set(rest, "process_event", fake_process_event)
+        events = [
+            {"account": "1", "rtype": "nova/volume", "name": "1",
+             "linear": 1, "datetime": "2011-01-01T00:00:00Z"},
+            {"account": "1", "rtype": "nova/volume", "name": "2",
+             "linear": "oops", "datetime": "2011-01-01T00:00:00Z"},
+            {"account": "2", "rtype": "nova/volume", "name": "3",
+             "fixed": 1, "datetime": "2011-01-01T00:00:00Z",
+             "children": [{"rtype": "local_gb", "linear": [1]}]},
+            {"account": "3", "rtype": "nova/volume", "name": "broken",
+             "linear": 1, "datetime": "2011-01-02T00:00:00Z"},
+            {"account": "4", "rtype": "nova/volume", "name": "4",
+             "fixed": None, "datetime": "2011-01-03T00:00:00Z"},
+        ]
+        res = self.app_client.post(
+            "/events",
+            data=json.dumps(events),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        results = json.loads(res.data)
+        self.assertEqual([result["status"] for result in results],
+                         [200, 400, 400, 500, 200])
+        self.assertEqual(results[1]["error"], "linear must be a number")
+        self.assertEqual(sorted((rsrc.name for rsrc in Resource.query)),
+                         ["1", "4"])
+        self.assertEqual(sorted((acc.name for acc in Account.query)),
+                         ["1", "4"])
+        res = self.app_client.post(
+            "/event",
+            data=json.dumps(events[1]),
+            content_type=utils.ContentType.JSON)
+        self.assertEqual(res.status_code, 400)
+
+    def test_event_single_commit(self):
+        commits = []
+        commit = db.session.commit
+
+        def fake_commit():
+            commits.append(True)
+            commit()
+
+        self.stubs.Set(db.session, "commit", fake_commit)
+        event = self.json_load_from_file("os_amqp.instances.out.json")[0]
+        res = self.app_client.post(
+            "/event",
+            data=json.dumps(event),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        self.assertEqual(len(commits), 1)
+        self.stubs.UnsetAll()
+        res = self.app_client.get("/resource")
+        self.assertSuccess(res)
+        self.assertEqual(len(json.loads(res.data)), 4)
+
+    def test_current_segment(self):
+        self.populate_db()
+        for rsrc in Resource.query.all():
+            segments = (Segment.query.filter_by(resource_id=rsrc.id).
+                        order_by(Segment.id).all())
+            open_ids = [seg.id for seg in segments if seg.end_at is None]
+            self.assertEqual(open_ids,
+                             [rsrc.current_segment_id]
+                             if rsrc.current_segment_id else [])
+            for seg, next_seg in zip(segments, segments[1:]):
+                self.assertTrue(seg.end_at <= next_seg.begin_at)
+
+    def test_cache(self):
+        self.populate_db()
+        stats = json.loads(self.app_client.get("/cache").data)
+        self.assertTrue(stats["resource"]["hits"] > 0)
+        self.assertTrue(stats["resource"]["size"] > 0)
+        tariff_version = stats["tariff"]["version"]
+
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps({"datetime": "2012-01-01T00:00:00Z",
+                             "values": {"nova/cpu": 2}}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        stats = json.loads(self.app_client.get("/cache").data)
+        self.assertEqual(stats["tariff"]["version"], tariff_version + 1)
+        self.assertEqual(
+            json.loads(self.app_client.get("/tariff").data)["nova/cpu"], 2)
+
+    def test_tariff_migrate(self):
+        self.populate_db()
+        segment_count = Segment.query.count()
+
+        def volume_costs(period):
+            res = self.app_client.get("/bill?time_period=%s" % period)
+            self.assertSuccess(res)
+            return dict(((rsrc["id"], rsrc["cost"])
+                         for acc in json.loads(res.data)["bill"]
+                         for rsrc in acc["resources"]
+                         if rsrc["rtype"] == "nova/volume"))
+
+        before_2011 = volume_costs("2011")
+        before_2012 = volume_costs("2012-01")
+        self.assertTrue(before_2012)
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps({"datetime": "2012-01-01T00:00:00Z",
+                             "migrate": True,
+                             "values": {"nova/volume": 63113904.0}}),
+            content_type=utils.ContentType.JSON)
+        self.assertSuccess(res)
+        self.assertEqual(Segment.query.count(), segment_count)
+        self.assertEqual(volume_costs("2011"), before_2011)
+        after_2012 = volume_costs("2012-01")
+        self.assertEqual(sorted(after_2012.keys()), sorted(before_2012.keys()))
+        for key, value in before_2012.iteritems():
+            self.assertAlmostEqual(after_2012[key], value * 2)
+        # bills of single accounts adjust only their own resources
+        res = self.app_client.get("/bill?time_period=2012-01")
+        for account in json.loads(res.data)["bill"]:
+            res = self.app_client.get("/bill?time_period=2012-01&account=%s" %
+                                      account["name"])
+            self.assertSuccess(res)
+            self.assertEqual(json.loads(res.data)["bill"], [account])
+
+        res = self.app_client.post(
+            "/tariff",
+            data=json.dumps({"datetime": "2011-12-01T00:00:00Z",
+                             "migrate": True,
+                             "values": {"nova/volume": 1.0}}),
+            content_type=utils.ContentType.JSON)
+        self.assertEqual(res.status_code, 400)
@@ -0,0 +1,57 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for nova_billing.heart.server
+"""
+
+import os
+import sys
+
+import eventlet
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing.heart.server import TimeoutMiddleware
+
+
+class TestCase(tests.TestCase):
+
+    def call(self, app, timeout):
+        responses = []
+
+        def start_response(status, headers, exc_info=None):
+            responses.append(status)
+
+        body = TimeoutMiddleware(app, timeout)(
+            {"REQUEST_METHOD": "GET", "PATH_INFO": "/bill"},
+            start_response)
+        return responses[0], "".join(body)
+
+    def test_timeout(self):
+        def slow_app(environ, start_response):
+            eventlet.sleep(0.1)
+            start_response("200 OK", [])
+            return ["done"]
+
+        status, body = self.call(slow_app, 0.01)
+        self.assertEqual(status, "503 Service Unavailable")
+        status, body = self.call(slow_app, 0)
+        self.assertEqual((status, body), ("200 OK", "done"))
@@ -0,0 +1,164 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for nova_billing.migrate
+"""
+
+import os
+import sys
+import json
+import urlparse
+import datetime
+import tempfile
+
+from sqlalchemy import create_engine
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import migrate
+from nova_billing.heart import app
+from nova_billing.heart.database import db
+from nova_billing.heart.database import api as db_api
+from nova_billing.heart.database.models import Resource, Segment
+
+
+class TestCase(tests.TestCase):
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.db_fd, self.db_filename = tempfile.mkstemp()
+        self.old_db_fd, self.old_db_filename = tempfile.mkstemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////" + self.db_filename
+        app.config['TESTING'] = True
+        self.context = app.test_request_context()
+        self.context.push()
+        db.create_all()
+        db_api.cache_clear()
+        self.stubs.Set(migrate.Progress, "add", lambda self, count: None)
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        for fd, filename in ((self.db_fd, self.db_filename),
+                             (self.old_db_fd, self.old_db_filename)):
+            os.close(fd)
+            os.unlink(filename)
+        super(TestCase, self).tearDown()
+
+    def create_old_db(self):
+        url = "sqlite:////" + self.old_db_filename
+        engine = create_engine(url)
+        engine.execute(
+            "create table billing_instance_info (id integer primary key,"
+            " instance_id integer, project_id varchar(255),"
+            " local_gb integer, memory_mb integer, vcpus integer)")
+        engine.execute(
+            "create table billing_instance_segment (id integer primary key,"
+            " instance_info_id integer, segment_type integer,"
+            " begin_at varchar(32), end_at varchar(32))")
+        for i in xrange(1, 6):
+            engine.execute(
+                "insert into billing_instance_info values (?, ?, ?, ?, ?, ?)",
+                i, 100 + i, "project%s" % (i % 2), 10, 512 * i, 1)
+            engine.execute(
+                "insert into billing_instance_segment values (?, ?, ?, ?, ?)",
+                2 * i, i, 0, "2011-01-0%s 00:00:00" % i,
+                "2011-01-0%s 00:00:00" % (i + 1))
+            engine.execute(
+                "insert into billing_instance_segment values (?, ?, ?, ?, ?)",
+                2 * i + 1, i, 0, "2011-01-0%s 00:00:00" % (i + 1),
+                None if i % 2 else "2011-01-0%s 00:00:00" % (i + 2))
+        return url
+
+    def test_migrate_instances(self):
+        url = self.create_old_db()
+        checkpoint_path = self.db_filename + ".checkpoint"
+        try:
+            checkpoint = migrate.Checkpoint(checkpoint_path, url)
+            migrate.migrate_instances(url, 2, checkpoint)
+            self.assertEqual(checkpoint.position, 5)
+            self.assertEqual(Resource.query.count(), 20)
+            self.assertEqual(Segment.query.count(), 35)
+            instance = Resource.query.filter_by(
+                rtype="nova/instance", name="101").one()
+            segment = Segment.query.filter_by(resource_id=instance.id).one()
+            self.assertEqual((segment.begin_at, segment.end_at),
+                             (datetime.datetime(2011, 1, 1), None))
+            memory = Resource.query.filter_by(
+                parent_id=instance.id, rtype="memory_mb").one()
+            self.assertEqual(memory.current_segment_id,
+                             Segment.query.filter_by(
+                                 resource_id=memory.id, end_at=None).one().id)
+
+            # a run interrupted after a commit, but before saving the position
+            checkpoint.save(2)
+            checkpoint = migrate.Checkpoint(checkpoint_path, url)
+            self.assertEqual(checkpoint.position, 2)
+            migrate.migrate_instances(url, 2, checkpoint)
+            self.assertEqual(Resource.query.count(), 20)
+            self.assertEqual(Segment.query.count(), 35)
+            self.assertRaises(ValueError, migrate.Checkpoint,
+                              checkpoint_path, "sqlite://")
+        finally:
+            if os.path.exists(checkpoint_path):
+                os.unlink(checkpoint_path)
+
+    def test_resource_get_or_create_many(self):
+        # more names and parents than fit in a single IN list
+        keys = [(1, None, "nova/instance", i) for i in xrange(1200)]
+        instances = db_api.resource_get_or_create_many(keys)
+        self.assertEqual(len(set(instances.values())), 1200)
+        child_keys = [(1, parent_id, "memory_mb", None)
+                      for parent_id in instances.itervalues()]
+        children = db_api.resource_get_or_create_many(child_keys)
+        self.assertEqual(len(set(children.values())), 1200)
+        expected = dict(instances)
+        expected.update(children)
+        self.assertEqual(db_api.resource_get_or_create_many(keys + child_keys),
+                         expected)
+        self.assertEqual(Resource.query.count(), 2400)
+
+    def test_migrate_images(self):
+        images = [{"id": str(i),
+                   "owner": "project%s" % (i % 2) if i != 3 else None,
+                   "size": 1024 ** 3,
+                   "created_at": "2011-01-0%sT00:00:00" % i,
+                   "deleted_at": "2011-01-09T00:00:00" if i == 2 else None}
+                  for i in xrange(1, 6)]
+        requests = []
+
+        def fake_get(glance_client, path):
+            params = dict(urlparse.parse_qsl(urlparse.urlparse(path).query))
+            requests.append(params.get("marker"))
+            self.assertEqual(params["changes-since"], "1970-01-01T00:00:00")
+            page = [img for img in images
+                    if img["id"] > params.get("marker", "")]
+            return json.dumps({"images": page[:int(params["limit"])]})
+
+        self.stubs.Set(migrate.client.RestClient, "get", fake_get)
+        checkpoint = migrate.Checkpoint(None, "http://glance")
+        migrate.migrate_images("http://glance", 2, checkpoint)
+        self.assertEqual(requests, [None, "2", "4", "5"])
+        self.assertEqual(checkpoint.position, "5")
+        self.assertEqual(Resource.query.filter_by(
+            rtype="glance/image").count(), 4)
+        image = Resource.query.filter_by(name="2").one()
+        segment = Segment.query.filter_by(resource_id=image.id).one()
+        self.assertEqual(segment.end_at, datetime.datetime(2011, 1, 9))
@@ -25,6 +25,8 @@ import os
 import sys
 import json
 import datetime
+import shutil
+import tempfile
 import unittest
 import stubout
 
@@ -32,8 +34,18 @@ import stubout
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import tests
 
+from nova_billing.client import HttpError
 from nova_billing.os_amqp import amqp
 from nova_billing.os_amqp import instances
+from nova_billing.os_amqp import spool
+
+
+class FakeMessage(object):
+    delivery_info = {"routing_key": "compute.fake"}
+    acked = 0
+
+    def ack(self):
+        self.acked += 1
 
 
 class TestCase(tests.TestCase):
@@ -43,13 +55,21 @@ class TestCase(tests.TestCase):
     def setUp(self):
         super(TestCase, self).setUp()
         self.stubs.Set(amqp.Service, "__init__", lambda self: None)
+        self.messages = []
+        instances.instance_flavors.clear()
+
+    def process_message(self, service, body):
+        message = FakeMessage()
+        self.messages.append(message)
+        service.process_message(body, message)
 
     def fake_get_event_datetime(self, body):
         self.day += 1
         return datetime.datetime(2011, 1, self.day)
 
-    def fake_event(self, req):
-        self.requests.append(req)
+    def fake_events(self, reqs):
+        self.requests.extend(reqs)
+        return [{"status": 200} for req in reqs]
 
     def fake_get_instance_flavor(self, instance_id):
         return self.flavor
@@ -58,8 +78,10 @@ class TestCase(tests.TestCase):
         self.day = 1
         self.requests = []
         service = amqp.Service()
+        service.batch = []
+        service.spool = None
         
-        self.stubs.Set(service.billing_heart, "event", self.fake_event)
+        self.stubs.Set(service.billing_heart, "events", self.fake_events)
         self.stubs.Set(service, "get_event_datetime", self.fake_get_event_datetime)
         self.stubs.Set(instances, "get_instance_flavor", self.fake_get_instance_flavor)
 
@@ -68,17 +90,20 @@ class TestCase(tests.TestCase):
         any_instance_body = json_in["any"]
         self.flavor = run_instance_body["args"]["request_spec"]["instance_type"]
 
-        service.process_event(run_instance_body, None)
+        self.process_message(service, run_instance_body)
         for method in ("stop_instance", "start_instance",
                        "pause_instance", "unpause_instance",
                        "suspend_instance", "resume_instance",
                        "terminate_instance"):
             any_instance_body["method"] = method
-            service.process_event(any_instance_body, None)
-        service.process_event(run_instance_body, None)
+            self.process_message(service, any_instance_body)
+        self.process_message(service, run_instance_body)
         for method in ("stop_instance", "start_instance"):
             any_instance_body["method"] = method
-            service.process_event(any_instance_body, None)
+            self.process_message(service, any_instance_body)
+        service.flush()
+        self.assertEqual([message.acked for message in self.messages],
+                         [1] * len(self.messages))
 
         self.stubs.UnsetAll()
         self.json_check_with_file(self.requests, 
@@ -88,16 +113,265 @@ class TestCase(tests.TestCase):
         self.day = 1
         self.requests = []
         service = amqp.Service()
+        service.batch = []
+        service.spool = None
         
-        self.stubs.Set(service.billing_heart, "event", self.fake_event)
+        self.stubs.Set(service.billing_heart, "events", self.fake_events)
         self.stubs.Set(service, "get_event_datetime", self.fake_get_event_datetime)
         self.stubs.Set(instances, "get_instance_flavor", self.fake_get_instance_flavor)
 
         json_in = self.json_load_from_file("os_amqp.local_volumes.in.json")
         
         for event in json_in:
-            service.process_event(event, None)
+            self.process_message(service, event)
+        service.flush()
+        self.assertEqual([message.acked for message in self.messages],
+                         [1] * len(self.messages))
 
         self.stubs.UnsetAll()
         self.json_check_with_file(self.requests,
             "os_amqp.local_volumes.out.json")
+
+    def test_amqp_flush_retry(self):
+        self.requests = []
+        service = amqp.Service()
+        service.batch = []
+        service.spool = None
+        failures = [amqp.socket.error("connection refused")]
+
+        def fake_events(reqs):
+            self.assertEqual([message.acked for message in self.messages],
+                             [0] * len(self.messages))
+            if failures:
+                raise failures.pop()
+            return self.fake_events(reqs)
+
+        self.stubs.Set(service.billing_heart, "events", fake_events)
+        self.stubs.Set(amqp.time, "sleep", lambda seconds: None)
+        self.process_message(service, {"method": "unknown"})
+        self.process_message(service, {
+            "method": "create_local_volume",
+            "_context_project_id": "1",
+            "args": {"volume_id": 1, "size": 10}})
+        service.flush()
+        self.assertEqual(failures, [])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual([message.acked for message in self.messages], [1, 1])
+
+    def test_amqp_flush_drop(self):
+        self.requests = []
+        service = amqp.Service()
+        service.batch = []
+        service.spool = None
+        attempts = []
+        dropped = []
+
+        def fake_events(reqs):
+            attempts.append(reqs)
+            # the Heart fails every batch with volume 2
+            if [req for req in reqs if req["name"] == 2]:
+                raise HttpError(500, "internal server error")
+            return self.fake_events(reqs)
+
+        self.stubs.Set(service.billing_heart, "events", fake_events)
+        self.stubs.Set(service, "drop_events",
+                       lambda reqs, ex: dropped.extend(reqs))
+        self.stubs.Set(amqp.time, "sleep", lambda seconds: None)
+        for volume_id in 1, 2, 3:
+            self.process_message(service, {
+                "method": "create_local_volume",
+                "_context_project_id": "1",
+                "args": {"volume_id": volume_id, "size": 10}})
+        service.flush()
+        # the batch, its half with volumes 2 and 3, and volume 2 alone
+        self.assertEqual(len(attempts),
+                         3 * (amqp.global_conf.amqp_max_retries + 1) + 2)
+        self.assertEqual([req["name"] for req in self.requests], [1, 3])
+        self.assertEqual([req["name"] for req in dropped], [2])
+        self.assertEqual([message.acked for message in self.messages],
+                         [1, 1, 1])
+
+    def test_amqp_spool(self):
+        self.requests = []
+        service = amqp.Service()
+        service.batch = []
+        spool_dir = tempfile.mkdtemp()
+        try:
+            service.spool = spool.Spool(spool_dir)
+            heart_up = []
+
+            def fake_events(reqs):
+                if not heart_up:
+                    raise amqp.socket.error("connection refused")
+                return self.fake_events(reqs)
+
+            self.stubs.Set(service.billing_heart, "events", fake_events)
+            body = {"method": "create_local_volume",
+                    "_context_project_id": "1",
+                    "args": {"size": 10}}
+            for volume_id in 1, 2, 3:
+                body["args"]["volume_id"] = volume_id
+                self.process_message(service, body)
+                service.flush()
+                # the heart is back, but the spool must be sent first
+                heart_up.append(True)
+            self.assertEqual(self.requests, [])
+            self.assertEqual([message.acked for message in self.messages],
+                             [1, 1, 1])
+            service.replay_spool()
+            self.assertEqual([req["name"] for req in self.requests],
+                             [1, 2, 3])
+            self.assertTrue(service.spool.empty())
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_amqp_spool_reject(self):
+        self.requests = []
+        service = amqp.Service()
+        spool_dir = tempfile.mkdtemp()
+        try:
+            service.spool = spool.Spool(spool_dir)
+            service.spool.append([{"name": 1}, {"name": "bad"}])
+            service.spool.append([{"name": 2}])
+
+            def fake_events(reqs):
+                if [req for req in reqs if req["name"] == "bad"]:
+                    raise HttpError(500, "internal server error")
+                return self.fake_events(reqs)
+
+            self.stubs.Set(service.billing_heart, "events", fake_events)
+            self.stubs.Set(amqp.time, "sleep", lambda seconds: None)
+            service.replay_spool()
+            self.assertEqual(self.requests, [{"name": 1}, {"name": 2}])
+            self.assertTrue(service.spool.empty())
+            with open(os.path.join(spool_dir, "00000001.rejected")) as f:
+                self.assertEqual(json.loads(f.read()), {"name": "bad"})
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def test_flavor_cache(self):
+        class FakeFlavor(object):
+            def __init__(self, id, name, ram):
+                self.id, self.name, self.ram = id, name, ram
+                self.disk = 10
+                self.vcpus = 1
+
+        class FakeServer(object):
+            flavor = {"id": "2"}
+
+        calls = []
+        flavors = [FakeFlavor(1, "m1.tiny", 512),
+                   FakeFlavor(2, "m1.small", 2048)]
+
+        def fake_list():
+            calls.append("list")
+            return flavors
+
+        def fake_flavor_get(flavor_id):
+            calls.append("flavor")
+            return FakeFlavor(int(flavor_id), "m1.new", 4096)
+
+        def fake_server_get(instance_id):
+            calls.append("server")
+            return FakeServer()
+
+        now = [1000.0]
+        nova_client = instances.nova_client
+        self.stubs.Set(nova_client.flavors, "list", fake_list)
+        self.stubs.Set(nova_client.flavors, "get", fake_flavor_get)
+        self.stubs.Set(nova_client.servers, "get", fake_server_get)
+        self.stubs.Set(instances.time, "time", lambda: now[0])
+        cache = instances.FlavorCache(60)
+        self.stubs.Set(instances, "flavor_cache", cache)
+        self.stubs.Set(instances, "instance_flavor_stats",
+                       {"hits": 0, "misses": 0})
+
+        self.assertEqual(instances.get_flavor(1)["memory_mb"], 512)
+        self.assertEqual(instances.get_flavor("2")["name"], "m1.small")
+        self.assertEqual(instances.get_flavor(3)["name"], "m1.new")
+        self.assertEqual(instances.get_flavor(3)["memory_mb"], 4096)
+        self.assertEqual(calls, ["list", "flavor"])
+        now[0] += 60
+        flavors[0].ram = 1024
+        self.assertEqual(instances.get_flavor(1)["memory_mb"], 1024)
+        self.assertEqual(calls, ["list", "flavor", "list"])
+
+        del calls[:]
+        self.assertEqual(instances.get_instance_flavor("a")["vcpus"], 1)
+        self.assertEqual(instances.get_instance_flavor("a")["vcpus"], 1)
+        self.assertEqual(calls, ["server"])
+        stats = instances.cache_stats()
+        self.assertEqual(stats["flavor"]["hits"], 5)
+        self.assertEqual(stats["flavor"]["misses"], 1)
+        self.assertEqual(stats["instance"],
+                         {"hits": 1, "misses": 1, "size": 1, "hit_rate": 0.5})
+
+        # remembered flavors expire and are forgotten on resize
+        self.stubs.Set(instances.global_conf, "flavor_cache_ttl", 60)
+        now[0] += 60
+        instances.get_instance_flavor("a")
+        self.assertEqual(calls, ["server", "server", "list"])
+        FakeServer.flavor = {"id": "1"}
+        self.assertEqual(instances.create_heart_request(
+            "finish_resize", {"args": {"instance_uuid": "a"}}), None)
+        self.assertEqual(instances.get_instance_flavor("a")["name"],
+                         "m1.tiny")
+        self.assertEqual(calls, ["server", "server", "list", "server"])
+
+    def test_amqp_workers(self):
+        service = amqp.Service()
+        service.batch = []
+        service.workers = [amqp.eventlet.queue.LightQueue()
+                           for i in xrange(4)]
+        for queue in service.workers:
+            amqp.eventlet.spawn_n(service.work, queue)
+        self.assertEqual(
+            amqp.get_resource_key({"args": {"instance_id": 7}}), 7)
+        self.assertEqual(amqp.get_resource_key({"method": "unknown"}), None)
+
+        def fake_create_heart_request(body, message):
+            # yield to other workers in the middle of translation
+            amqp.eventlet.sleep(0.001 * (body["seq"] % 3))
+            return body
+
+        self.stubs.Set(service, "create_heart_request",
+                       fake_create_heart_request)
+        for seq in xrange(40):
+            self.process_message(service, {
+                "seq": seq, "args": {"volume_id": seq % 5}})
+        while len(service.batch) < 40:
+            amqp.eventlet.sleep(0.01)
+        for volume_id in xrange(5):
+            self.assertEqual(
+                [req["seq"] for req, message in service.batch
+                 if req["args"]["volume_id"] == volume_id],
+                range(volume_id, 40, 5))
+
+        # messages handled after reconnection are dropped
+        service.generation += 1
+        service.batch = []
+        service.workers[0].put(({"seq": 0}, FakeMessage(), 0))
+        amqp.eventlet.sleep(0.01)
+        self.assertEqual(service.batch, [])
+
+    def test_spool(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            spool1 = spool.Spool(spool_dir, segment_size=20)
+            spool1.append([{"i": 0}, {"i": 1}])
+            spool1.append([{"i": 2}])
+            spool1.append([{"i": 3}])
+            self.assertFalse(spool1.empty())
+            requests, position = spool1.read(3)
+            self.assertEqual(requests, [{"i": 0}, {"i": 1}, {"i": 2}])
+            spool1.commit(position)
+            spool1.close()
+
+            spool2 = spool.Spool(spool_dir, segment_size=20)
+            requests, position = spool2.read(10)
+            self.assertEqual(requests, [{"i": 3}])
+            spool2.commit(position)
+            self.assertTrue(spool2.empty())
+            self.assertEqual(len(spool2.segments()), 1)
+        finally:
+            shutil.rmtree(spool_dir)
@@ -0,0 +1,136 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Nova Billing
+#    Copyright (C) GridDynamics Openstack Core Team, GridDynamics
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for nova_billing.os_glance
+"""
+
+import os
+import sys
+import json
+
+import webob
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tests
+
+from nova_billing import os_glance
+from nova_billing.client import BillingHeartClient, HttpError
+
+
+class FakeHeart(BillingHeartClient):
+    def __init__(self, failures=0, status=503, broken=()):
+        self.failures = failures
+        self.status = status
+        # the Heart fails every request with these names
+        self.broken = broken
+        self.requests = []
+
+    def events(self, requests):
+        if self.failures:
+            self.failures -= 1
+            raise HttpError(self.status, "unavailable")
+        if [request for request in requests
+            if request["name"] in self.broken]:
+            raise HttpError(500, "internal server error")
+        self.requests.append(requests)
+        return [{"status": 200} for request in requests]
+
+
+class TestCase(tests.TestCase):
+
+    def make_sender(self, heart, queue_size=10, batch_size=2):
+        sender = os_glance.EventSender(heart, queue_size, batch_size)
+        # do not start the sender thread
+        sender.thread_pid = os.getpid()
+        return sender
+
+    def test_filter(self):
+        def glance_app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "application/json")])
+            return [json.dumps({"image": {"id": "1", "size": 1024 ** 3}})]
+
+        sender = self.make_sender(FakeHeart())
+        self.stubs.Set(os_glance.GlanceBillingFilter, "sender", sender)
+        app = os_glance.GlanceBillingFilter(glance_app)
+        for method, path in (("POST", "/images"), ("GET", "/images/1"),
+                             ("DELETE", "/images/1")):
+            req = webob.Request.blank(path, method=method,
+                                      headers={"X-Tenant": "tenant"})
+            self.assertEqual(req.get_response(app).status_int, 200)
+        requests = sender.next_batch()
+        self.assertEqual(
+            [(request["name"], request.get("linear"), request.get("fixed", 0))
+             for request in requests],
+            [("1", 1.0, 0), ("1", None, None)])
+        self.assertEqual(sender.stats()["queue_depth"], 0)
+
+    def test_load_image_metadata(self):
+        def stream():
+            yield json.dumps({"image": {"id": "1", "size": 1}})
+
+        metadata = {"image": {"id": "1", "size": 1}}
+        resp = webob.Response(json.dumps(metadata),
+                              content_type="application/json")
+        self.assertEqual(
+            os_glance.GlanceBillingFilter.load_image_metadata(resp), metadata)
+        for resp in (
+                webob.Response("{", content_type="application/json"),
+                webob.Response("data", content_type="application/octet-stream"),
+                webob.Response(json.dumps(metadata), status=409,
+                               content_type="application/json")):
+            self.assertEqual(
+                os_glance.GlanceBillingFilter.load_image_metadata(resp), None)
+        # the streaming response is not consumed
+        resp = webob.Response(app_iter=stream(),
+                              content_type="application/json")
+        app_iter = resp.app_iter
+        os_glance.GlanceBillingFilter.load_image_metadata(resp)
+        self.assertTrue(resp.app_iter is app_iter)
+        self.assertEqual(list(app_iter), [json.dumps(metadata)])
+
+    def test_sender(self):
+        heart = FakeHeart(failures=2)
+        sender = self.make_sender(heart, queue_size=3)
+        self.stubs.Set(os_glance.time, "sleep", lambda seconds: None)
+        for i in xrange(5):
+            sender.send({"name": i})
+        self.assertEqual(sender.stats(),
+                         {"queue_depth": 3, "sent": 0,
+                          "dropped": 2, "rejected": 0})
+        sender.post_events(sender.next_batch())
+        sender.post_events(sender.next_batch())
+        self.assertEqual(heart.requests,
+                         [[{"name": 0}, {"name": 1}], [{"name": 2}]])
+        self.assertEqual(sender.stats(),
+                         {"queue_depth": 0, "sent": 3,
+                          "dropped": 2, "rejected": 0})
+
+    def test_sender_drop(self):
+        heart = FakeHeart(broken=(1, ))
+        sender = self.make_sender(heart, batch_size=4)
+        self.stubs.Set(os_glance.time, "sleep", lambda seconds: None)
+        for i in xrange(4):
+            sender.send({"name": i})
+        sender.post_events(sender.next_batch())
+        # only the broken event is dropped
+        self.assertEqual(heart.requests,
+                         [[{"name": 0}], [{"name": 2}, {"name": 3}]])
+        self.assertEqual(sender.stats(),
+                         {"queue_depth": 0, "sent": 3,
+                          "dropped": 1, "rejected": 0})
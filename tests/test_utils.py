@@ -37,3 +37,16 @@ class UsageTest(tests.TestCase):
         end_at = datetime.datetime(2011, 1, 12, 0, 1)
         seconds = utils.total_seconds(end_at - begin_at)
         self.assertEquals(seconds, 60)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        self.assertEquals(cache.get(1), "a")
+        cache.put(3, "c")
+        self.assertEquals(cache.get(2), None)
+        self.assertEquals(cache.get(1), "a")
+        self.assertEquals(cache.get(3), "c")
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.pop(1), "a")
+        self.assertFalse(1 in cache)